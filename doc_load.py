@@ -1,17 +1,44 @@
+import os
 import PyPDF2
 from docx import Document
 from telegram import File
 
 class DocumentLoader:
-    def __init__(self):
+    def __init__(self, docs_path="data/documents"):
+        self.docs_path = docs_path
         self.supported_formats = ['.pdf', '.docx', '.txt']
     
+    def is_supported(self, file_name: str) -> bool:
+        return os.path.splitext(file_name or "")[1].lower() in self.supported_formats
+    
+    def safe_name(self, file_name: str) -> str:
+        """Имя файла без пути, чтобы загрузка не вышла за папку документов"""
+        return os.path.basename((file_name or "").replace("\\", "/")).lstrip(".")
+    
+    async def download_telegram_document(self, bot, file_id, file_name, docs_path=None):
+        """Скачивает документ из Telegram в папку документов и возвращает путь
+        
+        Файл пишется во временный и переименовывается, поэтому /reload
+        не увидит недокачанный файл.
+        """
+        docs_path = docs_path or self.docs_path
+        os.makedirs(docs_path, exist_ok=True)
+        file_path = os.path.join(docs_path, self.safe_name(file_name))
+        tmp_path = os.path.join(docs_path, f".{self.safe_name(file_name)}.part")
+        
+        file: File = await bot.get_file(file_id)
+        try:
+            await file.download_to_drive(tmp_path)
+            os.replace(tmp_path, file_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return file_path
+    
     async def process_telegram_document(self, bot, file_id, file_name):
         """Скачивает и обрабатывает документ из Telegram"""
         # Скачиваем файл
-        file = await bot.get_file(file_id)
-        file_path = f"data/documents/{file_name}"
-        await file.download_to_drive(file_path)
+        file_path = await self.download_telegram_document(bot, file_id, file_name)
         
         # Извлекаем текст в зависимости от формата
         if file_name.endswith('.pdf'):
@@ -25,7 +52,14 @@ class DocumentLoader:
         """Извлекает текст из PDF"""
         with open(file_path, 'rb') as file:
             reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text()
-            return text
+            return "".join(page.extract_text() for page in reader.pages)
+    
+    def extract_from_docx(self, file_path):
+        """Извлекает текст из DOCX"""
+        doc = Document(file_path)
+        return "".join(para.text + "\n" for para in doc.paragraphs)
+    
+    def extract_from_txt(self, file_path):
+        """Читает текстовый файл"""
+        with open(file_path, 'r', encoding='utf-8') as file:
+            return file.read()
@@ -1,40 +1,55 @@
 import asyncio
 import os
+import signal
+from urllib.parse import urlparse
 from dotenv import load_dotenv
-from src.bot import create_bot
 from telegram import BotCommand
 
 load_dotenv()
 
+# меню команд бота
+COMMANDS = [
+    BotCommand("start", "Начать работу с ботом"),
+    BotCommand("reload", "Перезагрузить документы"),
+    BotCommand("stats", "Показать статистику"),
+    BotCommand("clear", "Очистить историю чата"),
+    BotCommand("collection", "Коллекция документов чата"),
+    BotCommand("collections", "Список коллекций")
+]
+
+def check_env() -> bool:
+    """Проверяет переменные окружения и создает папки данных"""
+    if not os.getenv("BOT_TOKEN"):
+        print("❌ BOT_TOKEN не найден в .env файле")
+        return False
+    
+    if not os.getenv("OPENAI_API_KEY"):
+        print("❌ OPENAI_API_KEY не найден в .env файле")
+        return False
+    
+    # создаем папки если их нет
+    data_dir = os.getenv("DATA_DIR", "data")
+    os.makedirs(os.path.join(data_dir, "documents"), exist_ok=True)
+    os.makedirs(os.path.join(data_dir, "vectors"), exist_ok=True)
+    return True
+
 async def main():
     """Запуск бота"""
     print("🚀 Запускаю Telegram RAG-бота...")
     
     # проверяем переменные окружения
-    if not os.getenv("BOT_TOKEN"):
-        print("❌ BOT_TOKEN не найден в .env файле")
-        return
-        
-    if not os.getenv("OPENAI_API_KEY"):
-        print("❌ OPENAI_API_KEY не найден в .env файле")
+    if not check_env():
         return
     
-    # создаем папки если их нет
-    os.makedirs("data/documents", exist_ok=True)
-    os.makedirs("data/vectors", exist_ok=True)
+    # бот импортируется здесь: при импорте он загружает индексы, а в режиме
+    # webhook их загружают процессы-обработчики, а не этот
+    from src.bot import create_bot
     
     # создаем и запускаем бота
     app = create_bot()
     
     # устанавливаем меню команд
-    commands = [
-        BotCommand("start", "Начать работу с ботом"),
-        BotCommand("reload", "Перезагрузить документы"),
-        BotCommand("stats", "Показать статистику"),
-        BotCommand("clear", "Очистить историю чата")
-    ]
-    
-    await app.bot.set_my_commands(commands)
+    await app.bot.set_my_commands(COMMANDS)
     
     print("✅ Бот запущен и готов к работе!")
     print("📁 Добавь документы в папку data/documents/ и используй команду /reload")
@@ -42,5 +57,49 @@ async def main():
     # запускаем polling
     await app.run_polling()
 
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def main_webhook():
+    """Запуск в режиме webhook с несколькими процессами-обработчиками"""
+    from src.webhook import WebhookServer, WorkerPool, register_webhook
+    
+    print("🚀 Запускаю Telegram RAG-бота в режиме webhook...")
+    if not check_env():
+        return
+    
+    # WEBHOOK_URL — публичный адрес, на который Telegram шлет обновления;
+    # сервер слушает WEBHOOK_LISTEN:WEBHOOK_PORT на пути из этого адреса
+    url = os.getenv("WEBHOOK_URL")
+    secret = os.getenv("WEBHOOK_SECRET")
+    metrics_port = os.getenv("METRICS_PORT")
+    pool = WorkerPool(
+        readers=int(os.getenv("WEBHOOK_WORKERS", "0")) or None,
+        metrics_port=int(metrics_port) if metrics_port else None
+    )
+    server = WebhookServer(
+        pool, os.getenv("WEBHOOK_LISTEN", "0.0.0.0"), int(os.getenv("WEBHOOK_PORT", "8443")),
+        path=urlparse(url).path or "/", secret=secret
+    )
+    
+    # остановка по SIGTERM, как по Ctrl+C: процессы-обработчики завершаются вместе с сервером
+    signal.signal(signal.SIGTERM, _interrupt)
+    pool.start()
+    try:
+        asyncio.run(register_webhook(
+            os.getenv("BOT_TOKEN"), url, secret, COMMANDS, api_url=os.getenv("TELEGRAM_API_URL")
+        ))
+        print(f"✅ Бот принимает обновления на порту {server.port}: {pool.readers} обработчиков вопросов "
+              f"и процесс для изменения индексов")
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        pool.stop()
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    if os.getenv("WEBHOOK_URL"):
+        main_webhook()
+    else:
+        asyncio.run(main())
@@ -0,0 +1,154 @@
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+class AnswerCache:
+    """Кэш ответов для повторяющихся и почти одинаковых вопросов
+
+    Ключ — нормализованный embedding вопроса. Ответ возвращается, если
+    косинусная близость к сохраненному вопросу не ниже threshold и запись
+    не старше ttl секунд. При переполнении вытесняется давно не использованная.
+    Матрица embeddings растет вместе с числом записей, поэтому кэш редко
+    используемой коллекции почти не занимает памяти.
+
+    Ответы, найденные без embedding вопроса, хранятся по точному ключу
+    (get_exact/put_exact). clear() увеличивает epoch: ответ, начатый до
+    сброса, не сохраняется, если put получил прежний epoch.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, max_size: int = 1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.epoch = 0  # номер сброса кэша
+        self.exact = OrderedDict()  # ключ -> (время записи, ответ), от давно не использованных к недавним
+
+        self.vectors = None  # матрица до max_size x dimension, создается при первой записи и растет вдвое
+        self.valid = np.zeros(max_size, dtype=bool)
+        self.created = np.zeros(max_size)
+        self.last_used = np.zeros(max_size)
+        self.results = [None] * max_size
+
+    def get(self, vector: np.ndarray) -> Optional[Dict]:
+        """Ищет ответ на близкий вопрос"""
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+
+        with self.lock:
+            slot = self._best_slot(vector)
+            if slot is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.last_used[slot] = time.time()
+            return dict(self.results[slot])
+
+    def put(self, vector: np.ndarray, result: Dict, epoch: int = None):
+        """Сохраняет ответ, если кэш не сбрасывался после epoch"""
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+
+        with self.lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            if self.vectors is None:
+                self.vectors = np.zeros((min(16, self.max_size), len(vector)), dtype=np.float32)
+
+            now = time.time()
+            self._expire(now)
+
+            capacity = len(self.vectors)
+            free = np.flatnonzero(~self.valid[:capacity])
+            if len(free):
+                slot = free[0]
+            elif capacity < self.max_size:
+                grown = np.zeros((min(capacity * 2, self.max_size), self.vectors.shape[1]), dtype=np.float32)
+                grown[:capacity] = self.vectors
+                self.vectors = grown
+                slot = capacity
+            else:
+                slot = int(np.argmin(self.last_used))
+
+            self.vectors[slot] = vector
+            self.valid[slot] = True
+            self.created[slot] = now
+            self.last_used[slot] = now
+            self.results[slot] = dict(result)
+
+    def get_exact(self, key: Hashable) -> Optional[Dict]:
+        """Ищет ответ, сохраненный по точному ключу"""
+        with self.lock:
+            item = self.exact.get(key)
+            if item is not None and time.time() - item[0] > self.ttl:
+                del self.exact[key]
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.exact.move_to_end(key)
+            return dict(item[1])
+
+    def put_exact(self, key: Hashable, result: Dict, epoch: int = None):
+        """Сохраняет ответ по точному ключу, если кэш не сбрасывался после epoch"""
+        with self.lock:
+            if epoch is not None and epoch != self.epoch:
+                return
+            self.exact[key] = (time.time(), dict(result))
+            self.exact.move_to_end(key)
+            while len(self.exact) > self.max_size:
+                self.exact.popitem(last=False)
+
+    def _best_slot(self, vector: np.ndarray):
+        """Номер самой близкой действующей записи или None"""
+        if self.vectors is None:
+            return None
+
+        self._expire(time.time())
+        if not self.valid.any():
+            return None
+
+        scores = self.vectors @ vector
+        scores[~self.valid[:len(scores)]] = -np.inf
+        slot = int(np.argmax(scores))
+        return slot if scores[slot] >= self.threshold else None
+
+    def _expire(self, now: float):
+        """Помечает устаревшие записи как свободные"""
+        expired = self.valid & (now - self.created > self.ttl)
+        for slot in np.flatnonzero(expired):
+            self.results[slot] = None
+        self.valid &= ~expired
+
+    def clear(self):
+        """Сбрасывает кэш, например после изменения документов"""
+        with self.lock:
+            self.valid[:] = False
+            self.results = [None] * self.max_size
+            self.vectors = None
+            self.exact.clear()
+            self.epoch += 1
+
+    def memory(self) -> int:
+        """Примерный объем кэша в памяти, байт"""
+        with self.lock:
+            vectors = self.vectors.nbytes if self.vectors is not None else 0
+        return vectors + self.valid.nbytes + self.created.nbytes + self.last_used.nbytes
+
+    def stats(self) -> Dict:
+        """Счетчики попаданий и размер кэша"""
+        with self.lock:
+            size = int(self.valid.sum()) + len(self.exact)
+
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': size
+        }
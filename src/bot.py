@@ -1,13 +1,76 @@
 from telegram import Update, BotCommand
+from telegram.constants import MessageLimit
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from src.rag_system import RAGSystem
+from src.ingest_queue import IngestJob, IngestQueue
+from src.metrics import metrics
+from doc_load import DocumentLoader
+import asyncio
 import os
+import time
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# папка с документами, индексами и историей чатов
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
 # инициализируем RAG систему
-rag = RAGSystem(os.getenv("OPENAI_API_KEY"))
+rag = RAGSystem(
+    os.getenv("OPENAI_API_KEY"),
+    docs_path=os.path.join(DATA_DIR, "documents"),
+    store_path=os.path.join(DATA_DIR, "vectors"),
+    history_path=os.path.join(DATA_DIR, "chat_history.db"),
+    collections_path=os.path.join(DATA_DIR, "collections"),
+    index_type=os.getenv("INDEX_TYPE", "flat"),
+    retrieval_mode=os.getenv("RETRIEVAL_MODE", "hybrid"),
+    history_memory_users=int(os.getenv("HISTORY_MEMORY_USERS", "10000")),
+    history_ttl=float(os.getenv("HISTORY_TTL_DAYS", "30")) * 24 * 3600,
+    index_mmap=os.getenv("INDEX_MMAP", "").lower() in ("1", "true", "yes"),
+    verify_index=os.getenv("INDEX_VERIFY", "").lower() in ("1", "true", "yes"),
+    # загруженные коллекции в сумме не превышают бюджета памяти и числа, остальные выгружаются
+    collections_memory=int(float(os.getenv("COLLECTIONS_MEMORY_MB", "1024")) * 1024 * 1024),
+    collections_max_loaded=int(os.getenv("COLLECTIONS_MAX_LOADED", "32")),
+    ingest_workers=int(os.getenv("UPLOAD_WORKERS", "1")),
+    # openai — через API, hashing — локально на CPU, без сети; смена источника требует /reload
+    embedding_provider=os.getenv("EMBEDDING_PROVIDER", "openai"),
+    embedding_dim=int(os.getenv("EMBEDDING_DIM")) if os.getenv("EMBEDDING_DIM") else None,
+    # одновременные вопросы ждут попутчиков до QUERY_BATCH_WINDOW_MS и ищутся одной пачкой
+    query_batch_window=float(os.getenv("QUERY_BATCH_WINDOW_MS", "5")) / 1000,
+    query_batch_size=int(os.getenv("QUERY_BATCH_SIZE", "32")),
+    # процессы-обработчики в режиме webhook только читают индекс, меняет его один процесс
+    index_read_only=os.getenv("INDEX_READ_ONLY", "").lower() in ("1", "true", "yes")
+)
+
+# файлы, присланные в чат, индексируются в фоне; очередь и лимит на пользователя
+# не дают большим загрузкам занять ресурсы, нужные для ответов на вопросы
+document_loader = DocumentLoader(os.path.join(DATA_DIR, "documents"))
+ingest_queue = IngestQueue(
+    rag,
+    max_pending=int(os.getenv("UPLOAD_QUEUE_SIZE", "100")),
+    per_user=int(os.getenv("UPLOAD_PER_USER", "3")),
+    workers=int(os.getenv("UPLOAD_WORKERS", "1"))
+)
+# Bot API отдает ботам файлы не больше 20 МБ
+UPLOAD_MAX_MB = float(os.getenv("UPLOAD_MAX_MB", "20"))
+
+# Telegram ограничивает частоту правок сообщений, поэтому ответ при потоковой
+# генерации обновляется не чаще раза в STREAM_EDIT_INTERVAL секунд
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+
+# метрики собираются, если задан порт HTTP-эндпоинта или METRICS_ENABLED
+METRICS_PORT = os.getenv("METRICS_PORT")
+metrics.enabled = bool(METRICS_PORT) or os.getenv("METRICS_ENABLED", "").lower() in ("1", "true", "yes")
+metrics.add_collector(rag.collect_metrics)
+metrics.add_collector(lambda: [
+    ("rag_upload_queue_jobs", {'state': state}, value)
+    for state, value in ingest_queue.stats().items() if state != 'max_pending'
+])
+
+# пользователи, которым доступны /metrics и /rollback; если заданы, только они
+# переключают коллекции и загружают файлы
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /start"""
@@ -18,16 +81,20 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /reload - перезагрузить документы из папки
 /stats - статистика системы
 /clear - очистить историю чата
+/collection - коллекция документов этого чата
+/collections - список коллекций
 
-💡 Просто напиши любой вопрос, и я найду ответ в загруженных документах!"""
+💡 Просто напиши любой вопрос, и я найду ответ в загруженных документах!
+📎 Пришли файл PDF, DOCX или TXT, и я добавлю его в коллекцию чата."""
 
     await update.message.reply_text(welcome_text)
 
 async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /reload"""
-    loading_msg = await update.message.reply_text("🔄 Перезагружаю документы...")
+    collection = rag.collections.chat_collection(update.effective_chat.id)
+    loading_msg = await update.message.reply_text(f"🔄 Перезагружаю документы коллекции {collection}...")
     
-    success, message = rag.reload_documents()
+    success, message = await rag.reload_documents(collection)
     
     if success:
         await loading_msg.edit_text(f"✅ {message}")
@@ -36,12 +103,19 @@ async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /stats"""
-    stats = rag.get_stats()
+    stats = await rag.get_stats(rag.collections.chat_collection(update.effective_chat.id))
+    collections = stats['collections']
     
     stats_text = f"""📊 Статистика системы:
 
+🗄 Коллекция: {stats['collection']}, индекс {_format_mb(stats['index_memory'])}
+🗃 Коллекций в памяти: {collections['loaded']} из {collections['total']} (не больше {collections['max_loaded']}), {_format_mb(collections['memory'])} из {_format_mb(collections['memory_budget'])}
 📄 Всего частей документов: {stats['total_chunks']}
 📁 Всего файлов: {stats['total_sources']}
+🧠 Кэш embeddings: {stats['embedding_cache']['size']} записей, попаданий {stats['embedding_cache']['hits']}, промахов {stats['embedding_cache']['misses']}
+💬 Кэш ответов: {stats['answer_cache']['size']} записей, попаданий {stats['answer_cache']['hit_rate']:.0%}
+🗂 История чатов: в памяти {stats['chat_history']['memory']} из {stats['chat_history']['memory_limit']}, сохранено {stats['chat_history']['persistent']}
+⏱ Время до первого токена: {_format_ms(stats['ttft_ms_p50'])} (p95 {_format_ms(stats['ttft_ms_p95'])})
 
 📚 Загруженные файлы:"""
     
@@ -53,21 +127,112 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.reply_text(stats_text)
 
+async def metrics_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /metrics, только для администраторов"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    if not metrics.enabled:
+        await update.message.reply_text("📈 Метрики выключены: задай METRICS_PORT или METRICS_ENABLED=1")
+        return
+    
+    text = "📈 Метрики:\n\n" + "\n".join(metrics.summary())
+    await update.message.reply_text(text[:MessageLimit.MAX_TEXT_LENGTH])
+
+async def rollback_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /rollback: возврат к индексу до последней перезагрузки, только для администраторов"""
+    if update.effective_user.id not in ADMIN_IDS:
+        return
+    
+    collection = rag.collections.chat_collection(update.effective_chat.id)
+    if await rag.rollback_documents(collection):
+        count = await rag.count_chunks(collection)
+        await update.message.reply_text(f"↩️ Индекс {collection} возвращен к предыдущей версии: {count} частей")
+    else:
+        await update.message.reply_text("❌ Предыдущая версия индекса не сохранилась")
+
+async def collection_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /collection [имя]: показывает или меняет коллекцию документов чата"""
+    chat_id = update.effective_chat.id
+    
+    if not context.args:
+        collection = rag.collections.chat_collection(chat_id)
+        docs_path = rag.collections.paths(collection)[0]
+        await update.message.reply_text(f"🗄 Коллекция чата: {collection}\n📁 Документы: {docs_path}/")
+        return
+    
+    if ADMIN_IDS and update.effective_user.id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Менять коллекцию могут только администраторы")
+        return
+    
+    name = context.args[0].lower()
+    if not rag.collections.valid_name(name):
+        await update.message.reply_text("❌ Имя коллекции: латинские буквы, цифры, _ и -, до 64 символов")
+        return
+    
+    rag.collections.set_chat_collection(chat_id, name)
+    docs_path = rag.collections.paths(name)[0]
+    await update.message.reply_text(
+        f"✅ Чат переключен на коллекцию {name}\n📁 Положи документы в {docs_path}/ и используй /reload"
+    )
+
+async def collections_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /collections"""
+    current = rag.collections.chat_collection(update.effective_chat.id)
+    loaded = {item.name for item in rag.collections.loaded_collections()}
+    
+    lines = ["🗂 Коллекции:"]
+    for name in rag.collections.list_collections():
+        marks = (" ← этот чат" if name == current else "") + (" (в памяти)" if name in loaded else "")
+        lines.append(f"• {name}{marks}")
+    
+    await update.message.reply_text("\n".join(lines)[:MessageLimit.MAX_TEXT_LENGTH])
+
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /clear"""
-    user_id = update.effective_user.id
-    if user_id in rag.chat_history:
-        del rag.chat_history[user_id]
+    rag.clear_history(update.effective_user.id)
     
     await update.message.reply_text("🗑️ История чата очищена")
 
+def _format_ms(value) -> str:
+    return "нет данных" if value is None else f"{value:.0f} мс"
+
+def _format_mb(value) -> str:
+    return f"{value / 1024 / 1024:.1f} МБ"
+
+async def _edit_message(message, text: str, shown: str, final: bool = False) -> str:
+    """Редактирует сообщение и возвращает показанный текст
+    
+    Промежуточные правки при превышении лимита Telegram пропускаются,
+    итоговая повторяется после паузы.
+    """
+    text = text[:MessageLimit.MAX_TEXT_LENGTH]
+    if text == shown:
+        return shown
+    
+    try:
+        await message.edit_text(text)
+        return text
+    except RetryAfter as e:
+        if not final:
+            return shown
+        await asyncio.sleep(e.retry_after)
+        await message.edit_text(text)
+        return text
+    except BadRequest as e:
+        # текст не изменился после обрезки
+        if "not modified" in str(e).lower():
+            return shown
+        raise
+
 async def handle_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка вопросов пользователя"""
     question = update.message.text
     user_id = update.effective_user.id
+    collection = rag.collections.chat_collection(update.effective_chat.id)
     
     # проверяем есть ли документы
-    if len(rag.vector_store.documents) == 0:
+    if await rag.count_chunks(collection) == 0:
         await update.message.reply_text(
             "⚠️ Документы не загружены. Используй команду /reload для загрузки документов из папки."
         )
@@ -76,8 +241,17 @@ async def handle_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # показываем что обрабатываем
     thinking_msg = await update.message.reply_text("🤔 Ищу ответ в документах...")
     
-    # получаем ответ от RAG системы
-    result = rag.ask_question(user_id, question)
+    # ответ показывается по мере генерации, части между правками копятся
+    answer, shown, last_edit, result = "", "", 0.0, None
+    async for event in rag.ask_question_stream(user_id, question, collection):
+        if 'result' in event:
+            result = event['result']
+            continue
+        
+        answer += event['delta']
+        if time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            shown = await _edit_message(thinking_msg, f"🤖 {answer} ▌", shown)
+            last_edit = time.monotonic()
     
     if result['success']:
         response = f"🤖 {result['answer']}"
@@ -87,26 +261,93 @@ async def handle_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
             response += f"\n\n📚 Источники: {sources_text}"
             response += f"\n📊 Найдено документов: {result['found_docs']}"
         
-        await thinking_msg.edit_text(response)
+        await _edit_message(thinking_msg, response, shown, final=True)
     else:
-        await thinking_msg.edit_text(f"❌ {result['answer']}")
+        await _edit_message(thinking_msg, f"❌ {result['answer']}", shown, final=True)
 
-def create_bot():
-    """Создает и настраивает бота"""
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Загрузка документа: файл ставится в очередь и индексируется в фоне"""
+    document = update.message.document
+    user_id = update.effective_user.id
+    
+    if ADMIN_IDS and user_id not in ADMIN_IDS:
+        await update.message.reply_text("⛔ Загружать документы могут только администраторы")
+        return
+    
+    filename = document_loader.safe_name(document.file_name)
+    if not filename or not document_loader.is_supported(filename):
+        formats = ", ".join(document_loader.supported_formats)
+        await update.message.reply_text(f"❌ Поддерживаются только файлы {formats}")
+        return
+    
+    if document.file_size and document.file_size > UPLOAD_MAX_MB * 1024 * 1024:
+        await update.message.reply_text(f"❌ Файл больше {UPLOAD_MAX_MB:g} МБ, положи его в папку коллекции и используй /reload")
+        return
+    
+    collection = rag.collections.chat_collection(update.effective_chat.id)
+    status_msg = await update.message.reply_text(f"📥 Файл {filename} получен")
+    state = {'shown': status_msg.text, 'last_edit': 0.0}
+    
+    async def notify(text: str, final: bool = False):
+        # промежуточные состояния показываются не чаще STREAM_EDIT_INTERVAL
+        if not final and time.monotonic() - state['last_edit'] < STREAM_EDIT_INTERVAL:
+            return
+        state['last_edit'] = time.monotonic()
+        state['shown'] = await _edit_message(status_msg, text, state['shown'], final=final)
+    
+    async def download(docs_path: str) -> str:
+        return await document_loader.download_telegram_document(context.bot, document.file_id, filename, docs_path)
+    
+    accepted, message = ingest_queue.submit(IngestJob(user_id, collection, filename, download, notify))
+    # правка начинается до того, как обработчик очереди возьмет задание
+    await notify(f"📥 {message}" if accepted else f"❌ {message}", final=True)
+
+async def _start_ingest_queue(app: Application):
+    ingest_queue.start()
+
+async def _stop_ingest_queue(app: Application):
+    await ingest_queue.stop()
+
+def create_bot(metrics_port: int = None):
+    """Создает и настраивает бота
+    
+    metrics_port заменяет METRICS_PORT, когда несколько процессов бота
+    работают на одной машине.
+    """
     bot_token = os.getenv("BOT_TOKEN")
     
     if not bot_token:
         raise ValueError("BOT_TOKEN не найден в .env файле")
     
-    app = Application.builder().token(bot_token).build()
+    metrics_port = metrics_port or METRICS_PORT
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port), os.getenv("METRICS_HOST", "127.0.0.1"))
+    
+    # обновления обрабатываются параллельно, нагрузку ограничивает RAGSystem
+    builder = (
+        Application.builder().token(bot_token).concurrent_updates(True)
+        .post_init(_start_ingest_queue).post_shutdown(_stop_ingest_queue)
+    )
+    
+    # другой адрес Bot API, например локальный сервер или имитация для тестов
+    api_url = os.getenv("TELEGRAM_API_URL")
+    if api_url:
+        builder = builder.base_url(f"{api_url.rstrip('/')}/bot").base_file_url(f"{api_url.rstrip('/')}/file/bot")
+    
+    app = builder.build()
     
     # регистрируем обработчики команд
     app.add_handler(CommandHandler("start", start_command))
     app.add_handler(CommandHandler("reload", reload_command))
     app.add_handler(CommandHandler("stats", stats_command))
     app.add_handler(CommandHandler("clear", clear_command))
+    app.add_handler(CommandHandler("metrics", metrics_command))
+    app.add_handler(CommandHandler("rollback", rollback_command))
+    app.add_handler(CommandHandler("collection", collection_command))
+    app.add_handler(CommandHandler("collections", collections_command))
     
     # обработчик текстовых сообщений
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_question))
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     
     return app
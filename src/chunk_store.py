@@ -0,0 +1,127 @@
+import json
+import sqlite3
+import threading
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+class ChunkStore:
+    """Хранилище частей документов в SQLite с ключом faiss id
+
+    Тексты не держатся в памяти: при поиске читаются только найденные части.
+    """
+
+    def __init__(self, path="data/vectors/chunks.db"):
+        self.path = path
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "id INTEGER PRIMARY KEY, source TEXT NOT NULL, text TEXT NOT NULL, meta TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks(source)")
+        self.conn.commit()
+
+    def upsert_many(self, items: Iterable[Tuple[int, Dict]]):
+        """Добавляет или заменяет части документов"""
+        rows = []
+        for chunk_id, doc in items:
+            meta = {key: value for key, value in doc.items() if key not in ('text', 'source')}
+            rows.append((int(chunk_id), doc['source'], doc['text'], json.dumps(meta, ensure_ascii=False)))
+
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO chunks (id, source, text, meta) VALUES (?, ?, ?, ?)", rows
+            )
+            self.conn.commit()
+
+    def delete_ids(self, ids: List[int]):
+        """Удаляет части по id"""
+        with self.lock:
+            for i in range(0, len(ids), 500):
+                batch = [int(chunk_id) for chunk_id in ids[i:i + 500]]
+                placeholders = ",".join("?" * len(batch))
+                self.conn.execute(f"DELETE FROM chunks WHERE id IN ({placeholders})", batch)
+            self.conn.commit()
+
+    def get_many(self, ids: List[int]) -> Dict[int, Dict]:
+        """Читает части по id"""
+        ids = [int(chunk_id) for chunk_id in ids]
+        if not ids:
+            return {}
+
+        placeholders = ",".join("?" * len(ids))
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT id, source, text, meta FROM chunks WHERE id IN ({placeholders})", ids
+            ).fetchall()
+
+        docs = {}
+        for chunk_id, source, text, meta in rows:
+            doc = json.loads(meta)
+            doc.update({'text': text, 'source': source})
+            docs[chunk_id] = doc
+        return docs
+
+    def iter_texts(self, batch_size: int = 1000) -> Iterator[List[Tuple[int, str]]]:
+        """Отдает пары (id, текст) пачками, не загружая все тексты сразу"""
+        last_id = -1
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT id, text FROM chunks WHERE id > ? ORDER BY id LIMIT ?", (last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def ids(self, start: int = 0) -> List[int]:
+        """Возвращает id не меньше start по возрастанию"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT id FROM chunks WHERE id >= ? ORDER BY id", (start,))]
+
+    def ids_for_sources(self, sources: List[str]) -> List[int]:
+        """id частей указанных файлов, по индексу chunks_source"""
+        ids = []
+        with self.lock:
+            for i in range(0, len(sources), 500):
+                batch = list(sources[i:i + 500])
+                placeholders = ",".join("?" * len(batch))
+                ids.extend(row[0] for row in self.conn.execute(
+                    f"SELECT id FROM chunks WHERE source IN ({placeholders})", batch
+                ))
+        return ids
+
+    def count_source(self, source: str) -> int:
+        """Число частей файла"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks WHERE source = ?", (source,)).fetchone()[0]
+
+    def max_id(self) -> int:
+        """Возвращает наибольший id или -1"""
+        with self.lock:
+            value = self.conn.execute("SELECT MAX(id) FROM chunks").fetchone()[0]
+        return -1 if value is None else value
+
+    def count(self, below: int = None) -> int:
+        """Число частей в хранилище, при below — только с id меньше below"""
+        with self.lock:
+            if below is None:
+                return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            return self.conn.execute("SELECT COUNT(*) FROM chunks WHERE id < ?", (below,)).fetchone()[0]
+
+    def sources(self) -> List[str]:
+        """Имена файлов, части которых есть в хранилище"""
+        with self.lock:
+            return [row[0] for row in self.conn.execute("SELECT DISTINCT source FROM chunks")]
+
+    def clear(self):
+        """Удаляет все части"""
+        with self.lock:
+            self.conn.execute("DELETE FROM chunks")
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
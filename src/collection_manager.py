@@ -0,0 +1,216 @@
+import os
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List
+from src.document_processor import DocProcessor
+from src.vector_store import FAISSVectorStore
+from src.answer_cache import AnswerCache
+from src.embedding_cache import EmbeddingCache
+from src.embeddings import EmbeddingProvider, OpenAIEmbeddingProvider
+
+DEFAULT_COLLECTION = "default"
+
+# имя коллекции становится именем папки
+COLLECTION_NAME = re.compile(r'^[a-z0-9_-]{1,64}$')
+
+# память загруженной коллекции сверх индекса и кэша ответов: соединения SQLite
+# к chunks.db и lexical.db с кэшем страниц (около 6 открытых файлов вместе с WAL)
+# и манифест
+COLLECTION_OVERHEAD = 8 * 1024 * 1024
+
+class Collection:
+    """Отдельная база знаний: папка документов, хранилище векторов и кэш ответов"""
+
+    def __init__(self, name: str, doc_processor: DocProcessor, vector_store: FAISSVectorStore):
+        self.name = name
+        self.doc_processor = doc_processor
+        self.vector_store = vector_store
+        self.answer_cache = AnswerCache()
+        self.users = 0  # сколько запросов сейчас работает с коллекцией
+
+    def memory(self) -> int:
+        """Примерный объем коллекции в памяти, байт"""
+        return self.vector_store.memory() + self.answer_cache.memory() + COLLECTION_OVERHEAD
+
+class CollectionManager:
+    """Именованные коллекции документов, загружаемые по требованию
+
+    Коллекция «default» лежит в прежних папках data/documents и data/vectors,
+    остальные — в root/<имя>/{documents,vectors}. Загруженные коллекции
+    вытесняются из памяти по LRU, когда их индексы, кэши ответов и
+    соединения в сумме превышают memory_budget байт или коллекций больше
+    max_loaded (у каждой открыто около 6 файлов); занятые запросами
+    коллекции не вытесняются. Источник embeddings (с ограничением частоты
+    запросов к API) и кэш embeddings общие для всех коллекций.
+    Чат привязывается к коллекции в SQLite.
+    """
+
+    def __init__(self, root="data/collections", memory_budget: int = 1024 * 1024 * 1024, max_loaded: int = 32,
+                 default_docs_path="data/documents", default_store_path="data/vectors",
+                 embedder: EmbeddingProvider = None, client=None, cache_size=200000,
+                 embedding_concurrency=4, tokens_per_minute=1000000, **store_kwargs):
+        self.root = root
+        self.memory_budget = memory_budget
+        self.max_loaded = max_loaded
+        self.default_docs_path = default_docs_path
+        self.default_store_path = default_store_path
+        self.store_kwargs = store_kwargs
+        self.embedder = embedder or OpenAIEmbeddingProvider(
+            client, max_concurrency=embedding_concurrency, tokens_per_minute=tokens_per_minute
+        )
+
+        os.makedirs(root, exist_ok=True)
+        os.makedirs(default_store_path, exist_ok=True)
+        # прежний кэш хранилища по умолчанию становится общим
+        self.cache = EmbeddingCache(os.path.join(default_store_path, "embeddings_cache.db"), max_entries=cache_size)
+
+        self.lock = threading.Lock()  # словари коллекций
+        self.load_locks = {}  # имя -> блокировка загрузки, чтобы коллекция не загружалась дважды
+        self.loaded = OrderedDict()  # имя -> Collection, от давно не использованных к недавним
+
+        self.conn = sqlite3.connect(os.path.join(root, "collections.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS chat_collections (chat_id INTEGER PRIMARY KEY, collection TEXT NOT NULL)"
+        )
+        self.conn.commit()
+        self.db_lock = threading.Lock()
+
+    @staticmethod
+    def valid_name(name: str) -> bool:
+        return bool(COLLECTION_NAME.match(name or ""))
+
+    def paths(self, name: str):
+        """Папки документов и векторов коллекции"""
+        if name == DEFAULT_COLLECTION:
+            return self.default_docs_path, self.default_store_path
+        path = os.path.join(self.root, name)
+        return os.path.join(path, "documents"), os.path.join(path, "vectors")
+
+    def acquire(self, name: str) -> Collection:
+        """Возвращает коллекцию, загружая ее при необходимости
+
+        Коллекция не вытесняется, пока не вызван release.
+        """
+        if not self.valid_name(name):
+            raise ValueError(f"Недопустимое имя коллекции: {name}")
+
+        with self.lock:
+            collection = self._take(name)
+            if collection is not None:
+                return collection
+            load_lock = self.load_locks.setdefault(name, threading.Lock())
+
+        # загрузка идет вне общей блокировки: другие коллекции тем временем доступны
+        with load_lock:
+            with self.lock:
+                collection = self._take(name)
+                if collection is not None:
+                    return collection
+
+            collection = self._load(name)
+
+            with self.lock:
+                collection.users += 1
+                self.loaded[name] = collection
+                evicted = self._evict()
+
+        for item in evicted:
+            print(f"Коллекция {item.name} выгружена из памяти")
+            item.vector_store.close()
+
+        return collection
+
+    def release(self, collection: Collection):
+        """Отпускает коллекцию, полученную через acquire"""
+        with self.lock:
+            collection.users -= 1
+            evicted = self._evict()
+
+        for item in evicted:
+            print(f"Коллекция {item.name} выгружена из памяти")
+            item.vector_store.close()
+
+    def _take(self, name: str):
+        """Занимает уже загруженную коллекцию; вызывается под self.lock"""
+        collection = self.loaded.get(name)
+        if collection is not None:
+            collection.users += 1
+            self.loaded.move_to_end(name)
+        return collection
+
+    def _load(self, name: str) -> Collection:
+        docs_path, store_path = self.paths(name)
+        os.makedirs(docs_path, exist_ok=True)
+
+        vector_store = FAISSVectorStore(store_path, cache=self.cache, embedder=self.embedder, **self.store_kwargs)
+        print(f"Коллекция {name} загружена: {vector_store.count()} частей")
+        return Collection(name, DocProcessor(docs_path), vector_store)
+
+    def _evict(self) -> List[Collection]:
+        """Убирает давно не использованные свободные коллекции, пока память больше бюджета
+        или коллекций больше max_loaded
+
+        Вызывается под self.lock; возвращает коллекции, которые нужно закрыть.
+        """
+        evicted = []
+        memory = {name: collection.memory() for name, collection in self.loaded.items()}
+        total = sum(memory.values())
+
+        for name in list(self.loaded):
+            if total <= self.memory_budget and len(self.loaded) <= self.max_loaded:
+                break
+            collection = self.loaded[name]
+            if collection.users > 0:
+                continue
+            total -= memory[name]
+            del self.loaded[name]
+            evicted.append(collection)
+
+        return evicted
+
+    def loaded_collections(self) -> List[Collection]:
+        with self.lock:
+            return list(self.loaded.values())
+
+    def list_collections(self) -> List[str]:
+        """Имена коллекций на диске"""
+        names = {DEFAULT_COLLECTION}
+        for name in os.listdir(self.root):
+            if self.valid_name(name) and os.path.isdir(os.path.join(self.root, name)):
+                names.add(name)
+        return sorted(names)
+
+    def chat_collection(self, chat_id: int) -> str:
+        """Коллекция, выбранная в чате"""
+        with self.db_lock:
+            row = self.conn.execute(
+                "SELECT collection FROM chat_collections WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+        return row[0] if row else DEFAULT_COLLECTION
+
+    def set_chat_collection(self, chat_id: int, name: str):
+        """Привязывает чат к коллекции, создавая ее папки"""
+        if not self.valid_name(name):
+            raise ValueError(f"Недопустимое имя коллекции: {name}")
+
+        os.makedirs(self.paths(name)[0], exist_ok=True)
+        with self.db_lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chat_collections (chat_id, collection) VALUES (?, ?)", (chat_id, name)
+            )
+            self.conn.commit()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            memory = sum(collection.memory() for collection in self.loaded.values())
+            loaded = len(self.loaded)
+        return {
+            'loaded': loaded,
+            'max_loaded': self.max_loaded,
+            'total': len(self.list_collections()),
+            'memory': memory,
+            'memory_budget': self.memory_budget
+        }
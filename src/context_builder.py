@@ -0,0 +1,92 @@
+from typing import Dict, List, Tuple
+from src.tokens import count_tokens, truncate_to_tokens
+
+class ContextAssembler:
+    """Собирает контекст для модели в пределах бюджета токенов
+
+    Пересекающиеся и соседние части одного файла склеиваются по смещениям
+    start/end, повторяющийся текст отбрасывается, фрагменты добавляются по
+    убыванию релевантности, пока не кончится бюджет.
+    """
+
+    def __init__(self, token_budget: int = 2500, min_fragment_tokens: int = 100):
+        self.token_budget = token_budget
+        self.min_fragment_tokens = min_fragment_tokens
+
+    def assemble(self, docs: List[Dict]) -> Tuple[str, List[Dict]]:
+        """Возвращает текст контекста и вошедшие в него фрагменты"""
+        fragments = self._merge(docs)
+        context_parts, used = [], []
+        remaining = self.token_budget
+
+        for fragment in fragments:
+            header = f"Документ {len(used) + 1} ({fragment['source']}, релевантность: {fragment['similarity_score']:.2f}):\n"
+            text = fragment['text']
+            tokens = count_tokens(header + text)
+
+            if tokens > remaining:
+                # последний фрагмент обрезаем, если от него останется что-то осмысленное
+                available = remaining - count_tokens(header)
+                if available < self.min_fragment_tokens:
+                    break
+                text = truncate_to_tokens(text, available)
+                tokens = remaining
+
+            context_parts.append(header + text)
+            used.append(fragment)
+            remaining -= tokens
+
+            if remaining <= 0:
+                break
+
+        return "\n\n---\n\n".join(context_parts), used
+
+    def _merge(self, docs: List[Dict]) -> List[Dict]:
+        """Склеивает пересекающиеся части одного файла и убирает повторы"""
+        by_source = {}
+        for rank, doc in enumerate(docs):
+            by_source.setdefault(doc['source'], []).append((rank, doc))
+
+        fragments = []
+        for source, items in by_source.items():
+            with_offsets = sorted(
+                (item for item in items if 'start' in item[1]), key=lambda item: item[1]['start']
+            )
+            current = None
+
+            for rank, doc in with_offsets:
+                # соседние части разделены одним пробелом
+                if current and doc['start'] <= current['end'] + 1:
+                    if doc['end'] > current['end']:
+                        overlap = current['end'] - doc['start']
+                        tail = doc['text'][overlap:] if overlap >= 0 else ' ' + doc['text']
+                        current['text'] += tail
+                        current['end'] = doc['end']
+                    current['rank'] = min(current['rank'], rank)
+                    current['similarity_score'] = max(current['similarity_score'], doc.get('similarity_score', 0))
+                    continue
+
+                current = {
+                    'source': source,
+                    'text': doc['text'],
+                    'start': doc['start'],
+                    'end': doc['end'],
+                    'rank': rank,
+                    'similarity_score': doc.get('similarity_score', 0),
+                }
+                fragments.append(current)
+
+            # части из индексов старого формата без смещений
+            for rank, doc in items:
+                if 'start' in doc:
+                    continue
+                if any(doc['text'] in fragment['text'] for fragment in fragments if fragment['source'] == source):
+                    continue
+                fragments.append({
+                    'source': source,
+                    'text': doc['text'],
+                    'rank': rank,
+                    'similarity_score': doc.get('similarity_score', 0),
+                })
+
+        return sorted(fragments, key=lambda fragment: fragment['rank'])
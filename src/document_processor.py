@@ -3,45 +3,244 @@ import PyPDF2
 from docx import Document
 import re
 import json
+import hashlib
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Iterator, List
+from src.tokens import count_tokens_batch
+from src.metrics import metrics
+
+class IngestProgress:
+    """Счетчики и время этапов загрузки документов"""
+    
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.seconds = {}
+        self.counts = {}
+    
+    def add(self, stage: str, seconds: float, count: int = 1):
+        """Учитывает время и число обработанных элементов этапа"""
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.counts[stage] = self.counts.get(stage, 0) + count
+        metrics.observe("rag_ingest_stage_seconds", seconds, stage=stage)
+        metrics.inc("rag_ingest_items_total", count, stage=stage)
+    
+    def report(self) -> str:
+        """Сводка по этапам"""
+        parts = [
+            f"{stage}: {self.counts[stage]} за {self.seconds[stage]:.2f} с"
+            for stage in self.seconds
+        ]
+        parts.append(f"всего {time.perf_counter() - self.started:.2f} с")
+        return "; ".join(parts)
 
 class DocProcessor:
-    def __init__(self, docs_path="data/documents"):
+    def __init__(self, docs_path="data/documents", workers: int = None, pdf_pages_per_task: int = 50,
+                 large_pdf_bytes: int = 5 * 1024 * 1024, chunk_tokens: int = 500, overlap_tokens: int = 100):
         self.docs_path = docs_path
+        self.chunk_tokens = chunk_tokens
+        self.overlap_tokens = overlap_tokens
+        self.workers = workers or os.cpu_count() or 1
+        # большие PDF извлекаются по диапазонам страниц в разных процессах
+        self.pdf_pages_per_task = pdf_pages_per_task
+        self.large_pdf_bytes = large_pdf_bytes
         
-    def load_all_documents(self):
-        """Загружает все документы из папки"""
-        docs = []
-        
+    def load_all_documents(self, filenames: List[str] = None):
+        """Загружает все документы из папки или только указанные файлы"""
+        return list(self.iter_documents(filenames))
+    
+    def iter_documents(self, filenames: List[str] = None, progress: IngestProgress = None) -> Iterator[Dict]:
+        """Извлекает файлы параллельно и отдает части документов по мере готовности"""
         if not os.path.exists(self.docs_path):
             os.makedirs(self.docs_path)
-            return docs
+            return
+        
+        if filenames is None:
+            filenames = self._list_files()
+        
+        progress = progress or IngestProgress()
+        tasks = self._plan_tasks(filenames)
+        parts_total = {}
+        for filename, _, _ in tasks:
+            parts_total[filename] = parts_total.get(filename, 0) + 1
+        parts = {}
+        done = 0
+        
+        for filename, part, result, timings in self._run_tasks(tasks, parts_total):
+            progress.add("извлечение", timings['extract'])
             
-        for filename in os.listdir(self.docs_path):
-            if filename.startswith('.'):
-                continue
+            if parts_total[filename] == 1:
+                # файл целиком разбит на части в рабочем процессе
+                chunks = result
+                progress.add("разбиение", timings['split'], len(chunks))
+            else:
+                parts.setdefault(filename, {})[part] = result
+                if len(parts[filename]) < parts_total[filename]:
+                    continue
                 
+                file_parts = parts.pop(filename)
+                text = "".join(file_parts[i] for i in range(len(file_parts)))
+                
+                start = time.perf_counter()
+                chunks = self._split_into_chunks(text) if text else []
+                progress.add("разбиение", time.perf_counter() - start, len(chunks))
+            
+            done += 1
+            if not chunks:
+                continue
+            
+            print(f"Обработан: {filename} -> {len(chunks)} частей ({done}/{len(parts_total)})")
+            
+            for i, chunk in enumerate(chunks):
+                yield {
+                    'id': f"{filename}_chunk_{i}",
+                    'text': chunk['text'],
+                    'source': filename,
+                    'start': chunk['start'],
+                    'end': chunk['end'],
+                    'chunk_num': i,
+                    'total_chunks': len(chunks)
+                }
+    
+    def _plan_tasks(self, filenames: List[str]):
+        """Разбивает работу на задачи (файл, номер части, диапазон страниц)"""
+        tasks = []
+        
+        for filename in filenames:
             filepath = os.path.join(self.docs_path, filename)
-            text = self._extract_text(filepath, filename)
+            page_count = 0
             
-            if text:
-                chunks = self._split_into_chunks(text)
-                for i, chunk in enumerate(chunks):
-                    docs.append({
-                        'id': f"{filename}_chunk_{i}",
-                        'text': chunk,
-                        'source': filename,
-                        'chunk_num': i,
-                        'total_chunks': len(chunks)
-                    })
-                print(f"Обработан: {filename} -> {len(chunks)} частей")
-                
-        return docs
+            if filename.lower().endswith('.pdf') and os.path.getsize(filepath) >= self.large_pdf_bytes:
+                try:
+                    with open(filepath, 'rb') as file:
+                        page_count = len(PyPDF2.PdfReader(file).pages)
+                except Exception as e:
+                    print(f"Ошибка чтения {filename}: {e}")
+            
+            if page_count > self.pdf_pages_per_task:
+                for part, start in enumerate(range(0, page_count, self.pdf_pages_per_task)):
+                    tasks.append((filename, part, (start, start + self.pdf_pages_per_task)))
+            else:
+                tasks.append((filename, 0, None))
+        
+        return tasks
+    
+    def _run_tasks(self, tasks, parts_total):
+        """Выполняет задачи извлечения в пуле процессов, держа в работе ограниченное их число"""
+        if self.workers == 1 or len(tasks) <= 1:
+            for filename, part, pages in tasks:
+                yield (filename, part) + self._extract_part(filename, pages, parts_total[filename] == 1)
+            return
+        
+        queue = iter(tasks)
+        max_in_flight = self.workers * 2  # ограничивает память под извлеченные тексты
+        
+        # spawn: fork процесса с потоками asyncio, SQLite и FAISS может зависнуть в дочернем
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(tasks)),
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            running = {}
+            try:
+                while True:
+                    for filename, part, pages in queue:
+                        future = pool.submit(self._extract_part, filename, pages, parts_total[filename] == 1)
+                        running[future] = (filename, part)
+                        if len(running) >= max_in_flight:
+                            break
+                    
+                    if not running:
+                        return
+                    
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        filename, part = running.pop(future)
+                        yield (filename, part) + future.result()
+            finally:
+                for future in running:
+                    future.cancel()
     
-    def _extract_text(self, filepath, filename):
+    def _extract_part(self, filename, pages=None, split=False):
+        """Извлекает текст файла или диапазона страниц PDF
+        
+        Если split, сразу разбивает текст на части. Возвращает (текст или части, время этапов).
+        """
+        start = time.perf_counter()
+        text = self._extract_text(os.path.join(self.docs_path, filename), filename, pages)
+        timings = {'extract': time.perf_counter() - start, 'split': 0.0}
+        
+        if not split:
+            return text, timings
+        
+        start = time.perf_counter()
+        chunks = self._split_into_chunks(text) if text else []
+        timings['split'] = time.perf_counter() - start
+        return chunks, timings
+    
+    @property
+    def chunking(self) -> str:
+        """Параметры разбиения; при их изменении индекс нужно перестроить"""
+        return f"tokens:{self.chunk_tokens}:{self.overlap_tokens}"
+    
+    def diff_documents(self, manifest: Dict[str, Dict]):
+        """Сравнивает папку с манифестом индекса
+        
+        Возвращает (changed, touched, deleted): новые или измененные файлы,
+        файлы с новым mtime, но прежним содержимым, и удаленные файлы.
+        """
+        changed, touched = {}, {}
+        
+        if not os.path.exists(self.docs_path):
+            os.makedirs(self.docs_path)
+        
+        filenames = self._list_files()
+        
+        for filename in filenames:
+            filepath = os.path.join(self.docs_path, filename)
+            stat = os.stat(filepath)
+            entry = manifest.get(filename)
+            
+            # быстрая проверка без чтения файла
+            if entry and entry.get('mtime') == stat.st_mtime and entry.get('size') == stat.st_size:
+                continue
+            
+            info = self.file_info(filename)
+            
+            if entry and entry.get('hash') == info['hash']:
+                touched[filename] = info
+            else:
+                changed[filename] = info
+        
+        existing = set(filenames)
+        deleted = [filename for filename in manifest if filename not in existing]
+        
+        return changed, touched, deleted
+    
+    def file_info(self, filename: str) -> Dict:
+        """Сведения о файле для манифеста: {hash, mtime, size}"""
+        filepath = os.path.join(self.docs_path, filename)
+        stat = os.stat(filepath)
+        return {'hash': self._file_hash(filepath), 'mtime': stat.st_mtime, 'size': stat.st_size}
+    
+    def _list_files(self) -> List[str]:
+        """Возвращает имена файлов в папке документов"""
+        return [
+            filename for filename in os.listdir(self.docs_path)
+            if not filename.startswith('.') and os.path.isfile(os.path.join(self.docs_path, filename))
+        ]
+    
+    def _file_hash(self, filepath) -> str:
+        """Считает хэш содержимого файла"""
+        sha = hashlib.sha256()
+        with open(filepath, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+        return sha.hexdigest()
+    
+    def _extract_text(self, filepath, filename, pages=None):
         """Извлекает текст из файла"""
         try:
             if filename.lower().endswith('.pdf'):
-                return self._read_pdf(filepath)
+                return self._read_pdf(filepath, pages)
             elif filename.lower().endswith('.docx'):
                 return self._read_docx(filepath)
             elif filename.lower().endswith('.txt'):
@@ -50,39 +249,52 @@ class DocProcessor:
             print(f"Ошибка чтения {filename}: {e}")
         return ""
     
-    def _read_pdf(self, filepath):
+    def _read_pdf(self, filepath, pages=None):
         with open(filepath, 'rb') as file:
             reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in reader.pages:
-                text += page.extract_text() + "\n"
-        return text
+            selected = reader.pages if pages is None else reader.pages[pages[0]:pages[1]]
+            return "".join(page.extract_text() + "\n" for page in selected)
     
     def _read_docx(self, filepath):
         doc = Document(filepath)
-        text = ""
-        for para in doc.paragraphs:
-            text += para.text + "\n"
-        return text
+        return "".join(para.text + "\n" for para in doc.paragraphs)
     
     def _read_txt(self, filepath):
         with open(filepath, 'r', encoding='utf-8') as file:
             return file.read()
     
-    def _split_into_chunks(self, text, chunk_size=1000, overlap=200):
-        """Разбивает текст на части с перекрытием"""
+    def _split_into_chunks(self, text):
+        """Разбивает текст на части по числу токенов с перекрытием
+        
+        Возвращает [{'text', 'start', 'end'}], где start и end — смещения части
+        в очищенном тексте; по ним соседние части одного файла можно склеить.
+        """
         # очищаем текст
         text = re.sub(r'\s+', ' ', text.strip())
         
-        words = text.split()
+        words = [(match.start(), match.end()) for match in re.finditer(r'\S+', text)]
+        counts = count_tokens_batch([text[start:end] for start, end in words])
         chunks = []
+        i = 0
         
-        for i in range(0, len(words), chunk_size - overlap):
-            chunk_words = words[i:i + chunk_size]
-            chunk = ' '.join(chunk_words)
-            chunks.append(chunk)
+        while i < len(words):
+            # набираем слова, пока часть укладывается в chunk_tokens
+            j, tokens = i, 0
+            while j < len(words) and (j == i or tokens + counts[j] <= self.chunk_tokens):
+                tokens += counts[j]
+                j += 1
+            
+            start, end = words[i][0], words[j - 1][1]
+            chunks.append({'text': text[start:end], 'start': start, 'end': end})
             
-            if i + chunk_size >= len(words):
+            if j >= len(words):
                 break
+            
+            # следующая часть начинается на overlap_tokens раньше
+            k, overlap = j, 0
+            while k > i + 1 and overlap + counts[k - 1] <= self.overlap_tokens:
+                k -= 1
+                overlap += counts[k]
+            i = k
                 
         return chunks
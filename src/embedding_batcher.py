@@ -0,0 +1,169 @@
+import random
+import threading
+import time
+import openai
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List
+from src.tokens import count_tokens
+from src.metrics import metrics
+
+# ошибки, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+class TokenRateLimiter:
+    """Ограничивает расход токенов в минуту (token bucket)"""
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60.0
+        self.available = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        """Ждет, пока в бюджете появится нужное число токенов"""
+        # пачка больше минутного лимита ждет полного бюджета
+        tokens = min(tokens, self.capacity)
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+
+                wait = (tokens - self.available) / self.rate
+
+            time.sleep(wait)
+
+class EmbeddingBatcher:
+    """Отправляет тексты в embeddings API пачками по бюджету токенов
+
+    Несколько пачек выполняются параллельно, ошибки 429 и сетевые сбои
+    повторяются с экспоненциальной задержкой, порядок результатов совпадает
+    с порядком входных текстов.
+    """
+
+    def __init__(self, client, model: str, max_batch_tokens: int = 30000, max_batch_items: int = 2048,
+                 max_concurrency: int = 4, tokens_per_minute: int = 1000000,
+                 max_retries: int = 6, base_delay: float = 1.0, max_delay: float = 60.0):
+        # SDK сам повторяет 429 и сетевые сбои (max_retries=2 по умолчанию), и тогда
+        # задержки батчера, Retry-After и лимит токенов не действуют: повторяет только батчер
+        self.client = client.with_options(max_retries=0) if hasattr(client, 'with_options') else client
+        # копия делит HTTP-клиент с исходным, а тот закрывает его в __del__: ссылка держит его живым
+        self.source_client = client
+        self.client_lock = threading.Lock()
+        self.model = model
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_items = max_batch_items
+        self.max_concurrency = max_concurrency
+        self.limiter = TokenRateLimiter(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retries = 0  # сколько раз запросы повторялись
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        """Создает embeddings для всех текстов"""
+        batches = self._pack(texts)
+        results = [None] * len(texts)
+        done = 0
+
+        if len(batches) == 1:
+            indices, tokens = batches[0]
+            return self._embed_batch([texts[i] for i in indices], tokens)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            futures = {
+                pool.submit(self._embed_batch, [texts[i] for i in indices], tokens): indices
+                for indices, tokens in batches
+            }
+
+            for future in as_completed(futures):
+                indices = futures[future]
+                for i, embedding in zip(indices, future.result()):
+                    results[i] = embedding
+
+                done += len(indices)
+                print(f"Создано embeddings: {done}/{len(texts)}")
+
+        return results
+
+    def _pack(self, texts: List[str]):
+        """Разбивает тексты на пачки, не превышающие бюджет токенов"""
+        batches = []
+        indices, batch_tokens = [], 0
+
+        for i, text in enumerate(texts):
+            tokens = count_tokens(text)
+
+            if indices and (batch_tokens + tokens > self.max_batch_tokens or len(indices) >= self.max_batch_items):
+                batches.append((indices, batch_tokens))
+                indices, batch_tokens = [], 0
+
+            indices.append(i)
+            batch_tokens += tokens
+
+        if indices:
+            batches.append((indices, batch_tokens))
+
+        return batches
+
+    def _embed_batch(self, batch: List[str], tokens: int) -> List[List[float]]:
+        """Отправляет одну пачку, повторяя запрос при временных ошибках"""
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(tokens)
+
+            start = time.perf_counter()
+            try:
+                response = self._client().embeddings.create(input=batch, model=self.model)
+                metrics.observe("rag_openai_request_seconds", time.perf_counter() - start, endpoint="embeddings")
+                metrics.inc("rag_openai_requests_total", endpoint="embeddings", status="ok")
+                metrics.inc("rag_openai_tokens_total", tokens, endpoint="embeddings", kind="prompt")
+                # API может вернуть элементы не по порядку
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+            except RETRYABLE_ERRORS as e:
+                metrics.inc("rag_openai_requests_total", endpoint="embeddings", status=type(e).__name__)
+                if attempt == self.max_retries:
+                    print(f"Ошибка создания embeddings: {e}")
+                    raise
+
+                self.retries += 1
+                metrics.inc("rag_openai_retries_total", endpoint="embeddings")
+                delay = self._retry_delay(e, attempt)
+                print(f"Повтор запроса embeddings через {delay:.1f} с: {e}")
+                time.sleep(delay)
+
+    def _client(self):
+        """Клиент API без встроенных повторов
+
+        Вместо модуля openai создается собственный клиент при первом запросе,
+        когда ключ и адрес API уже заданы.
+        """
+        if self.client is openai:
+            with self.client_lock:
+                if self.client is openai:
+                    self.client = openai.OpenAI(api_key=openai.api_key, base_url=openai.base_url, max_retries=0)
+        return self.client
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """Задержка перед повтором: Retry-After или экспоненциальная с джиттером"""
+        response = getattr(error, 'response', None)
+        retry_after = response.headers.get('retry-after') if response is not None else None
+
+        try:
+            if retry_after is not None:
+                return min(self.max_delay, float(retry_after))
+        except ValueError:
+            pass
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
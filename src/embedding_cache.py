@@ -0,0 +1,152 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+from typing import Dict, List, Optional
+
+class EmbeddingCache:
+    """Дисковый кэш embeddings с ключом (модель, хэш текста) и вытеснением LRU
+
+    Чтение идет через соединение своего потока, без общей блокировки и без
+    записи в базу. Время использования записи обновляется не чаще раза в
+    touch_interval секунд: такие отметки копятся в памяти и записываются
+    при сохранении новых векторов или в фоне, когда их набралось flush_size.
+    """
+
+    def __init__(self, path="data/vectors/embeddings_cache.db", max_entries=200000,
+                 touch_interval: float = 3600, flush_size: int = 1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.flush_size = flush_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()  # запись в базу
+        self.local = threading.local()  # соединение для чтения в каждом потоке
+        self.readers = []
+        self.pending_lock = threading.Lock()  # счетчики и отметки использования
+        self.pending = {}  # ключ -> время использования, еще не записанное в базу
+        self.flushing = False
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings(last_used)")
+        self.conn.commit()
+
+    def _key(self, model: str, text: str) -> str:
+        """Ключ записи: модель + sha256 текста"""
+        return f"{model}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def _reader(self) -> sqlite3.Connection:
+        """Соединение для чтения текущего потока"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.local.conn = conn
+            with self.pending_lock:
+                self.readers.append(conn)
+        return conn
+
+    def get_many(self, model: str, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Возвращает векторы из кэша, None для отсутствующих"""
+        keys = [self._key(model, text) for text in texts]
+        found = {}
+        reader = self._reader()
+
+        # sqlite ограничивает число параметров в запросе
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = reader.execute(
+                f"SELECT key, vector, last_used FROM embeddings WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            found.update((key, (blob, last_used)) for key, blob, last_used in rows)
+
+        now = time.time()
+        vectors = []
+        for key in keys:
+            item = found.get(key)
+            vectors.append(None if item is None else np.frombuffer(item[0], dtype=np.float32))
+        hits = sum(vector is not None for vector in vectors)
+
+        with self.pending_lock:
+            self.hits += hits
+            self.misses += len(keys) - hits
+            self.pending.update(
+                (key, now) for key, (_, last_used) in found.items() if now - last_used > self.touch_interval
+            )
+            flush = len(self.pending) >= self.flush_size and not self.flushing
+            if flush:
+                self.flushing = True
+
+        if flush:
+            threading.Thread(target=self._flush_in_background, daemon=True).start()
+
+        return vectors
+
+    def put_many(self, model: str, texts: List[str], vectors):
+        """Сохраняет векторы в кэш и вытесняет давно не использованные"""
+        now = time.time()
+        rows = [
+            (self._key(model, text), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)", rows
+            )
+            # отметки использования записываются до вытеснения, чтобы не удалить читаемые записи
+            self._write_pending()
+            self._evict()
+            self.conn.commit()
+
+    def flush(self):
+        """Записывает накопленные отметки использования в базу"""
+        with self.lock:
+            self._write_pending()
+            self.conn.commit()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        finally:
+            with self.pending_lock:
+                self.flushing = False
+
+    def _write_pending(self):
+        """Обновляет last_used по накопленным отметкам; вызывается под self.lock"""
+        with self.pending_lock:
+            touched, self.pending = self.pending, {}
+        if touched:
+            self.conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key, now in touched.items()]
+            )
+
+    def _evict(self):
+        """Удаляет самые старые записи сверх лимита"""
+        count = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        excess = count - self.max_entries
+        if excess > 0:
+            self.conn.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (excess,)
+            )
+
+    def stats(self) -> Dict:
+        """Возвращает счетчики попаданий и размер кэша"""
+        size = self._reader().execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': size
+        }
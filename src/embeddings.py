@@ -0,0 +1,141 @@
+import abc
+import functools
+import hashlib
+import math
+import numpy as np
+import openai
+from collections import Counter
+from typing import Dict, List, Tuple
+from src.embedding_batcher import EmbeddingBatcher
+from src.lexical_index import tokenize
+from src.metrics import metrics
+
+EMBEDDING_PROVIDERS = ("openai", "hashing")
+
+# размерность embeddings моделей OpenAI: API не позволяет ее выбрать
+OPENAI_DIMENSIONS = {"text-embedding-ada-002": 1536}
+
+class EmbeddingProvider(abc.ABC):
+    """Источник embeddings для хранилища
+
+    embed возвращает матрицу float32 размером (число текстов, dimension).
+    metadata сохраняется в манифесте индекса: по ней хранилище узнает,
+    что индекс построен другой моделью и его нужно перестроить.
+    """
+
+    name = None
+    model = None
+    dimension = None
+    cacheable = True  # стоит ли хранить результаты в дисковом кэше embeddings
+
+    @abc.abstractmethod
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Embeddings текстов, (число текстов, dimension)"""
+
+    def metadata(self) -> Dict:
+        return {'provider': self.name, 'model': self.model, 'dimension': self.dimension}
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """Embeddings через OpenAI API пачками с ограничением частоты запросов"""
+
+    name = "openai"
+
+    def __init__(self, client=None, model: str = "text-embedding-ada-002", dimension: int = 1536,
+                 max_concurrency: int = 4, tokens_per_minute: int = 1000000):
+        self.client = client or openai  # клиент embeddings, в тестах можно подменить
+        self.model = model
+        self.dimension = dimension
+        self.batcher = EmbeddingBatcher(
+            self.client, model, max_concurrency=max_concurrency, tokens_per_minute=tokens_per_minute
+        )
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        return np.array(self.batcher.embed(texts), dtype=np.float32).reshape(len(texts), self.dimension)
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """Локальные embeddings без сети: хэшированные термы и их n-граммы
+
+    Термы текста (те же, что у BM25) и символьные n-граммы термов хэшируются
+    со случайным знаком в dimension координат — это случайная проекция
+    разреженного вектора частот. Вес терма 1 + log(tf). Вся пачка текстов
+    собирается в матрицу одним вызовом numpy, признаки термов кэшируются,
+    поэтому вопрос кодируется за доли миллисекунды.
+    """
+
+    name = "hashing"
+    cacheable = False  # посчитать заново быстрее, чем прочитать из SQLite
+
+    def __init__(self, dimension: int = 512, ngram_range: Tuple[int, int] = (3, 4), ngram_weight: float = 0.5,
+                 seed: int = 0, cache_terms: int = 200000):
+        self.dimension = dimension
+        self.ngram_range = ngram_range
+        self.ngram_weight = ngram_weight
+        self.seed = seed
+        self.model = f"hashing-{ngram_range[0]}-{ngram_range[1]}-seed{seed}"
+        self._key = seed.to_bytes(8, 'little')
+        self._term_features = functools.lru_cache(maxsize=cache_terms)(self._features)
+
+    def metadata(self) -> Dict:
+        return {**super().metadata(), 'ngram_range': list(self.ngram_range), 'ngram_weight': self.ngram_weight}
+
+    def _hash(self, feature: str) -> Tuple[int, float]:
+        value = int.from_bytes(
+            hashlib.blake2b(feature.encode('utf-8'), digest_size=8, key=self._key).digest(), 'little'
+        )
+        return value % self.dimension, (1.0 if value >> 63 else -1.0)
+
+    def _features(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Координаты и веса признаков терма"""
+        features = [(term, 1.0)]
+        padded = f"<{term}>"
+        low, high = self.ngram_range
+        for n in range(low, high + 1):
+            features.extend((padded[i:i + n], self.ngram_weight) for i in range(len(padded) - n + 1))
+
+        columns, values = [], []
+        for feature, weight in features:
+            column, sign = self._hash(feature)
+            columns.append(column)
+            values.append(sign * weight)
+        return np.array(columns, dtype=np.int64), np.array(values, dtype=np.float32)
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        with metrics.timer("rag_local_embedding_seconds", provider=self.name):
+            rows, columns, values = [], [], []
+            for row, text in enumerate(texts):
+                for term, count in Counter(tokenize(text)).items():
+                    term_columns, term_values = self._term_features(term)
+                    rows.append(np.full(len(term_columns), row, dtype=np.int64))
+                    columns.append(term_columns)
+                    values.append(term_values * (1.0 + math.log(count)))
+
+            matrix = np.zeros((len(texts), self.dimension), dtype=np.float32)
+            if rows:
+                flat = np.concatenate(rows) * self.dimension + np.concatenate(columns)
+                matrix = np.bincount(
+                    flat, weights=np.concatenate(values), minlength=len(texts) * self.dimension
+                ).astype(np.float32).reshape(len(texts), self.dimension)
+
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            return matrix / np.maximum(norms, 1e-12)
+
+def create_provider(name: str = "openai", dimension: int = None, client=None,
+                    max_concurrency: int = 4, tokens_per_minute: int = 1000000) -> EmbeddingProvider:
+    """Создает источник embeddings по имени: openai или hashing
+
+    Размерность задается только для hashing; для openai она определяется
+    моделью, и другое значение — ошибка, ведь с ним строится индекс.
+    """
+    if name == "openai":
+        model_dimension = OPENAI_DIMENSIONS["text-embedding-ada-002"]
+        if dimension is not None and dimension != model_dimension:
+            raise ValueError(
+                f"Размерность embeddings {dimension} не подходит для OpenAI: у модели "
+                f"text-embedding-ada-002 она {model_dimension}, задай EMBEDDING_DIM только для hashing"
+            )
+        return OpenAIEmbeddingProvider(
+            client, max_concurrency=max_concurrency, tokens_per_minute=tokens_per_minute
+        )
+    if name == "hashing":
+        return HashingEmbeddingProvider(dimension or 512)
+    raise ValueError(f"Неизвестный источник embeddings: {name}, доступны: {', '.join(EMBEDDING_PROVIDERS)}")
@@ -0,0 +1,451 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import numpy as np
+from typing import Dict, List
+from src.embeddings import EMBEDDING_PROVIDERS, create_provider
+
+try:
+    import resource
+except ImportError:  # нет в Windows, пиковая память тогда не измеряется
+    resource = None
+
+RETRIEVAL_MODES = ('vector', 'lexical', 'hybrid')
+
+def load_qa(path: str) -> List[Dict]:
+    """Загружает набор вопросов: [{"question": ..., "sources": [имена файлов]}]"""
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read()
+    return json.loads(content) if content.strip() else []
+
+def retrieve(store, mode: str, question: str, top_k: int) -> List[Dict]:
+    """Поиск выбранным способом"""
+    if mode == 'vector':
+        return store.search(question, top_k)
+    if mode == 'lexical':
+        return store.lexical_search(question, top_k)
+    if mode == 'hybrid':
+        return store.hybrid_search(question, top_k)
+    raise ValueError(f"Неизвестный режим поиска: {mode}")
+
+def _percentiles(values: List[float], scale: float = 1000.0) -> Dict[str, float]:
+    """p50/p95/p99 в миллисекундах"""
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0}
+    return {f'p{q}': float(np.percentile(values, q) * scale) for q in (50, 95, 99)}
+
+def benchmark_retrieval(store, qa: List[Dict], top_k: int = 3, modes=RETRIEVAL_MODES) -> Dict[str, Dict]:
+    """Сравнивает режимы поиска: recall@k и MRR по источникам, задержку и число запросов к API"""
+    results = {}
+
+    for mode in modes:
+        latencies, hits, reciprocal_ranks, api_calls = [], 0, [], 0
+
+        for item in qa:
+            misses_before = store.cache.misses
+            start = time.perf_counter()
+            docs = retrieve(store, mode, item['question'], top_k)
+            latencies.append((time.perf_counter() - start) * 1000)
+            # промахи одного вопроса уходят в API одним запросом
+            api_calls += store.cache.misses > misses_before
+
+            expected = set(item.get('sources', []))
+            rank = next((i + 1 for i, doc in enumerate(docs) if doc['source'] in expected), None)
+            if rank:
+                hits += 1
+            reciprocal_ranks.append(1 / rank if rank else 0.0)
+
+        results[mode] = {
+            'recall_at_k': hits / len(qa) if qa else 0.0,
+            'mrr': float(np.mean(reciprocal_ranks)) if reciprocal_ranks else 0.0,
+            'k': top_k,
+            'latency_ms_p50': float(np.percentile(latencies, 50)) if latencies else 0.0,
+            'latency_ms_p95': float(np.percentile(latencies, 95)) if latencies else 0.0,
+            'embedding_requests': api_calls,
+        }
+
+    return results
+
+# слоги для несуществующих слов синтетического корпуса: каждое слово встречается
+# только в своем файле, поэтому правильный источник вопроса известен
+SYLLABLES = ['ка', 'ро', 'ми', 'ту', 'ле', 'ва', 'ни', 'со', 'да', 'пе', 'зу', 'го', 'ри', 'ба', 'ше', 'лу']
+TOPICS = ['договор', 'склад', 'отчет', 'проект', 'регламент', 'инструкция', 'заявка', 'приказ']
+
+def generate_corpus(docs_path: str, files: int = 20, facts_per_file: int = 30, seed: int = 0) -> List[Dict]:
+    """Создает синтетические документы и вопросы к ним
+
+    В каждом файле facts_per_file фактов вида "параметр <слово> объекта равен N"
+    с общим текстом-заполнителем. Возвращает набор вопросов с ответами-источниками.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(docs_path, exist_ok=True)
+    qa, used = [], set()
+
+    def word():
+        while True:
+            candidate = "".join(rng.choice(SYLLABLES, size=4))
+            if candidate not in used:
+                used.add(candidate)
+                return candidate
+
+    for file_num in range(files):
+        topic = TOPICS[file_num % len(TOPICS)]
+        filename = f"{topic}_{file_num:03d}.txt"
+        paragraphs = []
+
+        for _ in range(facts_per_file):
+            name, value = word(), int(rng.integers(100, 100000))
+            paragraphs.append(
+                f"Раздел про {topic}. Параметр {name} этого объекта равен {value}. "
+                f"Значение параметра {name} проверяется при каждой проверке документа и "
+                f"фиксируется в журнале вместе с датой и подписью ответственного сотрудника."
+            )
+            qa.append({'question': f"Чему равен параметр {name}?", 'sources': [filename]})
+
+        with open(os.path.join(docs_path, filename), 'w', encoding='utf-8') as f:
+            f.write("\n\n".join(paragraphs))
+
+    rng.shuffle(qa)
+    return qa
+
+def _memory_mb() -> Dict[str, float]:
+    """Текущая и пиковая память процесса (пиковая включает процессы извлечения текста)"""
+    memory = {}
+    try:
+        with open('/proc/self/statm') as f:
+            memory['rss_mb'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        pass
+
+    if resource is not None:
+        # ru_maxrss в килобайтах на Linux
+        memory['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        memory['peak_rss_children_mb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return memory
+
+async def _run_users(rag, qa: List[Dict], users: int, questions_per_user: int, user_offset: int) -> Dict:
+    """Задает вопросы от users пользователей одновременно"""
+    latencies, ttfts, stages, errors, cached = [], [], {}, 0, 0
+
+    async def user(num: int):
+        nonlocal errors, cached
+        for i in range(questions_per_user):
+            item = qa[(num + i) % len(qa)]
+            start = time.perf_counter()
+            result = None
+            async for event in rag.ask_question_stream(user_offset + num, item['question']):
+                result = event.get('result', result)
+            latencies.append(time.perf_counter() - start)
+
+            if not result or not result['success']:
+                errors += 1
+                continue
+            cached += bool(result.get('cached'))
+            if result.get('ttft') is not None:
+                ttfts.append(result['ttft'])
+            for stage, seconds in result.get('timings', {}).items():
+                stages.setdefault(stage, []).append(seconds)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(num) for num in range(users)))
+    seconds = time.perf_counter() - start
+
+    return {
+        'users': users,
+        'questions': len(latencies),
+        'seconds': seconds,
+        'questions_per_second': len(latencies) / seconds if seconds else 0.0,
+        'latency_ms': _percentiles(latencies),
+        'ttft_ms': _percentiles(ttfts),
+        'stages_ms': {stage: _percentiles(values) for stage, values in stages.items()},
+        'errors': errors,
+        'answer_cache_hits': cached,
+    }
+
+def run_benchmark(docs_path: str, qa: List[Dict], work_dir: str, concurrency=(1, 8, 32),
+                  questions_per_user: int = 10, top_k: int = 3, index_type: str = "flat",
+                  retrieval_mode: str = "hybrid", embedding_latency: float = 0.02,
+                  chat_latency: float = 0.2, token_latency: float = 0.01,
+                  embedding_provider: str = "openai", embedding_dim: int = None,
+                  query_batch_window: float = 0.005) -> Dict:
+    """Прогоняет загрузку и вопросы через RAGSystem с локальной имитацией OpenAI
+
+    С embedding_provider="hashing" embeddings считаются локально, и имитация
+    отвечает только на запросы к чату. query_batch_window — окно, в котором
+    одновременные вопросы объединяются в один запрос embeddings и один поиск.
+
+    Возвращает результаты в виде словаря, пригодного для сохранения в JSON
+    и сравнения между запусками.
+    """
+    from src.fake_openai import FakeOpenAIServer
+    from src.index_factory import index_memory
+    from src.rag_system import RAGSystem
+
+    server = FakeOpenAIServer(latency=embedding_latency, chat_latency=chat_latency,
+                              token_latency=token_latency).start()
+    rag = RAGSystem(
+        "benchmark", index_type=index_type, retrieval_mode=retrieval_mode, docs_path=docs_path,
+        store_path=os.path.join(work_dir, "vectors"), history_path=os.path.join(work_dir, "chat_history.db"),
+        collections_path=os.path.join(work_dir, "collections"), base_url=server.base_url,
+        embedding_provider=embedding_provider, embedding_dim=embedding_dim,
+        query_batch_window=query_batch_window
+    )
+
+    try:
+        memory_before = _memory_mb()
+        start = time.perf_counter()
+        success, message = rag.reload_documents_sync()
+        ingest_seconds = time.perf_counter() - start
+        if not success:
+            raise RuntimeError(message)
+
+        chunks = rag.vector_store.count()
+        progress = rag.last_ingest
+        ingest = {
+            'files': len(rag.vector_store.sources()),
+            'chunks': chunks,
+            'seconds': ingest_seconds,
+            'chunks_per_second': chunks / ingest_seconds if ingest_seconds else 0.0,
+            'stages_seconds': dict(progress.seconds) if progress else {},
+            'index_bytes': index_memory(rag.vector_store.index),
+            'memory_before': memory_before,
+            'memory_after': _memory_mb(),
+            'embedding_requests': server.requests,
+        }
+
+        retrieval = benchmark_retrieval(rag.vector_store, qa, top_k)
+
+        async def run_levels():
+            # все уровни в одном цикле событий: семафор и HTTP-клиент привязываются к нему
+            levels = {}
+            for num, users in enumerate(concurrency):
+                # ответы прошлого прогона не должны попадать в кэш следующего
+                rag.answer_cache.clear()
+                requests_before = server.embedding_requests
+                level = await _run_users(rag, qa, users, questions_per_user, user_offset=(num + 1) * 1000000)
+                level['embedding_requests'] = server.embedding_requests - requests_before
+                levels[str(users)] = level
+            return levels
+
+        levels = asyncio.run(run_levels())
+
+        return {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'config': {
+                'docs_path': docs_path, 'questions': len(qa), 'top_k': top_k, 'index_type': index_type,
+                'retrieval_mode': retrieval_mode, 'questions_per_user': questions_per_user,
+                'embedding_latency': embedding_latency, 'chat_latency': chat_latency,
+                'token_latency': token_latency, 'chunking': rag.doc_processor.chunking,
+                'embeddings': rag.embedder.metadata(), 'query_batch_window': query_batch_window,
+            },
+            'ingest': ingest,
+            'retrieval': retrieval,
+            'concurrency': levels,
+        }
+    finally:
+        rag.executor.shutdown(wait=False)
+        server.stop()
+
+def run_webhook_benchmark(docs_path: str, qa: List[Dict], work_dir: str, workers=(1, 2, 4),
+                          users: int = 32, questions_per_user: int = 5, chat_latency: float = 0.2,
+                          token_latency: float = 0.01, embedding_provider: str = "hashing") -> Dict:
+    """Вопросы через webhook и пул процессов с имитацией Telegram и OpenAI
+
+    Для каждого числа процессов-читателей из workers запускает пул, загружает
+    документы командой /reload и отправляет users * questions_per_user
+    вопросов, как их прислал бы Telegram. Пропускная способность должна
+    расти с числом процессов, пока их не больше ядер.
+    """
+    import shutil
+    import threading
+    from src.fake_openai import FakeOpenAIServer
+    from src.fake_telegram import FakeTelegramServer, make_update, send_updates
+    from src.webhook import WebhookServer, WorkerPool
+
+    openai_server = FakeOpenAIServer(chat_latency=chat_latency, token_latency=token_latency).start()
+    environ = dict(os.environ)
+    levels = {}
+    try:
+        for readers in workers:
+            data_dir = os.path.join(work_dir, f"webhook_{readers}")
+            shutil.copytree(docs_path, os.path.join(data_dir, "documents"))
+            telegram = FakeTelegramServer().start()
+            # процессы бота читают настройки из окружения
+            os.environ.update(
+                DATA_DIR=data_dir, BOT_TOKEN="1:benchmark", OPENAI_API_KEY="benchmark",
+                OPENAI_BASE_URL=openai_server.base_url, TELEGRAM_API_URL=telegram.base_url,
+                EMBEDDING_PROVIDER=embedding_provider
+            )
+            pool = WorkerPool(readers).start()
+            server = WebhookServer(pool, "127.0.0.1", 0, path="/webhook")
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.port}/webhook"
+
+            try:
+                send_updates(url, [make_update(1, 1, "/reload")])
+                if not telegram.wait_for_answers(1, timeout=600):
+                    raise RuntimeError("Документы не загрузились")
+
+                updates = [
+                    make_update(2 + i, 1000 + i % users, qa[i % len(qa)]['question'])
+                    for i in range(users * questions_per_user)
+                ]
+                start = time.perf_counter()
+                send_updates(url, updates, concurrency=users)
+                finished = telegram.wait_for_answers(1 + len(updates), timeout=600)
+                seconds = time.perf_counter() - start
+
+                answers = telegram.answers[1:]
+                levels[str(readers)] = {
+                    'workers': readers,
+                    'questions': len(answers),
+                    'seconds': seconds,
+                    'questions_per_second': len(answers) / seconds if seconds else 0.0,
+                    'errors': len(updates) - sum(text.startswith('🤖') for _, text in answers),
+                    'timed_out': not finished,
+                }
+            finally:
+                server.shutdown()
+                pool.stop()
+                telegram.stop()
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        openai_server.stop()
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'docs_path': docs_path, 'users': users, 'questions_per_user': questions_per_user,
+            'chat_latency': chat_latency, 'token_latency': token_latency,
+            'embeddings': embedding_provider, 'cpu_count': os.cpu_count(),
+        },
+        'webhook': levels,
+    }
+
+def _flatten(data: Dict, prefix: str = "") -> Dict[str, float]:
+    """Числовые метрики вложенного словаря с ключами вида a.b.c"""
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+def compare_results(current: Dict, baseline: Dict) -> List[str]:
+    """Строки с изменением метрик относительно прошлого запуска"""
+    old, new = _flatten(baseline), _flatten(current)
+    lines = []
+    for name in sorted(old.keys() & new.keys()):
+        if name.startswith('config.') or old[name] == new[name]:
+            continue
+        change = f" ({(new[name] - old[name]) / old[name]:+.1%})" if old[name] else ""
+        lines.append(f"{name}: {old[name]:.4g} -> {new[name]:.4g}{change}")
+    return lines
+
+def main(argv: List[str] = None):
+    """Сравнение режимов поиска на сохраненном индексе или полный бенчмарк с имитацией OpenAI"""
+    parser = argparse.ArgumentParser(description="Качество поиска и производительность RAG-бота")
+    parser.add_argument('--qa', default='data/test_qa.json')
+    parser.add_argument('--store', default='data/vectors')
+    parser.add_argument('--k', type=int, default=3)
+    parser.add_argument('--benchmark', action='store_true',
+                        help="загрузка и вопросы через RAGSystem с локальной имитацией OpenAI")
+    parser.add_argument('--docs', help="папка документов для бенчмарка, по умолчанию синтетический корпус")
+    parser.add_argument('--synthetic-files', type=int, default=20)
+    parser.add_argument('--concurrency', default='1,8,32', help="числа одновременных пользователей через запятую")
+    parser.add_argument('--questions-per-user', type=int, default=10)
+    parser.add_argument('--index-type', default='flat')
+    parser.add_argument('--mode', default='hybrid', choices=['vector', 'hybrid'])
+    parser.add_argument('--embedding-latency', type=float, default=0.02)
+    parser.add_argument('--chat-latency', type=float, default=0.2)
+    parser.add_argument('--token-latency', type=float, default=0.01)
+    parser.add_argument('--embeddings', default='openai', choices=EMBEDDING_PROVIDERS,
+                        help="источник embeddings: OpenAI API (имитация в бенчмарке) или локальный")
+    parser.add_argument('--embedding-dim', type=int, help="размерность локальных embeddings")
+    parser.add_argument('--batch-window-ms', type=float, default=5.0,
+                        help="окно объединения одновременных вопросов, 0 — без объединения")
+    parser.add_argument('--webhook-workers',
+                        help="числа процессов через запятую: вопросы через webhook и пул процессов бота")
+    parser.add_argument('--output', help="файл для результатов в JSON")
+    parser.add_argument('--baseline', help="результаты прошлого запуска для сравнения")
+    args = parser.parse_args(argv)
+
+    if not args.benchmark:
+        from src.vector_store import FAISSVectorStore
+
+        # хранилище может принадлежать работающему боту: оценка его не меняет
+        store = FAISSVectorStore(
+            args.store, embedder=create_provider(args.embeddings, args.embedding_dim), read_only=True
+        )
+        results = benchmark_retrieval(store, load_qa(args.qa), args.k)
+
+        for mode, result in results.items():
+            print(f"{mode:>8}: recall@{result['k']}={result['recall_at_k']:.3f} mrr={result['mrr']:.3f} "
+                  f"p50={result['latency_ms_p50']:.2f} мс p95={result['latency_ms_p95']:.2f} мс "
+                  f"запросов embeddings: {result['embedding_requests']}")
+        return
+
+    with tempfile.TemporaryDirectory(prefix="rag_benchmark_") as work_dir:
+        if args.docs:
+            docs_path, qa = args.docs, load_qa(args.qa)
+        else:
+            docs_path = os.path.join(work_dir, "documents")
+            qa = generate_corpus(docs_path, files=args.synthetic_files)
+
+        if args.webhook_workers:
+            results = run_webhook_benchmark(
+                docs_path, qa, work_dir, workers=[int(n) for n in args.webhook_workers.split(',')],
+                users=max(int(n) for n in args.concurrency.split(',')),
+                questions_per_user=args.questions_per_user, chat_latency=args.chat_latency,
+                token_latency=args.token_latency, embedding_provider=args.embeddings
+            )
+            for workers, level in results['webhook'].items():
+                print(f"{workers:>4} проц.: {level['questions_per_second']:.1f} вопросов/с, "
+                      f"{level['questions']} ответов за {level['seconds']:.1f} с, ошибок {level['errors']}")
+            if args.output:
+                with open(args.output, 'w', encoding='utf-8') as f:
+                    json.dump(results, f, ensure_ascii=False, indent=2)
+            return
+
+        results = run_benchmark(
+            docs_path, qa, work_dir,
+            concurrency=[int(n) for n in args.concurrency.split(',')],
+            questions_per_user=args.questions_per_user, top_k=args.k, index_type=args.index_type,
+            retrieval_mode=args.mode, embedding_latency=args.embedding_latency,
+            chat_latency=args.chat_latency, token_latency=args.token_latency,
+            embedding_provider=args.embeddings, embedding_dim=args.embedding_dim,
+            query_batch_window=args.batch_window_ms / 1000
+        )
+
+    ingest = results['ingest']
+    print(f"\nЗагрузка: {ingest['files']} файлов, {ingest['chunks']} частей за {ingest['seconds']:.2f} с "
+          f"({ingest['chunks_per_second']:.0f} частей/с), индекс {ingest['index_bytes'] / 2 ** 20:.1f} МБ")
+    for mode, result in results['retrieval'].items():
+        print(f"{mode:>8}: recall@{result['k']}={result['recall_at_k']:.3f} mrr={result['mrr']:.3f} "
+              f"p50={result['latency_ms_p50']:.2f} мс")
+    for users, level in results['concurrency'].items():
+        print(f"{users:>4} польз.: {level['questions_per_second']:.1f} вопросов/с, "
+              f"p50={level['latency_ms']['p50']:.0f} мс p95={level['latency_ms']['p95']:.0f} мс, "
+              f"ttft p50={level['ttft_ms']['p50']:.0f} мс, запросов embeddings {level['embedding_requests']}, "
+              f"ошибок {level['errors']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print("\nИзменения относительно прошлого запуска:")
+        for line in compare_results(results, baseline):
+            print(f"  {line}")
+
+if __name__ == "__main__":
+    main()
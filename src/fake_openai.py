@@ -0,0 +1,191 @@
+import hashlib
+import json
+import random
+import threading
+import time
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from src.lexical_index import tokenize
+
+def fake_embedding(text: str, dimension: int = 1536) -> List[float]:
+    """Детерминированный embedding текста
+
+    Термы текста хэшируются в координаты вектора, поэтому тексты с общими
+    словами близки и на имитации можно измерять качество поиска.
+    """
+    vector = np.zeros(dimension, dtype=np.float32)
+    for term in tokenize(text):
+        digest = hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest()
+        value = int.from_bytes(digest, 'little')
+        vector[value % dimension] += 1.0 if value >> 63 else -1.0
+
+    if not vector.any():
+        # текст без термов: случайный, но воспроизводимый вектор
+        seed = int(hashlib.sha256(text.encode('utf-8')).hexdigest()[:16], 16)
+        vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+
+    return (vector / np.linalg.norm(vector)).tolist()
+
+def fake_answer(messages: List[Dict], words: int = 40) -> str:
+    """Детерминированный ответ: начало контекста последнего сообщения пользователя"""
+    content = next((m['content'] for m in reversed(messages) if m.get('role') == 'user'), '')
+    context = content.split('КОНТЕКСТ:', 1)[-1].split('ВОПРОС:', 1)[0]
+    return " ".join(["Ответ:"] + context.split()[:words])
+
+class FakeOpenAIServer:
+    """Локальная имитация OpenAI API для тестов и бенчмарков
+
+    Отвечает на POST /v1/embeddings и /v1/chat/completions (в том числе
+    потоково) с заданной задержкой и с заданной вероятностью возвращает 429,
+    чтобы проверять повторы и ограничение скорости. chat_latency — задержка
+    до первого токена ответа, token_latency — между словами ответа.
+    Клиент подключается через base_url:
+
+        server = FakeOpenAIServer(latency=0.05, rate_limit_probability=0.1).start()
+        client = openai.OpenAI(api_key="test", base_url=server.base_url)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, rate_limit_probability=0.0,
+                 dimension=1536, seed=0, chat_latency=0.0, token_latency=0.0, answer_words=40):
+        self.latency = latency
+        self.chat_latency = chat_latency
+        self.token_latency = token_latency
+        self.answer_words = answer_words
+        self.rate_limit_probability = rate_limit_probability
+        self.dimension = dimension
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.embedding_requests = 0
+        self.rate_limited = 0
+        self.max_in_flight = 0
+        self.in_flight = 0
+
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        """Запускает сервер в фоновом потоке"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Останавливает сервер"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                server._handle(self, payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _handle(self, handler, payload):
+        with self.lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            limited = self.random.random() < self.rate_limit_probability
+
+        try:
+            path = handler.path.rstrip('/')
+            chat = path.endswith('/chat/completions')
+            time.sleep(self.chat_latency if chat else self.latency)
+
+            if limited:
+                with self.lock:
+                    self.rate_limited += 1
+                self._send(handler, 429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                           headers={'Retry-After': '0.05'})
+                return
+
+            if path.endswith('/embeddings'):
+                with self.lock:
+                    self.embedding_requests += 1
+                self._send(handler, 200, self._embeddings_response(payload))
+            elif chat and payload.get('stream'):
+                self._stream_chat(handler, payload)
+            elif chat:
+                self._send(handler, 200, self._chat_response(payload))
+            else:
+                self._send(handler, 404, {'error': {'message': f'Unknown path {handler.path}'}})
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def _embeddings_response(self, payload):
+        texts = payload.get('input', [])
+        if isinstance(texts, str):
+            texts = [texts]
+
+        return {
+            'object': 'list',
+            'data': [
+                {'object': 'embedding', 'index': i, 'embedding': fake_embedding(text, self.dimension)}
+                for i, text in enumerate(texts)
+            ],
+            'model': payload.get('model', ''),
+            'usage': {'prompt_tokens': 0, 'total_tokens': 0}
+        }
+
+    def _chat_response(self, payload):
+        answer = fake_answer(payload.get('messages', []), self.answer_words)
+        time.sleep(self.token_latency * len(answer.split()))
+
+        return {
+            'id': 'chatcmpl-fake',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model', ''),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+        }
+
+    def _stream_chat(self, handler, payload):
+        """Отдает ответ по словам в формате server-sent events"""
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'text/event-stream')
+        handler.end_headers()
+
+        words = fake_answer(payload.get('messages', []), self.answer_words).split()
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.token_latency)
+            chunk = {
+                'id': 'chatcmpl-fake',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': payload.get('model', ''),
+                'choices': [{'index': 0, 'delta': {'content': word if i == 0 else ' ' + word}, 'finish_reason': None}]
+            }
+            handler.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            handler.wfile.flush()
+
+        handler.wfile.write(b"data: [DONE]\n\n")
+        handler.wfile.flush()
+
+    def _send(self, handler, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        handler.wfile.write(data)
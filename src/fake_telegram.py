@@ -0,0 +1,185 @@
+import itertools
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qsl
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'RAG', 'username': 'rag_test_bot'}
+
+def make_update(update_id: int, user_id: int, text: str = None, chat_id: int = None, document: Dict = None) -> Dict:
+    """Обновление Telegram с сообщением пользователя в личном чате или группе chat_id"""
+    chat_id = chat_id or user_id
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private' if chat_id == user_id else 'group'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            # по этой разметке PTB узнает команды
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    if document is not None:
+        message['document'] = document
+    return {'update_id': update_id, 'message': message}
+
+def send_updates(url: str, updates: List[Dict], secret: str = None, concurrency: int = 16) -> List[int]:
+    """Отправляет обновления на webhook, как это делает Telegram; возвращает коды ответов"""
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+
+    def post(update):
+        request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(post, updates))
+
+class FakeTelegramServer:
+    """Локальная имитация Bot API для тестов режима webhook
+
+    Отвечает на методы, которыми пользуется бот (getMe, sendMessage,
+    editMessageText, getFile, setWebhook, setMyCommands и другие), и
+    запоминает отправленные сообщения. Ответ считается законченным, когда
+    сообщение отредактировано без курсора потоковой генерации «▌».
+    Бот подключается через TELEGRAM_API_URL=server.base_url:
+
+        server = FakeTelegramServer().start()
+        server.wait_for_answers(10, timeout=60)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Condition()
+        self.message_ids = itertools.count(1000000)
+        self.calls = {}     # метод -> число вызовов
+        self.messages = {}  # (chat_id, message_id) -> текст
+        self.answers = []   # (chat_id, текст) законченных ответов
+        self.files = {}     # file_id -> содержимое
+        self.webhook = None
+
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+        self.thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """Запускает сервер в фоновом потоке"""
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Останавливает сервер"""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_file(self, file_id: str, content: bytes):
+        """Файл, который бот сможет скачать через getFile"""
+        self.files[file_id] = content
+
+    def wait_for_answers(self, count: int, timeout: float = 60.0) -> bool:
+        """Ждет, пока бот закончит count ответов"""
+        with self.lock:
+            return self.lock.wait_for(lambda: len(self.answers) >= count, timeout)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._handle(self, {})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length).decode('utf-8')
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or '{}')
+                else:
+                    params = dict(parse_qsl(body))
+                server._handle(self, params)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _handle(self, handler, params: Dict):
+        # /bot<token>/<метод> или /file/bot<token>/<путь файла>
+        parts = handler.path.split('?')[0].strip('/').split('/')
+        if parts[0] == 'file':
+            content = self.files.get(parts[-1])
+            if content is None:
+                self._send(handler, 404, b'')
+            else:
+                self._send(handler, 200, content, 'application/octet-stream')
+            return
+
+        time.sleep(self.latency)
+        method = parts[-1]
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+
+        result = self._call(method, params)
+        if result is None:
+            body = {'ok': False, 'error_code': 400, 'description': f'Bad Request: unknown method {method}'}
+        else:
+            body = {'ok': True, 'result': result}
+        self._send(handler, 200, json.dumps(body).encode('utf-8'), 'application/json')
+
+    def _call(self, method: str, params: Dict):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendMessage':
+            return self._message(int(params['chat_id']), next(self.message_ids), params.get('text', ''))
+        if method == 'editMessageText':
+            return self._message(int(params['chat_id']), int(params['message_id']), params.get('text', ''))
+        if method == 'getFile':
+            file_id = params.get('file_id')
+            content = self.files.get(file_id, b'')
+            return {'file_id': file_id, 'file_unique_id': file_id, 'file_size': len(content), 'file_path': file_id}
+        if method == 'setWebhook':
+            self.webhook = params.get('url')
+            return True
+        if method in ('deleteWebhook', 'setMyCommands', 'sendChatAction'):
+            return True
+        return None
+
+    def _message(self, chat_id: int, message_id: int, text: str) -> Dict:
+        with self.lock:
+            edited = (chat_id, message_id) in self.messages
+            self.messages[chat_id, message_id] = text
+            # ответ на вопрос закончен, когда последняя правка без курсора генерации
+            if edited and not text.endswith('▌'):
+                self.answers.append((chat_id, text))
+                self.lock.notify_all()
+
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': text,
+        }
+
+    def _send(self, handler, status, data: bytes, content_type: str = 'application/json'):
+        handler.send_response(status)
+        handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
@@ -0,0 +1,152 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+class MemoryHistoryStore:
+    """История чатов в памяти с вытеснением давно не активных пользователей
+
+    Хранится не больше max_users историй; история, к которой не обращались
+    дольше ttl секунд, считается устаревшей.
+    """
+
+    def __init__(self, max_users: int = 10000, ttl: float = 3600):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.items = OrderedDict()  # user_id -> (сообщения, время последнего обращения)
+
+    def get(self, user_id: int) -> Optional[List[Dict]]:
+        with self.lock:
+            item = self.items.get(user_id)
+            if item is None:
+                return None
+
+            messages, last_used = item
+            now = time.time()
+            if now - last_used > self.ttl:
+                del self.items[user_id]
+                return None
+
+            self.items[user_id] = (messages, now)
+            self.items.move_to_end(user_id)
+            return list(messages)
+
+    def put(self, user_id: int, messages: List[Dict]):
+        with self.lock:
+            self.items[user_id] = (list(messages), time.time())
+            self.items.move_to_end(user_id)
+            while len(self.items) > self.max_users:
+                self.items.popitem(last=False)
+
+    def delete(self, user_id: int):
+        with self.lock:
+            self.items.pop(user_id, None)
+
+    def count(self) -> int:
+        return len(self.items)
+
+class SQLiteHistoryStore:
+    """История чатов в SQLite, сохраняется между перезапусками
+
+    Истории пользователей, не писавших дольше ttl секунд, удаляются при запуске.
+    """
+
+    def __init__(self, path="data/chat_history.db", ttl: float = 30 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "user_id INTEGER PRIMARY KEY, messages TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self.conn.commit()
+        self.purge_expired()
+
+    def get(self, user_id: int) -> Optional[List[Dict]]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT messages, updated FROM history WHERE user_id = ?", (user_id,)
+            ).fetchone()
+
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, user_id: int, messages: List[Dict]):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO history (user_id, messages, updated) VALUES (?, ?, ?)",
+                (user_id, json.dumps(messages, ensure_ascii=False), time.time())
+            )
+            self.conn.commit()
+
+    def delete(self, user_id: int):
+        with self.lock:
+            self.conn.execute("DELETE FROM history WHERE user_id = ?", (user_id,))
+            self.conn.commit()
+
+    def purge_expired(self):
+        """Удаляет устаревшие истории"""
+        with self.lock:
+            self.conn.execute("DELETE FROM history WHERE updated < ?", (time.time() - self.ttl,))
+            self.conn.commit()
+
+    def count(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class ChatHistoryStore:
+    """История чатов: активные пользователи в памяти, все остальные в SQLite
+
+    Запись идет в оба уровня сразу, чтение — из памяти, а при промахе
+    история поднимается из SQLite. Хранятся последние max_messages сообщений.
+    """
+
+    def __init__(self, path="data/chat_history.db", max_messages: int = 10, max_users_in_memory: int = 10000,
+                 memory_ttl: float = 3600, ttl: float = 30 * 24 * 3600):
+        self.max_messages = max_messages
+        self.memory = MemoryHistoryStore(max_users=max_users_in_memory, ttl=memory_ttl)
+        self.persistent = SQLiteHistoryStore(path, ttl=ttl)
+
+    def get(self, user_id: int) -> List[Dict]:
+        """Возвращает историю пользователя или пустой список"""
+        messages = self.memory.get(user_id)
+        if messages is not None:
+            return messages
+
+        messages = self.persistent.get(user_id)
+        if messages is None:
+            return []
+
+        self.memory.put(user_id, messages)
+        return messages
+
+    def append(self, user_id: int, messages: List[Dict]):
+        """Добавляет сообщения в историю, оставляя последние max_messages"""
+        history = (self.get(user_id) + messages)[-self.max_messages:]
+        self.memory.put(user_id, history)
+        self.persistent.put(user_id, history)
+
+    def clear(self, user_id: int):
+        """Удаляет историю пользователя"""
+        self.memory.delete(user_id)
+        self.persistent.delete(user_id)
+
+    def stats(self) -> Dict:
+        return {
+            'memory': self.memory.count(),
+            'memory_limit': self.memory.max_users,
+            'persistent': self.persistent.count()
+        }
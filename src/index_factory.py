@@ -0,0 +1,245 @@
+import argparse
+import json
+import math
+import os
+import time
+import faiss
+import numpy as np
+from typing import Dict, List
+
+# поддерживаемые типы индекса
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw', 'sq8')
+
+DEFAULT_PARAMS = {
+    'nlist': None,  # число кластеров IVF, по умолчанию 4 * sqrt(N)
+    'pq_m': None,  # число подвекторов PQ, по умолчанию наибольший делитель размерности не больше 64
+    'pq_bits': 8,
+    'hnsw_m': 32,
+    'ef_construction': 200,
+}
+
+def create_index(index_type: str, dimension: int, params: Dict = None, training_vectors: np.ndarray = None):
+    """Создает индекс с поддержкой id и метрикой inner product
+
+    IVF-индексы и SQ8 требуют обучения, поэтому для них нужны training_vectors.
+    """
+    check_params(index_type, dimension, params)
+    params = {**DEFAULT_PARAMS, **(params or {})}
+    metric = faiss.METRIC_INNER_PRODUCT
+
+    if index_type == 'flat':
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, params['hnsw_m'], metric)
+        index.hnsw.efConstruction = params['ef_construction']
+        return faiss.IndexIDMap2(index)
+
+    if training_vectors is None or len(training_vectors) == 0:
+        raise ValueError(f"Для индекса {index_type} нужны векторы для обучения")
+
+    if index_type == 'sq8':
+        index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_8bit, metric)
+        index.train(training_vectors)
+        return faiss.IndexIDMap2(index)
+
+    # IVF хранит id сам, обертка IndexIDMap2 не нужна
+    nlist = params['nlist'] or _default_nlist(len(training_vectors))
+    quantizer = faiss.IndexFlatIP(dimension)
+
+    if index_type == 'ivf_flat':
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, metric)
+    else:
+        pq_m = params['pq_m'] or _default_pq_m(dimension)
+        index = faiss.IndexIVFPQ(quantizer, dimension, nlist, pq_m, params['pq_bits'], metric)
+
+    index.train(training_vectors)
+    # прямое отображение id -> позиция нужно для reconstruct после удалений
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+def check_params(index_type: str, dimension: int, params: Dict = None):
+    """Проверяет параметры индекса до обучения, чтобы ошибка не всплыла посреди перестроения"""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Неизвестный тип индекса: {index_type}. Доступны: {', '.join(INDEX_TYPES)}")
+
+    pq_m = (params or {}).get('pq_m')
+    if index_type == 'ivf_pq' and pq_m and dimension % pq_m:
+        raise ValueError(f"pq_m={pq_m} не делит размерность {dimension}; "
+                         f"подойдет, например, pq_m={_default_pq_m(dimension, pq_m)}")
+
+def _default_pq_m(dimension: int, limit: int = 64) -> int:
+    """Наибольший делитель размерности не больше limit"""
+    return max(m for m in range(1, min(limit, dimension) + 1) if dimension % m == 0)
+
+def _default_nlist(n: int) -> int:
+    """Число кластеров IVF: около 4 * sqrt(N), но не меньше 39 точек на кластер"""
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+def set_search_params(index, nprobe: int = None, ef_search: int = None):
+    """Задает nprobe для IVF и efSearch для HNSW, если индекс их поддерживает"""
+    space = faiss.ParameterSpace()
+
+    if nprobe is not None and faiss.try_extract_index_ivf(index) is not None:
+        space.set_index_parameter(index, 'nprobe', nprobe)
+
+    if ef_search is not None and _hnsw(index) is not None:
+        space.set_index_parameter(index, 'efSearch', ef_search)
+
+def _hnsw(index):
+    """Возвращает вложенный HNSW-индекс или None"""
+    if isinstance(index, faiss.IndexIDMap2):
+        index = faiss.downcast_index(index.index)
+    return index if isinstance(index, faiss.IndexHNSW) else None
+
+def supports_remove(index) -> bool:
+    """Поддерживает ли индекс удаление векторов по id"""
+    return _hnsw(index) is None
+
+def reconstruct(index, ids: np.ndarray) -> np.ndarray:
+    """Восстанавливает векторы по id одним вызовом (для PQ и SQ8 — приближенно)"""
+    if len(ids) == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_batch(np.ascontiguousarray(ids, dtype=np.int64))
+
+def stored_ids(index) -> np.ndarray:
+    """Id всех векторов индекса: из id_map обертки или из списков IVF"""
+    if isinstance(index, faiss.IndexIDMap2):
+        return faiss.vector_to_array(index.id_map)
+
+    ivf = faiss.extract_index_ivf(index)
+    invlists = ivf.invlists
+    ids = [faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+           for l in range(ivf.nlist) if invlists.list_size(l)]
+    return np.concatenate(ids) if ids else np.zeros(0, dtype=np.int64)
+
+def index_memory(index) -> int:
+    """Размер индекса в байтах при сериализации"""
+    return int(faiss.serialize_index(index).size)
+
+def estimate_memory(index) -> int:
+    """Примерный объем памяти индекса в байтах без сериализации"""
+    per_vector = 0
+    if isinstance(index, faiss.IndexIDMap2):
+        per_vector += 24  # id и обратная таблица id -> позиция
+        index = faiss.downcast_index(index.index)
+
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # коды и id в списках, плюс таблица прямого доступа для remove_ids
+        per_vector += ivf.code_size + 8 + 24
+        return index.ntotal * per_vector + ivf.nlist * ivf.d * 4
+
+    hnsw = _hnsw(index)
+    if hnsw is not None:
+        # связи HNSW в среднем около 2 * M соседей на вектор
+        per_vector += hnsw.storage.sa_code_size() + hnsw.hnsw.nb_neighbors(0) * 4
+        return index.ntotal * per_vector
+
+    return index.ntotal * (per_vector + index.sa_code_size())
+
+def benchmark_index(vectors: np.ndarray, queries: np.ndarray, index_type: str, k: int = 10,
+                    params: Dict = None, nprobe: int = None, ef_search: int = None) -> Dict:
+    """Сравнивает индекс с точным поиском: recall@k, задержка и память"""
+    ids = np.arange(len(vectors), dtype=np.int64)
+
+    exact = create_index('flat', vectors.shape[1])
+    exact.add_with_ids(vectors, ids)
+    _, truth = exact.search(queries, k)
+
+    start = time.perf_counter()
+    index = create_index(index_type, vectors.shape[1], params, training_vectors=vectors)
+    index.add_with_ids(vectors, ids)
+    build_time = time.perf_counter() - start
+    set_search_params(index, nprobe, ef_search)
+
+    latencies = []
+    found = np.zeros_like(truth)
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        _, indices = index.search(queries[i:i + 1], k)
+        latencies.append(time.perf_counter() - start)
+        found[i] = indices[0]
+
+    hits = sum(len(set(truth[i]) & set(found[i])) for i in range(len(queries)))
+    latencies = np.array(latencies) * 1000
+
+    return {
+        'index_type': index_type,
+        'recall_at_k': hits / truth.size,
+        'k': k,
+        'latency_ms_p50': float(np.percentile(latencies, 50)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        'build_time_s': build_time,
+        'memory_bytes': index_memory(index),
+    }
+
+def stored_index_path(store_path: str) -> str:
+    """Файл индекса действующего поколения хранилища или прежний store_path/faiss.index"""
+    current_file = os.path.join(store_path, "CURRENT")
+    if os.path.exists(current_file):
+        with open(current_file, 'r', encoding='utf-8') as f:
+            return os.path.join(store_path, "generations", f.read().strip(), "faiss.index")
+    return os.path.join(store_path, "faiss.index")
+
+def load_stored_vectors(store_path: str):
+    """Id и векторы сохраненного хранилища вместе с дополнительным индексом delta.index"""
+    index_file = stored_index_path(store_path)
+    index = faiss.read_index(index_file)
+    ids = stored_ids(index)
+    vectors = reconstruct(index, ids)
+
+    # delta.index учитывается так же, как при загрузке хранилища: по манифесту и без id от next_id
+    manifest_file = os.path.join(os.path.dirname(index_file), "manifest.json")
+    delta_file = os.path.join(os.path.dirname(index_file), "delta.index")
+    if os.path.exists(manifest_file) and os.path.exists(delta_file):
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('index', {}).get('delta'):
+            delta = faiss.read_index(delta_file)
+            delta.remove_ids(faiss.IDSelectorRange(manifest['next_id'], 2 ** 62))
+            ids = np.concatenate([ids, faiss.vector_to_array(delta.id_map)])
+            vectors = np.vstack([vectors, faiss.downcast_index(delta.index).reconstruct_n(0, delta.ntotal)])
+    return ids, vectors
+
+def main(argv: List[str] = None):
+    """Сравнивает типы индекса на векторах сохраненного хранилища"""
+    parser = argparse.ArgumentParser(description="Сравнение типов FAISS-индекса с точным поиском")
+    parser.add_argument('--store', default='data/vectors', help="папка хранилища")
+    parser.add_argument('--types', default=','.join(INDEX_TYPES))
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--nprobe', type=int, default=16)
+    parser.add_argument('--ef-search', type=int, default=64)
+    args = parser.parse_args(argv)
+
+    index_file = stored_index_path(args.store)
+    if not os.path.exists(index_file):
+        print(f"Индекс не найден: {index_file}, сначала выполни /reload")
+        return
+    _, vectors = load_stored_vectors(args.store)
+    if not len(vectors):
+        print("Хранилище пусто")
+        return
+
+    # запросы — зашумленные векторы корпуса
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+    queries = queries + rng.normal(0, 0.01, queries.shape).astype(np.float32)
+    faiss.normalize_L2(queries)
+
+    print(f"Векторов: {len(vectors)}, запросов: {len(queries)}, k={args.k}")
+    for index_type in args.types.split(','):
+        try:
+            result = benchmark_index(vectors, queries, index_type, args.k,
+                                     nprobe=args.nprobe, ef_search=args.ef_search)
+        except (ValueError, RuntimeError) as e:
+            print(f"{index_type:>8}: ошибка: {e}")
+            continue
+
+        print(f"{index_type:>8}: recall@{args.k}={result['recall_at_k']:.3f} "
+              f"p50={result['latency_ms_p50']:.3f} мс p95={result['latency_ms_p95']:.3f} мс "
+              f"память={result['memory_bytes'] / 1024 / 1024:.1f} МБ")
+
+if __name__ == "__main__":
+    main()
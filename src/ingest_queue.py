@@ -0,0 +1,128 @@
+import asyncio
+import time
+from typing import Awaitable, Callable, Dict, Tuple
+from src.document_processor import IngestProgress
+from src.metrics import metrics
+
+class IngestJob:
+    """Загруженный пользователем файл, ожидающий индексации
+
+    download(docs_path) скачивает файл в папку документов коллекции и
+    возвращает путь, notify(text, final) показывает пользователю состояние.
+    """
+
+    def __init__(self, user_id: int, collection: str, filename: str,
+                 download: Callable[[str], Awaitable[str]], notify: Callable[..., Awaitable[None]]):
+        self.user_id = user_id
+        self.collection = collection
+        self.filename = filename
+        self.download = download
+        self.notify = notify
+        self.progress = IngestProgress()
+        self.created = time.perf_counter()
+
+class IngestQueue:
+    """Очередь фоновой индексации загруженных файлов
+
+    Очередь ограничена max_pending заданиями, у одного пользователя не больше
+    per_user заданий в очереди и в работе; лишние отклоняются сразу, а не
+    копятся в памяти. Файлы обрабатывают workers задач, каждая добавляет файл
+    в индекс коллекции через RAGSystem.ingest_file и раз в progress_interval
+    секунд сообщает, сколько частей обработано.
+    """
+
+    def __init__(self, rag, max_pending: int = 100, per_user: int = 3, workers: int = 1,
+                 progress_interval: float = 2.0):
+        self.rag = rag
+        self.max_pending = max_pending
+        self.per_user = per_user
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.queue = None  # asyncio.Queue, создается в start внутри цикла событий
+        self.pending = {}  # user_id -> число заданий в очереди и в работе
+        self.tasks = []
+
+    def start(self):
+        """Запускает обработчики очереди, вызывается из работающего цикла событий"""
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Останавливает обработчики, не дожидаясь оставшихся заданий"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def submit(self, job: IngestJob) -> Tuple[bool, str]:
+        """Ставит файл в очередь; возвращает (принят ли, сообщение для пользователя)"""
+        if self.pending.get(job.user_id, 0) >= self.per_user:
+            metrics.inc("rag_uploads_total", outcome="user_limit")
+            return False, f"У тебя уже {self.per_user} файла в обработке, дождись их загрузки"
+
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            metrics.inc("rag_uploads_total", outcome="queue_full")
+            return False, "Очередь загрузки заполнена, попробуй позже"
+
+        self.pending[job.user_id] = self.pending.get(job.user_id, 0) + 1
+        return True, f"Файл {job.filename} в очереди, позиция {self.queue.qsize()}"
+
+    def stats(self) -> Dict:
+        return {
+            'queued': self.queue.qsize() if self.queue else 0,
+            'max_pending': self.max_pending,
+            'in_progress': sum(self.pending.values()) - (self.queue.qsize() if self.queue else 0)
+        }
+
+    async def _worker(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self._process(job)
+            except Exception as e:
+                print(f"Ошибка загрузки {job.filename}: {e}")
+                metrics.inc("rag_uploads_total", outcome="error")
+                await self._notify(job, f"❌ Ошибка загрузки {job.filename}: {e}", final=True)
+            finally:
+                self.pending[job.user_id] -= 1
+                if not self.pending[job.user_id]:
+                    del self.pending[job.user_id]
+                self.queue.task_done()
+
+    async def _process(self, job: IngestJob):
+        docs_path = self.rag.collections.paths(job.collection)[0]
+        await self._notify(job, f"⬇️ Скачиваю {job.filename}...")
+        with metrics.timer("rag_upload_stage_seconds", stage="download"):
+            await job.download(docs_path)
+
+        await self._notify(job, f"⚙️ Обрабатываю {job.filename}...")
+        ingest = asyncio.create_task(self.rag.ingest_file(job.collection, job.filename, job.progress))
+        while True:
+            done, _ = await asyncio.wait({ingest}, timeout=self.progress_interval)
+            if done:
+                break
+            await self._notify(job, f"⚙️ Обрабатываю {job.filename}: {self._describe(job.progress)}")
+
+        success, message = ingest.result()
+        metrics.inc("rag_uploads_total", outcome="ok" if success else "failed")
+        metrics.observe("rag_upload_stage_seconds", time.perf_counter() - job.created, stage="total")
+        await self._notify(job, f"✅ {message}" if success else f"❌ {message}", final=True)
+
+    def _describe(self, progress: IngestProgress) -> str:
+        """Ход обработки: сколько частей получили embeddings и попали в индекс"""
+        chunks = progress.counts.get("разбиение")
+        if chunks is None:
+            return "извлекаю текст"
+        return (
+            f"частей {chunks}, embeddings {progress.counts.get('embeddings', 0)}/{chunks}, "
+            f"в индексе {progress.counts.get('индекс', 0)}/{chunks}"
+        )
+
+    async def _notify(self, job: IngestJob, text: str, final: bool = False):
+        # ошибка показа состояния не должна прерывать загрузку
+        try:
+            await job.notify(text, final)
+        except Exception as e:
+            print(f"Не удалось обновить состояние загрузки: {e}")
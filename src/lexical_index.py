@@ -0,0 +1,257 @@
+import functools
+import math
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+from src.metrics import metrics
+
+# слова и идентификаторы вида "123-фз", "ст.15", "gpt-4"
+TOKEN_RE = re.compile(r"[0-9a-zа-я]+(?:[-./][0-9a-zа-я]+)*")
+
+STOP_WORDS = {
+    'и', 'в', 'во', 'не', 'что', 'он', 'на', 'я', 'с', 'со', 'как', 'а', 'то', 'все', 'она', 'так',
+    'его', 'но', 'да', 'ты', 'к', 'у', 'же', 'вы', 'за', 'бы', 'по', 'только', 'ее', 'мне', 'было',
+    'вот', 'от', 'меня', 'еще', 'нет', 'о', 'из', 'ему', 'теперь', 'когда', 'даже', 'ну', 'ли',
+    'если', 'уже', 'или', 'ни', 'быть', 'был', 'него', 'до', 'вас', 'нибудь', 'опять', 'уж', 'вам',
+    'ведь', 'там', 'потом', 'себя', 'ничего', 'ей', 'может', 'они', 'тут', 'где', 'есть', 'надо',
+    'ней', 'для', 'мы', 'тебя', 'их', 'чем', 'была', 'сам', 'чтоб', 'без', 'будто', 'чего', 'раз',
+    'тоже', 'себе', 'под', 'будет', 'ж', 'тогда', 'кто', 'этот', 'того', 'потому', 'этого', 'какой',
+    'совсем', 'ним', 'здесь', 'этом', 'один', 'почти', 'мой', 'тем', 'чтобы', 'нее', 'были', 'куда',
+    'зачем', 'всех', 'никогда', 'можно', 'при', 'наконец', 'два', 'об', 'другой', 'хоть', 'после',
+    'над', 'больше', 'тот', 'через', 'эти', 'нас', 'про', 'всего', 'них', 'какая', 'много', 'разве',
+    'три', 'эту', 'моя', 'впрочем', 'хорошо', 'свою', 'этой', 'перед', 'иногда', 'лучше', 'чуть',
+    'том', 'нельзя', 'такой', 'им', 'более', 'всегда', 'конечно', 'всю', 'между', 'это',
+    'the', 'a', 'an', 'of', 'to', 'in', 'and', 'or', 'is', 'are', 'for', 'on', 'with',
+}
+
+# окончания русских слов, от длинных к коротким
+RUSSIAN_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ией', 'иях', 'ях', 'ах', 'ов', 'ев', 'ей', 'ий', 'ый', 'ой', 'ая', 'яя',
+    'ое', 'ее', 'ые', 'ие', 'ого', 'его', 'ому', 'ему', 'ым', 'им', 'ом', 'ем', 'ую', 'юю', 'ых',
+    'их', 'ия', 'ью', 'ья', 'ьи', 'ье', 'ть', 'ться', 'тся', 'ешь', 'ет', 'ете', 'ут', 'ют', 'ишь',
+    'ит', 'ите', 'ат', 'ят', 'ал', 'ял', 'ала', 'яла', 'али', 'яли', 'ило', 'ила', 'или',
+    'ость', 'ости', 'остью', 'ение', 'ения', 'ению', 'ением', 'ании', 'ание', 'ания',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+], key=len, reverse=True)
+
+@functools.lru_cache(maxsize=200000)  # словарь корпуса невелик, а окончания перебираются долго
+def _stem(word: str) -> str:
+    """Отрезает окончание русского слова, оставляя основу не короче трех букв"""
+    if len(word) <= 4 or not ('а' <= word[0] <= 'я'):
+        return word
+
+    for ending in RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+def tokenize(text: str) -> List[str]:
+    """Разбивает текст на термы: нижний регистр, е вместо ё, основы русских слов
+
+    Составные идентификаторы дают и целый терм, и его части,
+    поэтому "123-ФЗ" находится и по "123-фз", и по "123".
+    """
+    tokens = []
+    for match in TOKEN_RE.findall(text.lower().replace('ё', 'е')):
+        if match in STOP_WORDS:
+            continue
+
+        parts = re.split(r"[-./]", match)
+        if len(parts) > 1:
+            tokens.append(match)
+            tokens.extend(_stem(part) for part in parts if part and part not in STOP_WORDS)
+        else:
+            tokens.append(_stem(match))
+    return tokens
+
+class LexicalIndex:
+    """Инвертированный индекс BM25 в SQLite, обновляемый вместе с FAISS-индексом
+
+    Поиск читает базу через соединение своего потока, без общей блокировки,
+    поэтому одновременные запросы не ждут друг друга. Термы, которые есть
+    больше чем в max_df доле частей большого корпуса, почти не влияют на
+    ранжирование, но их списки длиннее всех: такие термы досчитываются
+    только для max_candidates лучших частей, найденных по более редким
+    термам запроса.
+    """
+
+    def __init__(self, path="data/vectors/lexical.db", k1: float = 1.5, b: float = 0.75,
+                 max_df: float = 0.5, min_docs_to_prune: int = 1000, max_candidates: int = 1000):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.max_df = max_df
+        self.min_docs_to_prune = min_docs_to_prune  # маленький корпус дешево читать целиком
+        self.max_candidates = max_candidates  # частые термы досчитываются только для лучших частей
+        self.lock = threading.Lock()
+        self.local = threading.local()  # соединение для чтения в каждом потоке
+        self.readers = []
+
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "term TEXT NOT NULL, doc_id INTEGER NOT NULL, tf INTEGER NOT NULL, "
+            "PRIMARY KEY (term, doc_id)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS doc_terms (doc_id INTEGER PRIMARY KEY, length INTEGER NOT NULL)")
+        # число частей с термом: по нему считается idf и отбрасываются частые термы
+        self.conn.execute("CREATE TABLE IF NOT EXISTS term_df (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID")
+        if self.conn.execute("SELECT 1 FROM postings LIMIT 1").fetchone() and \
+                not self.conn.execute("SELECT 1 FROM term_df LIMIT 1").fetchone():
+            # индекс, созданный до появления term_df
+            self.conn.execute("INSERT INTO term_df (term, df) SELECT term, COUNT(*) FROM postings GROUP BY term")
+        self.conn.commit()
+        self.reload_stats()
+
+    def reload_stats(self):
+        """Перечитывает число документов и суммарную длину, если базу дополнил другой процесс"""
+        # они нужны для каждого запроса, поэтому хранятся в памяти
+        with self.lock:
+            self.doc_count, self.total_length = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(length), 0) FROM doc_terms"
+            ).fetchone()
+
+    def add(self, items: Iterable[Tuple[int, str]]):
+        """Индексирует тексты (id, текст)"""
+        postings, lengths = [], []
+        for doc_id, text in items:
+            terms = tokenize(text)
+            lengths.append((int(doc_id), len(terms)))
+            postings.extend((term, int(doc_id), tf) for term, tf in Counter(terms).items())
+
+        with self.lock:
+            # заменяемые части сначала удаляются, чтобы df их термов не посчитался дважды
+            self._remove([doc_id for doc_id, _ in lengths])
+            self.conn.executemany("INSERT INTO postings (term, doc_id, tf) VALUES (?, ?, ?)", postings)
+            self.conn.executemany("INSERT INTO doc_terms (doc_id, length) VALUES (?, ?)", lengths)
+            self.conn.executemany(
+                "INSERT INTO term_df (term, df) VALUES (?, ?) ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+                Counter(term for term, _, _ in postings).items()
+            )
+            self.conn.commit()
+            self.doc_count += len(lengths)
+            self.total_length += sum(length for _, length in lengths)
+
+    def remove(self, ids: List[int]):
+        """Удаляет документы из индекса"""
+        with self.lock:
+            self._remove([int(doc_id) for doc_id in ids])
+            self.conn.commit()
+
+    def _remove(self, ids: List[int]):
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            removed_count, removed_length = self.conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM doc_terms WHERE doc_id IN ({placeholders})", batch
+            ).fetchone()
+            if not removed_count:
+                continue
+            self.conn.execute(f"DELETE FROM doc_terms WHERE doc_id IN ({placeholders})", batch)
+            terms = self.conn.execute(
+                f"DELETE FROM postings WHERE doc_id IN ({placeholders}) RETURNING term", batch
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE term_df SET df = df - ? WHERE term = ?",
+                [(count, term) for term, count in Counter(term for term, in terms).items()]
+            )
+            self.conn.execute("DELETE FROM term_df WHERE df <= 0")
+            self.doc_count -= removed_count
+            self.total_length -= removed_length
+
+    def _reader(self) -> sqlite3.Connection:
+        """Соединение для чтения текущего потока"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.local.conn = conn
+            with self.lock:
+                self.readers.append(conn)
+        return conn
+
+    def search(self, query: str, top_k: int = 5) -> List[Dict]:
+        """Ищет документы по BM25
+
+        Возвращает [{'id', 'score', 'coverage', 'max_score', 'terms'}]: coverage — доля
+        термов запроса в документе, max_score — предельный BM25 для запроса,
+        terms — число термов запроса.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        with self.lock:
+            doc_count, avg_length = self.doc_count, self.total_length / max(self.doc_count, 1)
+        if not terms or not doc_count:
+            return []
+
+        with metrics.timer("rag_search_seconds", stage="bm25"):
+            reader = self._reader()
+            placeholders = ",".join("?" * len(terms))
+            df = dict(reader.execute(f"SELECT term, df FROM term_df WHERE term IN ({placeholders})", terms))
+            idf = {term: math.log(1 + (doc_count - n + 0.5) / (n + 0.5)) for term, n in df.items()}
+            present = sorted(df, key=df.get)  # от редких термов к частым
+
+            # списки частых термов читаются только для лучших частей, найденных по редким
+            full = present
+            if doc_count >= self.min_docs_to_prune:
+                full = [term for term in present if df[term] <= self.max_df * doc_count] or present[:1]
+            scores, matched = {}, {}
+            self._score(self._postings(reader, full), idf, avg_length, scores, matched)
+            common = present[len(full):]
+            if common and scores:
+                candidates = sorted(scores, key=scores.get, reverse=True)[:self.max_candidates]
+                self._score(self._postings(reader, common, candidates), idf, avg_length, scores, matched)
+
+        max_score = sum(idf.get(term, 0.0) for term in terms) * (self.k1 + 1)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+        return [
+            {'id': doc_id, 'score': score, 'coverage': matched[doc_id] / len(terms),
+             'max_score': max_score, 'terms': len(terms)}
+            for doc_id, score in best
+        ]
+
+    def _score(self, rows: List[Tuple], idf: Dict[str, float], avg_length: float, scores: Dict, matched: Dict):
+        """Добавляет вклад строк постингов в баллы частей"""
+        for term, doc_id, tf, length in rows:
+            norm = tf + self.k1 * (1 - self.b + self.b * length / avg_length)
+            scores[doc_id] = scores.get(doc_id, 0.0) + idf[term] * tf * (self.k1 + 1) / norm
+            matched[doc_id] = matched.get(doc_id, 0) + 1
+
+    def _postings(self, reader: sqlite3.Connection, terms: List[str], doc_ids: List[int] = None) -> List[Tuple]:
+        """Строки (терм, id, tf, длина части) для термов, при doc_ids — только для этих частей"""
+        if not terms:
+            return []
+
+        query = (
+            "SELECT p.term, p.doc_id, p.tf, d.length FROM postings p "
+            f"JOIN doc_terms d ON d.doc_id = p.doc_id WHERE p.term IN ({','.join('?' * len(terms))})"
+        )
+        if doc_ids is None:
+            return reader.execute(query, terms).fetchall()
+
+        rows = []
+        for i in range(0, len(doc_ids), 500):
+            batch = doc_ids[i:i + 500]
+            rows += reader.execute(f"{query} AND p.doc_id IN ({','.join('?' * len(batch))})", terms + batch).fetchall()
+        return rows
+
+    def count(self) -> int:
+        return self.doc_count
+
+    def clear(self):
+        """Удаляет все документы"""
+        with self.lock:
+            self.conn.execute("DELETE FROM postings")
+            self.conn.execute("DELETE FROM doc_terms")
+            self.conn.execute("DELETE FROM term_df")
+            self.conn.commit()
+            self.doc_count, self.total_length = 0, 0
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+            for conn in self.readers:
+                conn.close()
+            self.readers = []
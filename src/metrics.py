@@ -0,0 +1,193 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+# границы корзин гистограмм в секундах: от быстрых локальных этапов до запросов к API
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class _Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Счетчики и гистограммы времени этапов в формате Prometheus
+
+    Пока реестр выключен, observe/inc/timer ничего не делают, поэтому
+    инструментирование почти ничего не стоит. Значения, которые дешевле
+    прочитать в момент запроса (размер индекса, попадания в кэши), отдают
+    функции-сборщики из add_collector.
+    """
+
+    def __init__(self, enabled: bool = False, buckets=DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}    # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> _Histogram
+        self.help = {}
+        self.collectors = []  # функции, возвращающие [(имя, метки, значение)]
+        self.server = None
+
+    def describe(self, name: str, text: str):
+        """Задает описание метрики для HELP"""
+        self.help[name] = text
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Увеличивает счетчик"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        """Добавляет значение в гистограмму"""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = _Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Измеряет время блока и добавляет его в гистограмму"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def add_collector(self, collector: Callable[[], List[Tuple[str, Dict, float]]]):
+        """Регистрирует функцию, значения которой читаются при каждом запросе метрик"""
+        self.collectors.append(collector)
+
+    def _collect(self) -> List[Tuple[str, Dict, float]]:
+        gauges = []
+        for collector in self.collectors:
+            try:
+                gauges.extend(collector())
+            except Exception as e:
+                print(f"Ошибка сбора метрик: {e}")
+        return gauges
+
+    def render(self) -> str:
+        """Метрики в текстовом формате Prometheus"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {
+                key: (list(h.counts), h.sum, h.count) for key, h in self.histograms.items()
+            }
+
+        lines, described = [], set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+        for (name, labels), (counts, total, count) in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', repr(bound)),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+
+        for name, labels, value in sorted(self._collect(), key=lambda item: item[0]):
+            header(name, "gauge")
+            lines.append(f"{name}{_labels(tuple(sorted(labels.items())))} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """Краткая сводка для человека: средние по гистограммам, счетчики и показатели"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (h.sum, h.count) for key, h in self.histograms.items()}
+
+        lines = []
+        for (name, labels), (total, count) in sorted(histograms.items()):
+            lines.append(f"{name}{_labels(labels)}: {count} шт., среднее {total / count * 1000:.1f} мс")
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"{name}{_labels(labels)}: {value:g}")
+        for name, labels, value in self._collect():
+            lines.append(f"{name}{_labels(tuple(sorted(labels.items())))}: {value:g}")
+        return lines
+
+    def start_http_server(self, port: int, host: str = "127.0.0.1"):
+        """Запускает HTTP-сервер с метриками на /metrics в фоновом потоке"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                data = registry.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"Метрики доступны на http://{host}:{self.server.server_address[1]}/metrics")
+        return self.server
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+# общий реестр процесса, включается в bot.py
+metrics = MetricsRegistry()
+
+metrics.describe("rag_question_stage_seconds", "Время этапов ответа на вопрос")
+metrics.describe("rag_questions_total", "Вопросы по результату")
+metrics.describe("rag_ttft_seconds", "Время до первого токена ответа")
+metrics.describe("rag_reload_seconds", "Время перезагрузки документов")
+metrics.describe("rag_ingest_stage_seconds", "Время этапов загрузки на файл или пачку частей")
+metrics.describe("rag_ingest_items_total", "Обработанные при загрузке элементы по этапам")
+metrics.describe("rag_search_seconds", "Время поиска по индексу")
+metrics.describe("rag_openai_requests_total", "Запросы к OpenAI API")
+metrics.describe("rag_openai_request_seconds", "Время запросов к OpenAI API")
+metrics.describe("rag_openai_retries_total", "Повторы запросов к OpenAI API")
+metrics.describe("rag_openai_tokens_total", "Токены, отправленные и полученные через OpenAI API")
+metrics.describe("rag_query_batches_total", "Пачки одновременных вопросов по операциям")
+metrics.describe("rag_query_batch_items_total", "Вопросы в пачках; среднее на пачку — отношение к rag_query_batches_total")
+metrics.describe("rag_local_embedding_seconds", "Время локального расчета embeddings на пачку текстов")
+metrics.describe("rag_uploads_total", "Загруженные через Telegram файлы по результату")
+metrics.describe("rag_upload_stage_seconds", "Время скачивания и полной обработки загруженного файла")
@@ -0,0 +1,74 @@
+import asyncio
+import functools
+from typing import Any, Callable, Hashable, List
+from src.metrics import metrics
+
+class QueryCoalescer:
+    """Объединяет одновременные запросы в пачки
+
+    Запросы с одинаковым ключом, пришедшие в течение window секунд,
+    выполняются одним вызовом run_batch(key, items) в пуле потоков, и каждый
+    вызывающий получает свой элемент результата. Пачка уходит раньше, если
+    набралось max_batch запросов. window задает, сколько задержки можно
+    добавить одиночному запросу ради более крупных пачек; при window=0
+    запросы выполняются сразу по одному.
+    """
+
+    def __init__(self, run_batch: Callable[[Hashable, List], List], executor, window: float = 0.005,
+                 max_batch: int = 32, name: str = "query"):
+        self.run_batch = run_batch
+        self.executor = executor
+        self.window = window
+        self.max_batch = max_batch
+        self.name = name
+        self.pending = {}  # ключ -> [(элемент, future)]
+        self.timers = {}   # ключ -> отложенная отправка пачки
+        self.tasks = set()
+
+    async def submit(self, key: Hashable, item) -> Any:
+        """Добавляет запрос в пачку и ждет его результата"""
+        loop = asyncio.get_running_loop()
+        if self.window <= 0:
+            return (await self._execute(key, [item]))[0]
+
+        future = loop.create_future()
+        batch = self.pending.setdefault(key, [])
+        batch.append((item, future))
+
+        if len(batch) >= self.max_batch:
+            self._flush(key)
+        elif len(batch) == 1:
+            self.timers[key] = loop.call_later(self.window, self._flush, key)
+
+        return await future
+
+    def _flush(self, key: Hashable):
+        timer = self.timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        batch = self.pending.pop(key, None)
+        if batch:
+            task = asyncio.ensure_future(self._run(key, batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, key: Hashable, batch: List):
+        try:
+            results = await self._execute(key, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # вызывающий мог перестать ждать, например при отмене обработки сообщения
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _execute(self, key: Hashable, items: List) -> List:
+        metrics.inc("rag_query_batches_total", operation=self.name)
+        metrics.inc("rag_query_batch_items_total", len(items), operation=self.name)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(self.run_batch, key, items))
@@ -1,95 +1,565 @@
+import asyncio
+import functools
+import time
+import numpy as np
 import openai
-from src.document_processor import DocProcessor
-from src.vector_store import FAISSVectorStore
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from src.document_processor import IngestProgress
+from src.collection_manager import CollectionManager, Collection, DEFAULT_COLLECTION
+from src.embeddings import create_provider
+from src.query_batcher import QueryCoalescer
+from src.context_builder import ContextAssembler
+from src.history_store import ChatHistoryStore
+from src.lexical_index import tokenize
+from src.metrics import metrics
+from src.tokens import count_tokens
+from collections import deque
+from typing import AsyncIterator, Dict, List, Tuple
 
 class RAGSystem:
-    def __init__(self, openai_api_key: str):
+    def __init__(self, openai_api_key: str, max_concurrency: int = 32, max_workers: int = 8,
+                 index_type: str = "flat", retrieval_mode: str = "hybrid", context_tokens: int = 2500,
+                 retrieval_top_k: int = 8, history_memory_users: int = 10000, history_ttl: float = 30 * 24 * 3600,
+                 docs_path: str = "data/documents", store_path: str = "data/vectors",
+                 history_path: str = "data/chat_history.db", base_url: str = None,
+                 index_mmap: bool = False, verify_index: bool = False,
+                 collections_path: str = "data/collections", collections_memory: int = 1024 * 1024 * 1024,
+                 collections_max_loaded: int = 32,
+                 ingest_workers: int = 1, embedding_provider: str = "openai", embedding_dim: int = None,
+                 query_batch_window: float = 0.005, query_batch_size: int = 32, index_read_only: bool = False):
         openai.api_key = openai_api_key
+        self.openai_api_key = openai_api_key
+        self.base_url = base_url  # другой адрес API, например локальная имитация для бенчмарков
+        self._client = None
         
-        self.doc_processor = DocProcessor()
-        self.vector_store = FAISSVectorStore()
-        self.chat_history = {}  # история чатов по user_id
+        embedding_client = openai.OpenAI(api_key=openai_api_key, base_url=base_url) if base_url else None
+        # embeddings через API или локально; модель и размерность записываются в манифест индекса
+        self.embedder = create_provider(embedding_provider, embedding_dim, client=embedding_client)
+        # у каждой коллекции свои документы, индекс и кэш ответов
+        self.collections = CollectionManager(
+            collections_path, memory_budget=collections_memory, max_loaded=collections_max_loaded,
+            default_docs_path=docs_path, default_store_path=store_path, embedder=self.embedder,
+            index_type=index_type, mmap=index_mmap, verify_checksums=verify_index, read_only=index_read_only
+        )
+        # коллекция по умолчанию не выгружается
+        self.default_collection = self.collections.acquire(DEFAULT_COLLECTION)
+        # история чатов по user_id: активные пользователи в памяти, остальные в SQLite
+        self.chat_history = ChatHistoryStore(
+            history_path, max_users_in_memory=history_memory_users, ttl=history_ttl
+        )
+        self.retrieval_mode = retrieval_mode  # "vector" или "hybrid"
+        # частей ищется больше, чем помещается в контекст: лишние отсекает бюджет токенов
+        self.retrieval_top_k = retrieval_top_k
+        self.context_assembler = ContextAssembler(token_budget=context_tokens)
+        self.ttft = deque(maxlen=1000)  # время до первого токена последних ответов, секунды
+        self.last_ingest = None  # IngestProgress последней загрузки
+        
+        # FAISS, извлечение текста и синхронные вызовы API выполняются в пуле потоков,
+        # чтобы не блокировать цикл событий бота
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # загруженные через Telegram файлы обрабатываются в отдельном пуле и не занимают потоки вопросов
+        self.ingest_executor = ThreadPoolExecutor(max_workers=ingest_workers)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.reload_locks = {}  # имя коллекции -> asyncio.Lock
+        # вызываются с именем коллекции, когда этот процесс сменил ее поколение индекса или
+        # дописал в него файлы, например чтобы процессы только для чтения перешли на новое
+        self.generation_listeners = []
+        # одновременные вопросы к одной коллекции получают embeddings одним запросом
+        # и ищутся одним многострочным поиском FAISS
+        self.query_embedder = QueryCoalescer(
+            self._embed_batch, self.executor, query_batch_window, query_batch_size, name="embed"
+        )
+        self.query_searcher = QueryCoalescer(
+            self._search_batch, self.executor, query_batch_window, query_batch_size, name="search"
+        )
+    
+    @property
+    def vector_store(self):
+        """Хранилище коллекции по умолчанию"""
+        return self.default_collection.vector_store
+    
+    @property
+    def doc_processor(self):
+        return self.default_collection.doc_processor
+    
+    @property
+    def answer_cache(self):
+        return self.default_collection.answer_cache
+    
+    @property
+    def client(self) -> openai.AsyncOpenAI:
+        """Асинхронный клиент OpenAI, создается при первом обращении"""
+        if self._client is None:
+            self._client = openai.AsyncOpenAI(api_key=self.openai_api_key, base_url=self.base_url)
+        return self._client
+    
+    async def _run_in_executor(self, func, *args, **kwargs):
+        """Выполняет блокирующую функцию в пуле потоков"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+    
+    async def _acquire(self, name: str) -> Collection:
+        """Занимает коллекцию, загрузка с диска идет в пуле потоков"""
+        return await self._run_in_executor(self.collections.acquire, name)
+    
+    def _embed_batch(self, vector_store, questions: List[str]) -> List[np.ndarray]:
+        """Embeddings пачки вопросов, по строке (1, dimension) на вопрос"""
+        vectors = vector_store.embed_queries(questions)
+        return [vectors[i:i + 1] for i in range(len(questions))]
+    
+    def _search_batch(self, key, items: List[Tuple[str, np.ndarray, List[Dict]]]) -> List[List[Dict]]:
+        """Поиск по пачке вопросов [(вопрос, embedding, кандидаты BM25 или None)]"""
+        vector_store, mode, top_k = key
+        questions = [question for question, _, _ in items]
+        vectors = np.vstack([vector for _, vector, _ in items])
+        if mode == "hybrid":
+            return vector_store.hybrid_search_many(
+                questions, top_k, vectors, lexical_candidates=[hits for _, _, hits in items]
+            )
+        return vector_store.search_many(questions, top_k, vectors)
     
-    def reload_documents(self):
-        """Перезагружает документы"""
+    def _reload_lock(self, name: str) -> asyncio.Lock:
+        return self.reload_locks.setdefault(name, asyncio.Lock())
+    
+    def _generation_changed(self, collection_name: str):
+        for listener in self.generation_listeners:
+            try:
+                listener(collection_name)
+            except Exception as e:
+                print(f"Ошибка уведомления о новом поколении {collection_name}: {e}")
+    
+    async def refresh_collection(self, collection: str) -> bool:
+        """Переходит на новое поколение индекса или файлы, добавленные другим процессом
+        
+        Коллекция, которой нет в памяти, прочитает новое поколение при загрузке.
+        """
+        for item in self.collections.loaded_collections():
+            if item.name == collection:
+                refreshed = await self._run_in_executor(item.vector_store.refresh)
+                if refreshed:
+                    item.answer_cache.clear()
+                return refreshed
+        return False
+    
+    async def reload_documents(self, collection: str = DEFAULT_COLLECTION):
+        """Перезагружает документы коллекции, не блокируя обработку вопросов"""
+        async with self._reload_lock(collection):
+            with metrics.timer("rag_reload_seconds"):
+                return await self._run_in_executor(self._reload_documents_sync, collection)
+    
+    def reload_documents_sync(self, collection: str = DEFAULT_COLLECTION):
+        """Перезагружает документы коллекции без цикла событий, например из утилит
+        
+        Возвращает (успех, сообщение). Не вызывается одновременно с
+        reload_documents той же коллекции.
+        """
+        with metrics.timer("rag_reload_seconds"):
+            return self._reload_documents_sync(collection)
+    
+    def _reload_documents_sync(self, collection_name: str = DEFAULT_COLLECTION):
+        """Перезагружает документы, переиндексируя только новые и измененные файлы
+        
+        Изменения вносятся в новое поколение хранилища, пока старое отвечает
+        на вопросы; при ошибке новое поколение отбрасывается.
+        """
+        try:
+            collection = self.collections.acquire(collection_name)
+        except Exception as e:
+            return False, f"Ошибка загрузки: {str(e)}"
+        
+        vector_store, doc_processor = collection.vector_store, collection.doc_processor
+        not_found = f"Документы не найдены в папке {doc_processor.docs_path}/"
         try:
-            # очищаем старый индекс
-            self.vector_store.clear()
+            # сравниваем папку с манифестом индекса
+            manifest = vector_store.manifest
+            chunking = doc_processor.chunking
+            rebuild = not vector_store.embeddings_match()
+            if rebuild:
+                # векторы другой модели несовместимы: индекс строится заново
+                print(f"Источник embeddings изменен: {vector_store.embedding_info} -> {vector_store.embedder.metadata()}")
+                manifest = {}
+            elif manifest and vector_store.chunking != chunking:
+                # при новых параметрах разбиения переиндексируются все файлы
+                print(f"Параметры разбиения изменены: {vector_store.chunking} -> {chunking}")
+                manifest = {name: {**entry, 'hash': None, 'mtime': None} for name, entry in manifest.items()}
+            
+            changed, touched, deleted = doc_processor.diff_documents(manifest)
             
-            # загружаем документы
-            docs = self.doc_processor.load_all_documents()
+            if not changed and not deleted and not rebuild:
+                if touched:
+                    vector_store.update_files(touched)
+                
+                if not vector_store.count():
+                    return False, not_found
+                
+                return True, f"Изменений нет, в индексе {vector_store.count()} частей документов"
             
-            if not docs:
-                return False, "Документы не найдены в папке data/documents/"
+            staged = vector_store.begin_update()
+            try:
+                # удаляем старые части измененных и удаленных файлов
+                if rebuild:
+                    staged.reset()
+                else:
+                    staged.remove_sources(deleted + list(changed))
+                
+                # извлекаем только новые и измененные документы и добавляем их
+                # в новое поколение по мере готовности
+                progress = IngestProgress()
+                self.last_ingest = progress
+                docs = doc_processor.iter_documents(list(changed), progress)
+                added = staged.add_documents_stream(docs, {**changed, **touched}, progress=progress)
+                staged.set_chunking(chunking)
+            except BaseException:
+                vector_store.abort_update(staged)
+                raise
             
-            # добавляем в векторное хранилище
-            self.vector_store.add_documents(docs)
+            vector_store.commit_update(staged)
+            print(f"Загрузка завершена ({collection_name}): {progress.report()}")
+            self._generation_changed(collection_name)
             
-            return True, f"Загружено {len(docs)} частей документов"
+            # ответы по старым документам больше не годятся
+            collection.answer_cache.clear()
+            
+            if not vector_store.count():
+                return False, not_found
+            
+            return True, (
+                f"Загружено {added} частей документов "
+                f"(новых и измененных файлов: {len(changed)}, удалено: {len(deleted)})"
+            )
             
         except Exception as e:
             return False, f"Ошибка загрузки: {str(e)}"
+        finally:
+            self.collections.release(collection)
     
-    def ask_question(self, user_id: int, question: str) -> Dict:
-        """Отвечает на вопрос пользователя"""
+    async def ingest_file(self, collection: str, filename: str, progress: IngestProgress = None):
+        """Добавляет в индекс коллекции один файл из ее папки документов, без полной перезагрузки"""
+        async with self._reload_lock(collection):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                self.ingest_executor,
+                functools.partial(self._ingest_file_sync, collection, filename, progress or IngestProgress())
+            )
+    
+    def _ingest_file_sync(self, collection_name: str, filename: str, progress: IngestProgress):
+        """Индексирует один файл
+        
+        Извлекаются и отправляются в API только части этого файла. Новый файл
+        дописывается в текущее поколение хранилища, а прежние части файла с тем
+        же именем заменяются в новом поколении. Возвращает (успех, сообщение).
+        """
         try:
-            # поиск релевантных документов
-            relevant_docs = self.vector_store.search(question, top_k=3)
+            collection = self.collections.acquire(collection_name)
+        except Exception as e:
+            return False, f"Ошибка загрузки: {str(e)}"
+        
+        vector_store, doc_processor = collection.vector_store, collection.doc_processor
+        try:
+            if not vector_store.embeddings_match():
+                return False, "Индекс построен другой моделью embeddings, сначала выполни /reload"
             
-            if not relevant_docs:
-                return {
-                    'answer': 'К сожалению, я не нашел релевантной информации в документах.',
-                    'sources': [],
-                    'success': False
-                }
+            info = doc_processor.file_info(filename)
+            entry = vector_store.manifest.get(filename)
+            if entry and entry.get('hash') == info['hash']:
+                vector_store.update_files({filename: info})
+                return True, f"Файл {filename} уже есть в индексе ({vector_store.count_source(filename)} частей)"
+            
+            if entry is None and vector_store.can_append():
+                # без копии баз и перезаписи основного индекса: стоимость зависит от файла, а не от корпуса
+                docs = doc_processor.iter_documents([filename], progress)
+                added = vector_store.append_documents(docs, {filename: info}, progress=progress)
+                if not added:
+                    return False, f"Не удалось извлечь текст из {filename}"
+                if not vector_store.chunking:
+                    vector_store.set_chunking(doc_processor.chunking)
+                return self._file_ingested(collection, filename, added, progress)
+            
+            staged = vector_store.begin_update()
+            try:
+                staged.remove_sources([filename])
+                docs = doc_processor.iter_documents([filename], progress)
+                added = staged.add_documents_stream(docs, {filename: info}, progress=progress)
+                if not staged.chunking:
+                    staged.set_chunking(doc_processor.chunking)
+            except BaseException:
+                vector_store.abort_update(staged)
+                raise
+            
+            if not added:
+                # из файла не удалось извлечь текст, индекс не меняем
+                vector_store.abort_update(staged)
+                return False, f"Не удалось извлечь текст из {filename}"
             
-            # собираем контекст
-            context = self._build_context(relevant_docs)
-            sources = self._get_sources(relevant_docs)
+            vector_store.commit_update(staged)
+            return self._file_ingested(collection, filename, added, progress)
             
+        except Exception as e:
+            return False, f"Ошибка загрузки: {str(e)}"
+        finally:
+            self.collections.release(collection)
+    
+    def _file_ingested(self, collection: Collection, filename: str, added: int, progress: IngestProgress):
+        """Сбрасывает кэш ответов и уведомляет читателей после добавления файла"""
+        print(f"Файл {filename} добавлен в {collection.name}: {progress.report()}")
+        collection.answer_cache.clear()
+        self._generation_changed(collection.name)
+        
+        return True, f"Добавлено {added} частей из {filename}, в индексе {collection.vector_store.count()} частей"
+    
+    async def rollback_documents(self, collection: str = DEFAULT_COLLECTION) -> bool:
+        """Возвращает предыдущее поколение индекса коллекции"""
+        async with self._reload_lock(collection):
+            item = await self._acquire(collection)
+            try:
+                rolled_back = await self._run_in_executor(item.vector_store.rollback)
+                if rolled_back:
+                    item.answer_cache.clear()
+                    self._generation_changed(collection)
+                return rolled_back
+            finally:
+                self.collections.release(item)
+    
+    async def count_chunks(self, collection: str = DEFAULT_COLLECTION) -> int:
+        """Число частей документов в коллекции"""
+        item = await self._acquire(collection)
+        try:
+            return item.vector_store.count()
+        finally:
+            self.collections.release(item)
+    
+    async def ask_question(self, user_id: int, question: str, collection: str = DEFAULT_COLLECTION) -> Dict:
+        """Отвечает на вопрос пользователя по документам коллекции"""
+        async with self.semaphore:
+            try:
+                item = await self._acquire(collection)
+            except Exception as e:
+                return self._error(e)
+            try:
+                return await self._ask_question(item, user_id, question)
+            finally:
+                self.collections.release(item)
+    
+    async def _ask_question(self, collection: Collection, user_id: int, question: str) -> Dict:
+        started = time.perf_counter()
+        timings = {}
+        try:
             # получаем историю чата
-            history = self.chat_history.get(user_id, [])
+            history = self.chat_history.get(user_id)
+            
+            relevant_docs, cache_key, cached = await self._retrieve(collection, question, history, timings)
+            if cached:
+                self._update_chat_history(user_id, question, cached['answer'])
+                self._record_question("cached", timings, started)
+                return cached
+            
+            if not relevant_docs:
+                self._record_question("not_found", timings, started)
+                return self._not_found()
+            
+            # собираем контекст, источники берем только из вошедших в него частей
+            stage = time.perf_counter()
+            context, used_docs = self._build_context(relevant_docs)
+            timings['context'] = time.perf_counter() - stage
             
             # генерируем ответ
-            answer = self._generate_answer(question, context, history)
+            stage = time.perf_counter()
+            answer = await self._generate_answer(question, context, history)
+            timings['generate'] = time.perf_counter() - stage
             
-            # обновляем историю
-            self._update_chat_history(user_id, question, answer)
+            result = self._finish_answer(
+                collection, user_id, question, answer, used_docs, relevant_docs, history, cache_key
+            )
+            self._record_question("answered", timings, started)
+            result['timings'] = timings
+            return result
             
-            return {
-                'answer': answer,
-                'sources': sources,
-                'found_docs': len(relevant_docs),
-                'success': True
-            }
+        except Exception as e:
+            self._record_question("error", timings, started)
+            return self._error(e)
+    
+    async def ask_question_stream(self, user_id: int, question: str,
+                                  collection: str = DEFAULT_COLLECTION) -> AsyncIterator[Dict]:
+        """Отвечает на вопрос по мере генерации
+        
+        Отдает события {'delta': текст} с очередными частями ответа и в конце
+        {'result': ...} в том же формате, что и ask_question, с временем до
+        первого токена в 'ttft' и временем этапов в секундах в 'timings'.
+        """
+        async with self.semaphore:
+            try:
+                item = await self._acquire(collection)
+            except Exception as e:
+                yield {'result': self._error(e)}
+                return
+            try:
+                async for event in self._ask_question_stream(item, user_id, question):
+                    yield event
+            finally:
+                self.collections.release(item)
+    
+    async def _ask_question_stream(self, collection: Collection, user_id: int, question: str) -> AsyncIterator[Dict]:
+        started = time.perf_counter()
+        timings = {}
+        try:
+            history = self.chat_history.get(user_id)
+            
+            relevant_docs, cache_key, cached = await self._retrieve(collection, question, history, timings)
+            if cached:
+                cached['ttft'] = time.perf_counter() - started
+                cached['timings'] = timings
+                self._record_ttft(cached['ttft'])
+                self._update_chat_history(user_id, question, cached['answer'])
+                self._record_question("cached", timings, started)
+                yield {'delta': cached['answer']}
+                yield {'result': cached}
+                return
+            
+            if not relevant_docs:
+                self._record_question("not_found", timings, started)
+                yield {'result': self._not_found()}
+                return
+            
+            stage = time.perf_counter()
+            context, used_docs = self._build_context(relevant_docs)
+            timings['context'] = time.perf_counter() - stage
+            
+            stage = time.perf_counter()
+            parts, ttft = [], None
+            async for delta in self._stream_answer(question, context, history):
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                    self._record_ttft(ttft)
+                parts.append(delta)
+                yield {'delta': delta}
+            timings['generate'] = time.perf_counter() - stage
+            
+            result = self._finish_answer(
+                collection, user_id, question, "".join(parts), used_docs, relevant_docs, history, cache_key
+            )
+            self._record_question("answered", timings, started)
+            result['ttft'] = ttft
+            result['timings'] = timings
+            yield {'result': result}
             
         except Exception as e:
-            return {
-                'answer': f'Произошла ошибка: {str(e)}',
-                'sources': [],
-                'success': False
-            }
+            self._record_question("error", timings, started)
+            yield {'result': self._error(e)}
     
-    def _build_context(self, docs: List[Dict]) -> str:
-        """Собирает контекст из найденных документов"""
-        context_parts = []
+    async def _retrieve(self, collection: Collection, question: str, history: List[Dict], timings: Dict = None):
+        """Ищет части документов для вопроса в коллекции
+        
+        Возвращает (найденные части, ключ кэша ответов, ответ из кэша или None).
+        Ключ — {'vector', 'text', 'epoch'}: embedding вопроса или, если ответ
+        найден без него, термы вопроса с id частей, и номер сброса кэша до
+        поиска. В timings записывается время этапов 'lexical', 'embed' и 'search'.
+        """
+        timings = {} if timings is None else timings
+        vector_store = collection.vector_store
+        # ответ по документам, замененным за время генерации, не попадет в кэш
+        cache_key = {'vector': None, 'text': None, 'epoch': collection.answer_cache.epoch}
+        relevant_docs = None
+        lexical_hits = None
         
-        for i, doc in enumerate(docs):
-            score = doc.get('similarity_score', 0)
-            source = doc['source']
-            text = doc['text']
+        # короткие запросы по ключевым словам находятся локально, без запроса embeddings;
+        # иначе найденные кандидаты BM25 используются в гибридном поиске
+        if self.retrieval_mode == "hybrid":
+            stage = time.perf_counter()
+            relevant_docs, lexical_hits = await self._run_in_executor(
+                vector_store.confident_lexical_search, question, top_k=self.retrieval_top_k
+            )
+            timings['lexical'] = time.perf_counter() - stage
+        
+        if relevant_docs is not None:
+            # без embedding ответ кэшируется по термам вопроса и найденным частям
+            cache_key['text'] = (
+                tuple(dict.fromkeys(tokenize(question))),
+                tuple(hit['id'] for hit in lexical_hits[:self.retrieval_top_k])
+            )
+            if not history:
+                cached = collection.answer_cache.get_exact(cache_key['text'])
+                if cached:
+                    cached['cached'] = True
+                    return None, cache_key, cached
+        else:
+            # embedding вопроса нужен и для кэша ответов, и для поиска
+            stage = time.perf_counter()
+            query_vector = await self.query_embedder.submit(vector_store, question)
+            cache_key['vector'] = query_vector
+            timings['embed'] = time.perf_counter() - stage
+            
+            # ответ зависит от истории, поэтому кэш используется только без нее
+            if not history:
+                cached = collection.answer_cache.get(query_vector)
+                if cached:
+                    cached['cached'] = True
+                    return None, cache_key, cached
             
-            context_parts.append(f"Документ {i+1} ({source}, релевантность: {score:.2f}):\n{text}")
+            # поиск релевантных документов
+            stage = time.perf_counter()
+            relevant_docs = await self.query_searcher.submit(
+                (vector_store, self.retrieval_mode, self.retrieval_top_k), (question, query_vector, lexical_hits)
+            )
+            timings['search'] = time.perf_counter() - stage
         
-        return "\n\n---\n\n".join(context_parts)
+        return relevant_docs, cache_key, None
+    
+    def _finish_answer(self, collection: Collection, user_id: int, question: str, answer: str,
+                       used_docs: List[Dict], relevant_docs: List[Dict], history: List[Dict], cache_key: Dict) -> Dict:
+        """Обновляет историю и кэш ответов, собирает результат"""
+        self._update_chat_history(user_id, question, answer)
+        
+        result = {
+            'answer': answer,
+            'sources': self._get_sources(used_docs),
+            'found_docs': len(relevant_docs),
+            'success': True
+        }
+        
+        # сброс кэша во время генерации (перезагрузка, новый файл) отменяет запись
+        if not history and cache_key['vector'] is not None:
+            collection.answer_cache.put(cache_key['vector'], result, epoch=cache_key['epoch'])
+        elif not history and cache_key['text'] is not None:
+            collection.answer_cache.put_exact(cache_key['text'], result, epoch=cache_key['epoch'])
+        
+        return result
+    
+    def _not_found(self) -> Dict:
+        return {
+            'answer': 'К сожалению, я не нашел релевантной информации в документах.',
+            'sources': [],
+            'success': False
+        }
+    
+    def _error(self, e: Exception) -> Dict:
+        return {
+            'answer': f'Произошла ошибка: {str(e)}',
+            'sources': [],
+            'success': False
+        }
+    
+    def _record_ttft(self, seconds: float):
+        """Запоминает время до первого токена ответа"""
+        self.ttft.append(seconds)
+        metrics.observe("rag_ttft_seconds", seconds)
+    
+    def _record_question(self, outcome: str, timings: Dict, started: float):
+        """Дописывает общее время в timings и передает этапы в метрики"""
+        timings['total'] = time.perf_counter() - started
+        metrics.inc("rag_questions_total", outcome=outcome)
+        for stage, seconds in timings.items():
+            metrics.observe("rag_question_stage_seconds", seconds, stage=stage)
+    
+    def _build_context(self, docs: List[Dict]) -> Tuple[str, List[Dict]]:
+        """Собирает контекст из найденных документов в пределах бюджета токенов"""
+        return self.context_assembler.assemble(docs)
     
     def _get_sources(self, docs: List[Dict]) -> List[str]:
         """Извлекает уникальные источники"""
         return list(set([doc['source'] for doc in docs]))
     
-    def _generate_answer(self, question: str, context: str, history: List[Dict]) -> str:
-        """Генерирует ответ через OpenAI"""
+    def _build_messages(self, question: str, context: str, history: List[Dict]) -> List[Dict]:
+        """Собирает сообщения для модели"""
         
         messages = [
             {
@@ -116,37 +586,111 @@ class RAGSystem:
 ВОПРОС: {question}"""
 
         messages.append({"role": "user", "content": user_content})
+        return messages
+    
+    async def _generate_answer(self, question: str, context: str, history: List[Dict]) -> str:
+        """Генерирует ответ через OpenAI"""
+        with metrics.timer("rag_openai_request_seconds", endpoint="chat"):
+            response = await self.client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=self._build_messages(question, context, history),
+                temperature=0.1,
+                max_tokens=500
+            )
+        
+        metrics.inc("rag_openai_requests_total", endpoint="chat", status="ok")
+        if response.usage:
+            metrics.inc("rag_openai_tokens_total", response.usage.prompt_tokens, endpoint="chat", kind="prompt")
+            metrics.inc("rag_openai_tokens_total", response.usage.completion_tokens, endpoint="chat", kind="completion")
         
-        response = openai.chat.completions.create(
+        return response.choices[0].message.content
+    
+    async def _stream_answer(self, question: str, context: str, history: List[Dict]) -> AsyncIterator[str]:
+        """Генерирует ответ через OpenAI, отдавая текст по мере получения"""
+        messages = self._build_messages(question, context, history)
+        start = time.perf_counter()
+        stream = await self.client.chat.completions.create(
             model="gpt-3.5-turbo",
             messages=messages,
             temperature=0.1,
-            max_tokens=500
+            max_tokens=500,
+            stream=True
         )
         
-        return response.choices[0].message.content
+        parts = []
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        
+        metrics.observe("rag_openai_request_seconds", time.perf_counter() - start, endpoint="chat")
+        metrics.inc("rag_openai_requests_total", endpoint="chat", status="ok")
+        if metrics.enabled:
+            # в потоковом ответе API не сообщает расход токенов, считаем локально
+            prompt_tokens = sum(count_tokens(message['content']) for message in messages)
+            metrics.inc("rag_openai_tokens_total", prompt_tokens, endpoint="chat", kind="prompt")
+            metrics.inc("rag_openai_tokens_total", count_tokens("".join(parts)), endpoint="chat", kind="completion")
     
     def _update_chat_history(self, user_id: int, question: str, answer: str):
         """Обновляет историю чата"""
-        if user_id not in self.chat_history:
-            self.chat_history[user_id] = []
-        
-        self.chat_history[user_id].extend([
+        self.chat_history.append(user_id, [
             {"role": "user", "content": question},
             {"role": "assistant", "content": answer}
         ])
-        
-        # ограничиваем историю
-        if len(self.chat_history[user_id]) > 10:
-            self.chat_history[user_id] = self.chat_history[user_id][-10:]
     
-    def get_stats(self) -> Dict:
-        """Возвращает статистику системы"""
-        total_docs = len(self.vector_store.documents)
-        sources = list(set([doc['source'] for doc in self.vector_store.documents]))
+    def clear_history(self, user_id: int):
+        """Очищает историю чата пользователя"""
+        self.chat_history.clear(user_id)
+    
+    async def get_stats(self, collection: str = DEFAULT_COLLECTION) -> Dict:
+        """Возвращает статистику системы и коллекции"""
+        item = await self._acquire(collection)
+        try:
+            total_docs = item.vector_store.count()
+            sources = await self._run_in_executor(item.vector_store.sources)
+            index_memory = item.vector_store.memory()
+        finally:
+            self.collections.release(item)
         
         return {
+            'collection': collection,
             'total_chunks': total_docs,
             'total_sources': len(sources),
-            'sources': sources
+            'sources': sources,
+            'index_memory': index_memory,
+            'collections': self.collections.stats(),
+            'embedding_cache': self.collections.cache.stats(),
+            'answer_cache': item.answer_cache.stats(),
+            'chat_history': self.chat_history.stats(),
+            'ttft_ms_p50': float(np.percentile(self.ttft, 50) * 1000) if self.ttft else None,
+            'ttft_ms_p95': float(np.percentile(self.ttft, 95) * 1000) if self.ttft else None
         }
+    
+    def collect_metrics(self) -> List[Tuple[str, Dict, float]]:
+        """Текущие показатели для экспорта метрик: размер индексов, кэши, история"""
+        embedding_cache = self.collections.cache.stats()
+        collections = self.collections.stats()
+        history = self.chat_history.stats()
+        
+        gauges = [
+            ("rag_collections_loaded", {}, collections['loaded']),
+            ("rag_collections_memory_bytes", {}, collections['memory']),
+            ("rag_cache_entries", {'cache': "embeddings"}, embedding_cache['size']),
+            ("rag_cache_hit_rate", {'cache': "embeddings"}, embedding_cache['hit_rate']),
+            ("rag_chat_history_users", {'tier': "memory"}, history['memory']),
+            ("rag_chat_history_users", {'tier': "sqlite"}, history['persistent']),
+        ]
+        
+        # выгруженные коллекции не загружаются ради метрик
+        for item in self.collections.loaded_collections():
+            vector_store = item.vector_store
+            answer_cache = item.answer_cache.stats()
+            gauges += [
+                ("rag_index_vectors", {'collection': item.name, 'index': vector_store.active_index_type},
+                 vector_store.count()),
+                ("rag_index_sources", {'collection': item.name}, len(vector_store.manifest)),
+                ("rag_cache_entries", {'cache': "answers", 'collection': item.name}, answer_cache['size']),
+                ("rag_cache_hit_rate", {'cache': "answers", 'collection': item.name}, answer_cache['hit_rate']),
+            ]
+        
+        return gauges
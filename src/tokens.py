@@ -0,0 +1,45 @@
+from typing import List
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken необязателен, без него используется грубая оценка
+    tiktoken = None
+
+_encoding = None
+_encoding_failed = False
+
+def _get_encoding():
+    """Возвращает токенизатор cl100k_base, если tiktoken установлен и словарь доступен"""
+    global _encoding, _encoding_failed
+    if _encoding is None and tiktoken is not None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            # словарь скачивается при первом использовании и может быть недоступен офлайн
+            print(f"Токенизатор tiktoken недоступен, использую оценку: {e}")
+            _encoding_failed = True
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    """Считает токены текста локально, без обращения к API"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+
+    # оценка с запасом: русский текст занимает около двух символов на токен
+    return max(1, len(text) // 2)
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    """Считает токены для списка текстов"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
+    return [max(1, len(text) // 2) for text in texts]
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Обрезает текст до max_tokens токенов"""
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    return text[:max_tokens * 2]
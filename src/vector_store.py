@@ -1,114 +1,1048 @@
+import copy
 import faiss
+import hashlib
 import numpy as np
 import json
 import os
-import openai
-from typing import List, Dict
+import shutil
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
+from src.embedding_cache import EmbeddingCache
+from src.embeddings import EmbeddingProvider, OpenAIEmbeddingProvider
+from src.chunk_store import ChunkStore
+from src.lexical_index import LexicalIndex
+from src.metrics import metrics
+from src import index_factory
+
+# состояние одного поколения индекса; при замене поколения меняются вместе
+GENERATION_ATTRS = (
+    'generation', 'index', 'delta', 'chunks', 'lexical', 'manifest', 'next_id', 'active_index_type', 'chunking',
+    'embedding_info', 'index_file_info', 'delta_file_info', 'index_file', 'delta_file', 'docs_file', 'manifest_file',
+)
+
+# индексы без сведений об embeddings построены через OpenAI
+LEGACY_EMBEDDINGS = {'provider': "openai", 'model': "text-embedding-ada-002", 'dimension': 1536}
+
+# версия формата manifest.json; манифест без поля format — версия 1, без контрольных сумм;
+# в версии 2 у файлов были списки id частей, теперь они берутся из chunks.db;
+# с версии 4 новые файлы могут лежать в дополнительном индексе delta.index
+FORMAT_VERSION = 4
+
+# файлы хранилища до появления поколений, лежали прямо в store_path
+LEGACY_FILES = ('faiss.index', 'manifest.json', 'documents.json', 'chunks.db', 'lexical.db')
+
+def _copy_sqlite(source_path: str, target_path: str):
+    """Копирует базу SQLite через backup API, не мешая читателям исходной базы"""
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(target_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+def _file_digest(path: str) -> str:
+    """sha256 файла, читаемого блоками"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _fsync_dir(path: str):
+    """Сохраняет на диск записи каталога: без этого переименование может пропасть при сбое питания"""
+    if os.name == 'nt':  # в Windows каталог нельзя открыть для fsync
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _pid_alive(pid: int) -> bool:
+    """Жив ли процесс pid"""
+    if os.name == 'nt':  # в Windows os.kill завершает процесс, поэтому считаем его живым
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:  # процесс есть, но принадлежит другому пользователю
+        return True
+    return True
+
+def _replace_file(path: str, write):
+    """Записывает файл во временный и атомарно подменяет им path"""
+    tmp_path = path + ".tmp"
+    write(tmp_path)
+    with open(tmp_path, 'rb') as f:
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path) or ".")
 
 class FAISSVectorStore:
-    def __init__(self, store_path="data/vectors"):
+    """Векторное хранилище из поколений
+
+    Поколение — индекс FAISS, части документов, BM25 и манифест в отдельной
+    папке generations/<номер>; файл CURRENT указывает на действующее.
+    Изменения вносятся в копию (begin_update), пока текущее поколение
+    обслуживает поиск, и подменяют его целиком (commit_update). Предыдущее
+    поколение сохраняется для rollback. Кэш embeddings общий для всех поколений.
+    
+    Новые файлы добавляются в текущее поколение без копии (append_documents):
+    их векторы попадают в небольшой точный индекс delta.index, и основной
+    индекс не переписывается. Поиск идет по обоим индексам, а при следующем
+    обновлении через begin_update дополнительный индекс вливается в основной.
+    """
+    
+    def __init__(self, store_path="data/vectors", client=None, cache_size=200000,
+                 embedding_concurrency=4, tokens_per_minute=1000000,
+                 index_type="flat", index_params=None, train_threshold=10000, nprobe=16, ef_search=64,
+                 mmap=False, verify_checksums=False, cache=None, embedder: EmbeddingProvider = None,
+                 read_only=False, max_delta=50000):
         self.store_path = store_path
-        self.dimension = 1536  # размер OpenAI embeddings
+        # кэш и источник embeddings можно разделить между несколькими хранилищами,
+        # тогда лимит запросов к API и кэш у них общие
+        self.embedder = embedder or OpenAIEmbeddingProvider(
+            client, max_concurrency=embedding_concurrency, tokens_per_minute=tokens_per_minute
+        )
+        self.dimension = self.embedder.dimension
+        self.model = self.embedder.model
+        self.embedding_info = self.embedder.metadata()  # чем построен индекс текущего поколения
         self.index = None
-        self.documents = []
-        self.index_file = os.path.join(store_path, "faiss.index")
-        self.docs_file = os.path.join(store_path, "documents.json")
+        self.delta = None  # векторы файлов, добавленных в текущее поколение
+        # больше max_delta векторов не добавляется в delta.index: точный поиск по нему замедлится
+        self.max_delta = max_delta
+        # пока корпус меньше train_threshold, используется точный Flat-индекс
+        self.index_type = index_type
+        self.active_index_type = "flat"
+        self.index_params = index_params or {}
+        # неподходящие параметры лучше отклонить сразу, а не при первом обучении индекса
+        index_factory.check_params(index_type, self.dimension, self.index_params)
+        self.train_threshold = train_threshold
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        # индекс отображается в память только для чтения: запуск не читает файл целиком,
+        # а процессы на одной машине делят страницы в page cache (в faiss 1.7.4 — списки IVF)
+        self.mmap = mmap
+        # полная проверка sha256 индекса при загрузке; размер и число векторов проверяются всегда
+        self.verify_checksums = verify_checksums
+        # хранилище только для чтения: поколения создает и удаляет другой процесс,
+        # а это переходит на новое через refresh
+        self.read_only = read_only
+        self.index_file_info = None  # {size, sha256, vectors} сохраненного файла индекса
+        self.delta_file_info = None  # {size, vectors} delta.index или None, если его нет
+        self.manifest = {}  # имя файла -> {hash, mtime, size}
+        self.chunking = None  # параметры разбиения, с которыми построен индекс
+        self.next_id = 0
+        self.lock = threading.RLock()  # поиск и изменения индекса идут из разных потоков
+        self.generations_path = os.path.join(store_path, "generations")
+        self.current_file = os.path.join(store_path, "CURRENT")
+        
+        os.makedirs(self.generations_path, exist_ok=True)
+        self.cache = cache or EmbeddingCache(os.path.join(store_path, "embeddings_cache.db"), max_entries=cache_size)
+        if not read_only:
+            self._migrate_legacy_layout()
+        
+        generation = self._read_current()
+        if generation is None:
+            # пустое хранилище создается любым процессом: делить пока нечего
+            generation = self._next_generation()
+            self._write_current(generation)
+        
+        try:
+            self._open_generation(generation)
+            self._load_or_create_index()
+        except (ValueError, RuntimeError) as e:
+            # поврежденное поколение заменяем предыдущим, если оно есть
+            older = [name for name in self._generations() if name < generation]
+            if not older:
+                raise
+            print(f"Поколение индекса {generation} повреждено ({e}), загружаю {older[-1]}")
+            self._open_generation(older[-1])
+            self._load_or_create_index()
+            if not read_only:
+                self._write_current(older[-1])
+        
+        if not read_only:
+            self._remove_stale_generations()
+    
+    def _open_generation(self, generation: str):
+        """Открывает файлы поколения"""
+        path = os.path.join(self.generations_path, generation)
+        os.makedirs(path, exist_ok=True)
+        
+        self.generation = generation
+        self.index_file = os.path.join(path, "faiss.index")
+        self.delta_file = os.path.join(path, "delta.index")
+        self.docs_file = os.path.join(path, "documents.json")  # старый формат, переносится в chunks.db
+        self.manifest_file = os.path.join(path, "manifest.json")
+        self.chunks = ChunkStore(os.path.join(path, "chunks.db"))  # faiss id -> часть документа
+        self.lexical = LexicalIndex(os.path.join(path, "lexical.db"))  # BM25 по тем же id
+    
+    def _migrate_legacy_layout(self):
+        """Переносит файлы хранилища без поколений в первое поколение"""
+        if os.path.exists(self.current_file):
+            return
+        
+        # вместе с базами переносятся их журналы -wal и -shm
+        legacy = [name for name in os.listdir(self.store_path) if name.split('-')[0] in LEGACY_FILES]
+        if not legacy:
+            return
+        
+        generation = self._next_generation()
+        path = os.path.join(self.generations_path, generation)
+        os.makedirs(path, exist_ok=True)
+        for name in legacy:
+            os.replace(os.path.join(self.store_path, name), os.path.join(path, name))
+        self._write_current(generation)
+        print(f"Хранилище перенесено в поколение {generation}")
+    
+    def _generations(self) -> List[str]:
+        """Имена поколений на диске по возрастанию"""
+        return sorted(name for name in os.listdir(self.generations_path) if name.isdigit())
+    
+    def _next_generation(self) -> str:
+        generations = self._generations()
+        return f"{int(generations[-1]) + 1 if generations else 1:06d}"
+    
+    def _read_current(self):
+        if not os.path.exists(self.current_file):
+            return None
+        with open(self.current_file, 'r', encoding='utf-8') as f:
+            generation = f.read().strip()
+        return generation if os.path.isdir(os.path.join(self.generations_path, generation)) else None
+    
+    def _write_current(self, generation: str):
+        """Атомарно переключает CURRENT на поколение"""
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(generation)
+        _replace_file(self.current_file, write)
+    
+    def _remove_stale_generations(self, keep: str = None):
+        """Удаляет поколения, кроме текущего и keep
+        
+        Без keep сохраняется ближайшее предыдущее поколение, а недостроенные
+        после сбоя (новее текущего) удаляются. Поколение, которое еще строит
+        живой процесс (файл STAGING с его pid), не удаляется: хранилище
+        могут открыть для записи несколько процессов, например бот и doc_load.py.
+        """
+        generations = self._generations()
+        if keep is None:
+            older = [name for name in generations if name < self.generation]
+            keep = older[-1] if older else None
+        
+        for name in generations:
+            if name not in (self.generation, keep) and not self._staged_by_live_process(name):
+                shutil.rmtree(os.path.join(self.generations_path, name), ignore_errors=True)
+    
+    def _staged_by_live_process(self, generation: str) -> bool:
+        """Строит ли поколение другой работающий процесс"""
+        try:
+            with open(os.path.join(self.generations_path, generation, "STAGING"), 'r', encoding='utf-8') as f:
+                pid = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            return False
+        return pid > 0 and _pid_alive(pid)
+    
+    def begin_update(self) -> "FAISSVectorStore":
+        """Создает новое поколение как копию текущего и возвращает хранилище для изменений
+        
+        Изменения в возвращенном хранилище не видны поиску до commit_update.
+        Одновременно допускается только одно обновление.
+        """
+        if self.read_only:
+            raise RuntimeError("Хранилище открыто только для чтения")
+        
+        with self.lock:
+            state = {attr: getattr(self, attr) for attr in GENERATION_ATTRS}
+        
+        staged = copy.copy(self)
+        staged.lock = threading.RLock()
+        generation = self._next_generation()
+        path = os.path.join(self.generations_path, generation)
+        os.makedirs(path)
+        # владелец недостроенного поколения: другие процессы не удалят его как брошенное
+        with open(os.path.join(path, "STAGING"), 'w', encoding='utf-8') as f:
+            f.write(str(os.getpid()))
+        
+        # базы копируются до открытия, текущее поколение в это время продолжает работать
+        _copy_sqlite(state['chunks'].path, os.path.join(path, "chunks.db"))
+        _copy_sqlite(state['lexical'].path, os.path.join(path, "lexical.db"))
+        staged._open_generation(generation)
+        
+        if self.mmap:
+            # отображенный индекс ссылается на файл, поэтому копия читается с диска целиком
+            staged.index = faiss.read_index(state['index_file'])
+        else:
+            staged.index = faiss.deserialize_index(faiss.serialize_index(state['index']))
+        if state['delta'].ntotal:
+            # новое поколение обходится без дополнительного индекса
+            delta = state['delta']
+            staged.index.add_with_ids(
+                faiss.downcast_index(delta.index).reconstruct_n(0, delta.ntotal), faiss.vector_to_array(delta.id_map)
+            )
+        staged.delta = staged._empty_delta()
+        staged.delta_file_info = None
+        index_factory.set_search_params(staged.index, self.nprobe, self.ef_search)
+        staged.manifest = copy.deepcopy(state['manifest'])
+        staged.next_id = state['next_id']
+        staged.active_index_type = state['active_index_type']
+        staged.chunking = state['chunking']
+        staged.index_file_info = state['index_file_info']
+        return staged
+    
+    def commit_update(self, staged: "FAISSVectorStore"):
+        """Сохраняет новое поколение на диск и атомарно подменяет им текущее"""
+        with staged.lock:
+            staged._save_index()
+        staging_file = os.path.join(self.generations_path, staged.generation, "STAGING")
+        if os.path.exists(staging_file):
+            os.remove(staging_file)
+        # папка нового поколения должна сохраниться раньше, чем на нее укажет CURRENT
+        _fsync_dir(os.path.dirname(staging_file))
+        _fsync_dir(self.generations_path)
+        
+        self._write_current(staged.generation)
+        with self.lock:
+            previous = self.generation
+            for attr in GENERATION_ATTRS:
+                setattr(self, attr, getattr(staged, attr))
+        
+        # соединения старых поколений закроются, когда их перестанут использовать начатые запросы
+        self._remove_stale_generations(keep=previous)
+        print(f"Поколение индекса {previous} заменено на {self.generation}")
+    
+    def refresh(self) -> bool:
+        """Переходит на поколение из CURRENT, если его сменил другой процесс
         
-        os.makedirs(store_path, exist_ok=True)
-        self._load_or_create_index()
+        Возвращает True, если поколение сменилось или в текущее добавлены
+        файлы. Файлы поколения, кроме манифеста и delta.index, не изменяются,
+        поэтому так можно обновлять хранилище только для чтения.
+        """
+        generation = self._read_current()
+        if generation is None:
+            return False
+        if generation == self.generation:
+            return self._refresh_delta()
+        
+        staged = copy.copy(self)
+        staged.lock = threading.RLock()
+        staged._open_generation(generation)
+        staged._load_or_create_index()
+        with self.lock:
+            previous = self.generation
+            for attr in GENERATION_ATTRS:
+                setattr(self, attr, getattr(staged, attr))
+        
+        print(f"Поколение индекса {previous} заменено на {generation} другим процессом")
+        return True
+    
+    def _refresh_delta(self) -> bool:
+        """Перечитывает манифест и delta.index текущего поколения, если другой процесс добавил файлы"""
+        staged = copy.copy(self)
+        try:
+            staged._load_manifest()
+            if staged.next_id == self.next_id:
+                return False
+            staged._load_delta()
+        except (ValueError, RuntimeError, OSError) as e:
+            # манифест и delta.index могли смениться между чтениями, следующий сигнал повторит попытку
+            print(f"Не удалось перечитать добавленные файлы поколения {self.generation}: {e}")
+            return False
+        
+        with self.lock:
+            for attr in ('manifest', 'next_id', 'chunking', 'delta', 'delta_file_info'):
+                setattr(self, attr, getattr(staged, attr))
+        self.lexical.reload_stats()
+        print(f"Поколение индекса {self.generation} дополнено другим процессом: {self.count()} частей")
+        return True
+    
+    def abort_update(self, staged: "FAISSVectorStore"):
+        """Отменяет обновление и удаляет недостроенное поколение"""
+        staged.chunks.close()
+        staged.lexical.close()
+        shutil.rmtree(os.path.join(self.generations_path, staged.generation), ignore_errors=True)
+    
+    def rollback(self) -> bool:
+        """Возвращает предыдущее поколение индекса, если оно сохранилось"""
+        if self.read_only:
+            raise RuntimeError("Хранилище открыто только для чтения")
+        
+        previous = [
+            name for name in self._generations()
+            if name != self.generation and not self._staged_by_live_process(name)
+        ]
+        if not previous:
+            return False
+        
+        staged = copy.copy(self)
+        staged.lock = threading.RLock()
+        staged._open_generation(previous[-1])
+        staged._load_or_create_index()
+        self.commit_update(staged)
+        return True
     
     def _load_or_create_index(self):
         """Загружает существующий индекс или создает новый"""
-        if os.path.exists(self.index_file) and os.path.exists(self.docs_file):
+        if os.path.exists(self.index_file):
             print("Загружаю существующий индекс...")
-            self.index = faiss.read_index(self.index_file)
+            start = time.perf_counter()
             
-            with open(self.docs_file, 'r', encoding='utf-8') as f:
-                self.documents = json.load(f)
-                
-            print(f"Загружено: {len(self.documents)} документов")
+            if os.path.exists(self.docs_file):
+                self.embedding_info = LEGACY_EMBEDDINGS
+                self.index = faiss.read_index(self.index_file)
+                self.delta, self.delta_file_info = self._empty_delta(), None
+                self._migrate_documents_json()
+            else:
+                self._load_manifest()
+                if not self.read_only:
+                    self._drop_unsaved_chunks()
+                self._verify_index_file()
+                flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if self.mmap else 0
+                self.index = faiss.read_index(self.index_file, flags)
+                self._load_delta()
+                self._verify_loaded_index()
+            
+            if not self.embeddings_match():
+                # индекс другой модели не перестраиваем при загрузке: векторный поиск
+                # выключен до /reload, BM25 продолжает работать
+                print(f"Индекс построен embeddings {self.embedding_info}, а выбраны {self.embedder.metadata()}: "
+                      f"нужна перезагрузка документов")
+            else:
+                loaded = self.index
+                self._apply_index_type()
+                if self.index is not loaded and not self.read_only:
+                    self._save_index()
+            
+            if self.lexical.count() != self.count() and not self.read_only:
+                self._rebuild_lexical_index()
+            print(f"Загружено: {self.count()} документов за {time.perf_counter() - start:.2f} с")
         else:
             print("Создаю новый индекс...")
-            self.index = faiss.IndexFlatIP(self.dimension)  # Inner Product для cosine similarity
-            self.documents = []
-    
-    def create_embeddings(self, texts: List[str]) -> List[List[float]]:
-        """Создает embeddings через OpenAI API"""
-        embeddings = []
-        batch_size = 20
-        
-        for i in range(0, len(texts), batch_size):
-            batch = texts[i:i + batch_size]
-            
-            try:
-                response = openai.embeddings.create(
-                    input=batch,
-                    model="text-embedding-ada-002"
-                )
-                
-                for item in response.data:
-                    embeddings.append(item.embedding)
-                    
-                print(f"Создано embeddings: {len(embeddings)}/{len(texts)}")
-                
-            except Exception as e:
-                print(f"Ошибка создания embeddings: {e}")
-                raise
-                
+            self.chunks.clear()
+            self.lexical.clear()
+            self.index = self._create_index()
+            self.delta = self._empty_delta()
+            self.manifest = {}
+            self.next_id = 0
+            self.index_file_info = None
+            self.delta_file_info = None
+            self.embedding_info = self.embedder.metadata()
+    
+    def _verify_index_file(self):
+        """Сверяет файл индекса с заголовком манифеста до чтения"""
+        info = self.index_file_info
+        if info is None:
+            return
+        
+        size = os.path.getsize(self.index_file)
+        if size != info['size']:
+            raise ValueError(f"размер faiss.index {size} не совпадает с манифестом ({info['size']})")
+        # сумма записывается, только если проверка включена при сохранении
+        if self.verify_checksums and info.get('sha256') and _file_digest(self.index_file) != info['sha256']:
+            raise ValueError("контрольная сумма faiss.index не совпадает с манифестом")
+    
+    def _verify_loaded_index(self):
+        """Проверяет, что индекс и части документов относятся к одному сохранению"""
+        if self.index_file_info is not None and self.index.ntotal != self.index_file_info['vectors']:
+            raise ValueError(
+                f"в индексе {self.index.ntotal} векторов, в манифесте {self.index_file_info['vectors']}"
+            )
+        
+        # части с id от next_id пишет добавление, которое еще не сохранило манифест
+        chunk_count = self.chunks.count(below=self.next_id)
+        if chunk_count != self.count():
+            raise ValueError(f"в индексе {self.count()} векторов, частей документов {chunk_count}")
+    
+    def _empty_delta(self):
+        """Пустой дополнительный индекс той же размерности, что и основной"""
+        return index_factory.create_index("flat", self.index.d)
+    
+    def _load_delta(self):
+        """Загружает delta.index текущего поколения, если он есть в манифесте"""
+        info = self.delta_file_info
+        if info is None:
+            self.delta = self._empty_delta()
+            return
+        
+        if not os.path.exists(self.delta_file) or os.path.getsize(self.delta_file) < info['size']:
+            raise ValueError("delta.index не найден или короче, чем в манифесте")
+        delta = faiss.read_index(self.delta_file)
+        # векторы добавления, прерванного до записи манифеста
+        delta.remove_ids(faiss.IDSelectorRange(self.next_id, 2 ** 62))
+        if delta.ntotal != info['vectors']:
+            raise ValueError(f"в delta.index {delta.ntotal} векторов, в манифесте {info['vectors']}")
+        self.delta = delta
+    
+    def _drop_unsaved_chunks(self):
+        """Удаляет части добавления, прерванного до записи манифеста"""
+        ids = self.chunks.ids(start=self.next_id)
+        if ids:
+            print(f"Удаляю {len(ids)} частей незавершенного добавления")
+            self.chunks.delete_ids(ids)
+            self.lexical.remove(ids)
+    
+    def _rebuild_lexical_index(self):
+        """Строит BM25-индекс по сохраненным частям документов"""
+        print("Строю лексический индекс...")
+        self.lexical.clear()
+        for rows in self.chunks.iter_texts():
+            self.lexical.add(rows)
+    
+    def _create_index(self):
+        """Создает пустой Flat-индекс с поддержкой удаления по id"""
+        self.active_index_type = "flat"
+        return index_factory.create_index("flat", self.dimension)  # Inner Product для cosine similarity
+    
+    def _apply_index_type(self):
+        """Приводит загруженный индекс к настроенному типу и задает параметры поиска"""
+        if self.active_index_type not in ("flat", self.index_type):
+            print(f"Тип индекса изменен: {self.active_index_type} -> {self.index_type}")
+            self._rebuild_index("flat")
+        
+        self._maybe_train_index()
+        index_factory.set_search_params(self.index, self.nprobe, self.ef_search)
+    
+    def _maybe_train_index(self):
+        """Переходит на приближенный индекс, когда корпус превысил порог"""
+        if self.active_index_type == self.index_type or self.index.ntotal < self.train_threshold:
+            return
+        
+        print(f"Строю индекс {self.index_type} на {self.index.ntotal} векторах...")
+        self._rebuild_index(self.index_type)
+    
+    def _rebuild_index(self, index_type: str):
+        """Перестраивает индекс заданного типа из текущих векторов, вливая в него дополнительный"""
+        delta_ids = faiss.vector_to_array(self.delta.id_map)
+        ids = np.setdiff1d(np.array(self.chunks.ids(), dtype=np.int64), delta_ids)
+        ids = ids[ids < self.next_id]
+        vectors = index_factory.reconstruct(self.index, ids)
+        if len(delta_ids):
+            ids = np.concatenate([ids, delta_ids])
+            vectors = np.vstack([vectors, faiss.downcast_index(self.delta.index).reconstruct_n(0, self.delta.ntotal)])
+            self.delta = self._empty_delta()
+        
+        if index_type == "flat":
+            index = index_factory.create_index("flat", self.dimension)
+        else:
+            index = index_factory.create_index(index_type, self.dimension, self.index_params, training_vectors=vectors)
+        
+        if len(ids):
+            index.add_with_ids(vectors, ids)
+        
+        index_factory.set_search_params(index, self.nprobe, self.ef_search)
+        self.index = index
+        self.active_index_type = index_type
+    
+    def _load_manifest(self):
+        """Загружает манифест файлов"""
+        self.manifest = {}
+        self.next_id = self.chunks.max_id() + 1
+        self.delta_file_info = None
+        
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            
+            version = data.get('format', 1)
+            if version > FORMAT_VERSION:
+                raise ValueError(f"манифест формата {version} создан более новой версией бота")
+            
+            self.index_file_info = data.get('index', {}).get('file')
+            self.delta_file_info = data.get('index', {}).get('delta')
+            self.manifest = data.get('files', {})
+            for entry in self.manifest.values():
+                entry.pop('ids', None)
+            # части с большими id — от добавления, прерванного до записи манифеста
+            self.next_id = data.get('next_id', self.next_id)
+            self.active_index_type = data.get('index', {}).get('type', "flat")
+            self.chunking = data.get('chunking')
+            self.embedding_info = data.get('embeddings', LEGACY_EMBEDDINGS)
+    
+    def _migrate_documents_json(self):
+        """Переносит документы из documents.json в chunks.db"""
+        print("Обновляю формат хранилища...")
+        with open(self.docs_file, 'r', encoding='utf-8') as f:
+            documents = json.load(f)
+        
+        self.chunks.clear()
+        
+        if isinstance(documents, list):
+            # индекс старого формата без id и манифеста
+            vectors = self.index.reconstruct_n(0, self.index.ntotal)
+            ids = np.arange(len(vectors), dtype=np.int64)
+            
+            self.index = self._create_index()
+            if len(vectors):
+                self.index.add_with_ids(vectors, ids)
+            self.chunks.upsert_many(enumerate(documents[:len(vectors)]))
+            self.next_id = len(vectors)
+            
+            # хэши неизвестны, поэтому при следующем /reload файлы будут переиндексированы
+            self.manifest = {}
+            for doc in documents[:len(vectors)]:
+                self.manifest.setdefault(doc['source'], {'hash': None, 'mtime': None, 'size': None})
+        else:
+            self.chunks.upsert_many((int(doc_id), doc) for doc_id, doc in documents.items())
+            self._load_manifest()
+        
+        self._save_index()
+        os.remove(self.docs_file)
+    
+    def embeddings_match(self) -> bool:
+        """Построен ли индекс текущего поколения выбранным источником embeddings"""
+        return self.embedding_info == self.embedder.metadata()
+    
+    def create_embeddings(self, texts: List[str]) -> np.ndarray:
+        """Создает embeddings выбранным источником, используя дисковый кэш"""
+        if not self.embedder.cacheable:
+            return self.embedder.embed(texts)
+        
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        
+        cached = self.cache.get_many(self.model, texts)
+        missing = []
+        for i, vector in enumerate(cached):
+            if vector is None:
+                missing.append(i)
+            else:
+                embeddings[i] = vector
+        
+        if not missing:
+            return embeddings
+        
+        # одинаковые тексты отправляем в API один раз
+        unique_texts = list(dict.fromkeys(texts[i] for i in missing))
+        new_embeddings = self.embedder.embed(unique_texts)
+        self.cache.put_many(self.model, unique_texts, new_embeddings)
+        
+        by_text = dict(zip(unique_texts, new_embeddings))
+        for i in missing:
+            embeddings[i] = by_text[texts[i]]
+        
         return embeddings
     
-    def add_documents(self, docs: List[Dict]):
-        """Добавляет документы в индекс"""
+    def add_documents(self, docs: List[Dict], files: Dict[str, Dict] = None, save: bool = True, progress=None,
+                      delta: bool = False):
+        """Добавляет документы в индекс
+        
+        files - сведения о файлах для манифеста: имя -> {hash, mtime, size}
+        delta - добавить векторы в дополнительный индекс, не трогая основной
+        """
         if not docs:
+            if files:
+                self.update_files(files)
             return
             
         print("Создаю embeddings для документов...")
+        start = time.perf_counter()
         texts = [doc['text'] for doc in docs]
         embeddings = self.create_embeddings(texts)
         
         # нормализуем для cosine similarity
         embeddings_array = np.array(embeddings, dtype=np.float32)
         faiss.normalize_L2(embeddings_array)
+        if progress:
+            progress.add("embeddings", time.perf_counter() - start, len(docs))
         
-        # добавляем в индекс
-        self.index.add(embeddings_array)
-        self.documents.extend(docs)
-        
-        # сохраняем
-        self._save_index()
+        start = time.perf_counter()
+        with self.lock:
+            for filename, info in (files or {}).items():
+                self._set_file_info(filename, info)
+            
+            # добавляем в индекс
+            ids = np.arange(self.next_id, self.next_id + len(docs), dtype=np.int64)
+            (self.delta if delta else self.index).add_with_ids(embeddings_array, ids)
+            self.next_id += len(docs)
+            
+            self.chunks.upsert_many(zip(ids.tolist(), docs))
+            self.lexical.add(zip(ids.tolist(), texts))
+            for doc in docs:
+                self.manifest.setdefault(doc['source'], {'hash': None, 'mtime': None, 'size': None})
+            
+            # сохраняем
+            if delta:
+                if save:
+                    self._save_delta()
+            else:
+                self._maybe_train_index()
+                if save:
+                    self._save_index()
+        if progress:
+            progress.add("индекс", time.perf_counter() - start, len(docs))
         print(f"Добавлено документов: {len(docs)}")
     
-    def search(self, query: str, top_k: int = 5) -> List[Dict]:
-        """Ищет похожие документы"""
-        if self.index.ntotal == 0:
-            return []
+    def add_documents_stream(self, docs: Iterable[Dict], files: Dict[str, Dict] = None,
+                             batch_size: int = 256, progress=None) -> int:
+        """Добавляет документы из генератора пачками, не держа весь корпус в памяти
+        
+        Манифест и индекс сохраняются один раз в конце, поэтому прерванная
+        загрузка повторится при следующем /reload.
+        """
+        total = 0
+        batch = []
+        
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                self.add_documents(batch, save=False, progress=progress)
+                total += len(batch)
+                batch = []
+        
+        if batch:
+            self.add_documents(batch, save=False, progress=progress)
+            total += len(batch)
+        
+        with self.lock:
+            for filename, info in (files or {}).items():
+                self._set_file_info(filename, info)
+            self._save_index()
+        
+        return total
+    
+    def can_append(self) -> bool:
+        """Можно ли добавлять файлы в текущее поколение через append_documents"""
+        return not self.read_only and self.embeddings_match() and self.delta.ntotal < self.max_delta
+    
+    def append_documents(self, docs: Iterable[Dict], files: Dict[str, Dict], batch_size: int = 256,
+                         progress=None) -> int:
+        """Добавляет части новых файлов в текущее поколение, без копии хранилища
+        
+        Сохраняются только delta.index и манифест, поэтому добавление стоит
+        порядка размера файлов, а не корпуса. Манифест — точка фиксации:
+        части, записанные до сбоя или ошибки, удаляются. Файлы из files не
+        должны быть в индексе. Возвращает число частей; если их нет, индекс
+        не меняется.
+        """
+        with self.lock:
+            first_id = self.next_id
+        total = 0
+        batch = []
+        
+        try:
+            for doc in docs:
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    self.add_documents(batch, save=False, progress=progress, delta=True)
+                    total += len(batch)
+                    batch = []
+            
+            if batch:
+                self.add_documents(batch, save=False, progress=progress, delta=True)
+                total += len(batch)
             
-        # создаем embedding для запроса
-        query_embedding = self.create_embeddings([query])[0]
-        query_vector = np.array([query_embedding], dtype=np.float32)
-        faiss.normalize_L2(query_vector)
+            if total:
+                with self.lock:
+                    for filename, info in files.items():
+                        self._set_file_info(filename, info)
+                    self._save_delta()
+        except BaseException:
+            self._discard_appended(first_id, list(files))
+            raise
         
-        # поиск
-        scores, indices = self.index.search(query_vector, top_k)
+        return total
+    
+    def _discard_appended(self, first_id: int, filenames: List[str]):
+        """Убирает части, добавленные в текущее поколение начиная с first_id"""
+        with self.lock:
+            self.delta.remove_ids(faiss.IDSelectorRange(first_id, 2 ** 62))
+            ids = self.chunks.ids(start=first_id)
+            self.chunks.delete_ids(ids)
+            self.lexical.remove(ids)
+            for filename in filenames:
+                self.manifest.pop(filename, None)
+            self.next_id = first_id
+    
+    def update_files(self, files: Dict[str, Dict]):
+        """Обновляет сведения о файлах, содержимое которых не изменилось"""
+        with self.lock:
+            for filename, info in files.items():
+                self._set_file_info(filename, info)
+            self._save_manifest()
+    
+    def set_chunking(self, chunking: str):
+        """Запоминает параметры разбиения, с которыми проиндексированы документы"""
+        with self.lock:
+            self.chunking = chunking
+            self._save_manifest()
+    
+    def remove_sources(self, filenames: List[str]):
+        """Удаляет из индекса все части указанных файлов"""
+        if not filenames:
+            return
+        
+        with self.lock:
+            ids = self.chunks.ids_for_sources(filenames)
+            for filename in filenames:
+                self.manifest.pop(filename, None)
+            
+            if ids:
+                self.chunks.delete_ids(ids)
+                self.lexical.remove(ids)
+                self.delta.remove_ids(np.array(ids, dtype=np.int64))
+                
+                if index_factory.supports_remove(self.index):
+                    self.index.remove_ids(np.array(ids, dtype=np.int64))
+                else:
+                    # HNSW не умеет удалять, перестраиваем из оставшихся векторов
+                    self._rebuild_index(self.active_index_type)
+            
+            self._save_index()
+        print(f"Удалено документов: {len(ids)}")
+    
+    def _set_file_info(self, filename: str, info: Dict):
+        """Записывает хэш и время изменения файла в манифест"""
+        entry = self.manifest.setdefault(filename, {'hash': None, 'mtime': None, 'size': None})
+        entry.update({'hash': info['hash'], 'mtime': info['mtime'], 'size': info['size']})
+    
+    def embed_query(self, query: str) -> np.ndarray:
+        """Создает нормализованный embedding запроса размером (1, dimension)"""
+        return self.embed_queries([query])
+    
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Нормализованные embeddings нескольких запросов одним обращением к источнику, (n, dimension)"""
+        query_vectors = self.create_embeddings(queries)
+        faiss.normalize_L2(query_vectors)
+        return query_vectors
+    
+    def search(self, query: str, top_k: int = 5, query_vector: np.ndarray = None) -> List[Dict]:
+        """Ищет похожие документы
+        
+        query_vector - готовый embedding запроса из embed_query, если он уже посчитан
+        """
+        return self.search_many([query], top_k, query_vector)[0]
+    
+    def search_many(self, queries: List[str], top_k: int = 5, query_vectors: np.ndarray = None) -> List[List[Dict]]:
+        """Ищет документы для нескольких запросов одним многострочным поиском FAISS
+        
+        query_vectors - готовые embeddings запросов (n, dimension), если они уже посчитаны
+        """
+        if self.count() == 0 or not self.embeddings_match():
+            return [[] for _ in queries]
+            
+        # создаем embeddings для запросов
+        if query_vectors is None:
+            query_vectors = self.embed_queries(queries)
+        
+        # поиск; части читаются из того же поколения, что и индекс
+        with self.lock, metrics.timer("rag_search_seconds", stage="faiss", index=self.active_index_type):
+            hits = self._vector_hits(query_vectors, top_k)
+            chunks = self.chunks
+        
+        return self._fetch_many(hits, chunks=chunks)
+    
+    def _vector_hits(self, query_vectors: np.ndarray, top_k: int) -> List[List]:
+        """Лучшие [(id, близость)] по основному и дополнительному индексам; вызывается под self.lock"""
+        hits = [[] for _ in range(len(query_vectors))]
+        for index in (self.index, self.delta):
+            if not index.ntotal:
+                continue
+            scores, indices = index.search(query_vectors, top_k)
+            for row, row_scores, row_indices in zip(hits, scores, indices):
+                row.extend((int(idx), float(score)) for score, idx in zip(row_scores, row_indices) if idx >= 0)
+        
+        if self.index.ntotal and self.delta.ntotal:
+            hits = [sorted(row, key=lambda hit: hit[1], reverse=True)[:top_k] for row in hits]
+        return hits
+    
+    def _fetch(self, hits: List, extra: Dict[int, Dict] = None, chunks: ChunkStore = None) -> List[Dict]:
+        """Читает тексты только найденных частей, сохраняя порядок hits [(id, score)]"""
+        return self._fetch_many([hits], [extra], chunks)[0]
+    
+    def _fetch_many(self, hits_lists: List[List], extras: List[Dict] = None,
+                    chunks: ChunkStore = None) -> List[List[Dict]]:
+        """Читает части для нескольких запросов одним обращением к базе"""
+        with metrics.timer("rag_search_seconds", stage="fetch"):
+            found = (chunks or self.chunks).get_many(list({idx for hits in hits_lists for idx, _ in hits}))
         
         results = []
-        for score, idx in zip(scores[0], indices[0]):
-            if idx < len(self.documents):
-                doc = self.documents[idx].copy()
-                doc['similarity_score'] = float(score)
-                results.append(doc)
+        for hits, extra in zip(hits_lists, extras or [None] * len(hits_lists)):
+            docs = []
+            for idx, score in hits:
+                if idx in found:
+                    # одна часть может попасть в результаты нескольких запросов
+                    doc = dict(found[idx])
+                    doc['similarity_score'] = score
+                    doc.update((extra or {}).get(idx, {}))
+                    docs.append(doc)
+            results.append(docs)
         
         return results
     
+    def lexical_search(self, query: str, top_k: int = 5) -> List[Dict]:
+        """Ищет по BM25 без обращения к API
+        
+        similarity_score — BM25, нормированный на предельный балл запроса (0..1).
+        """
+        with self.lock:
+            lexical, chunks = self.lexical, self.chunks
+        
+        return self._lexical_docs(lexical.search(query, top_k), top_k, chunks)
+    
+    def _lexical_docs(self, hits: List[Dict], top_k: int, chunks: ChunkStore = None) -> List[Dict]:
+        """Части для первых top_k результатов BM25"""
+        hits = hits[:top_k]
+        return self._fetch(
+            [(hit['id'], hit['score'] / hit['max_score'] if hit['max_score'] else 0.0) for hit in hits],
+            {hit['id']: {'lexical_score': hit['score'], 'coverage': hit['coverage']} for hit in hits},
+            chunks
+        )
+    
+    def confident_lexical_search(self, query: str, top_k: int = 5, max_terms: int = 4,
+                                 min_score: float = 0.3, candidates: int = 20) -> Tuple[List[Dict], List[Dict]]:
+        """Быстрый путь для коротких запросов по ключевым словам
+        
+        Возвращает (результаты BM25 или None, кандидаты BM25). Результаты есть,
+        если лучший документ содержит все термы короткого запроса и набрал не
+        меньше min_score. Кандидатов передают в hybrid_search_many, чтобы
+        BM25 не считался для вопроса второй раз.
+        """
+        with self.lock:
+            lexical, chunks = self.lexical, self.chunks
+        
+        hits = lexical.search(query, max(top_k, candidates))
+        if not hits:
+            return None, hits
+        
+        best = hits[0]
+        if best['terms'] > max_terms or best['coverage'] < 1.0 or best['score'] < min_score * best['max_score']:
+            return None, hits
+        
+        return self._lexical_docs(hits, top_k, chunks), hits
+    
+    def hybrid_search(self, query: str, top_k: int = 5, query_vector: np.ndarray = None,
+                      candidates: int = 20, rrf_k: int = 60) -> List[Dict]:
+        """Объединяет векторный и BM25-поиск по reciprocal rank fusion"""
+        return self.hybrid_search_many([query], top_k, query_vector, candidates, rrf_k)[0]
+    
+    def hybrid_search_many(self, queries: List[str], top_k: int = 5, query_vectors: np.ndarray = None,
+                           candidates: int = 20, rrf_k: int = 60,
+                           lexical_candidates: List[List[Dict]] = None) -> List[List[Dict]]:
+        """Гибридный поиск для нескольких запросов: векторная часть одним поиском FAISS
+        
+        lexical_candidates - уже найденные кандидаты BM25 по запросам (None, если их нет)
+        """
+        if self.count() == 0:
+            return [[] for _ in queries]
+        
+        if not self.embeddings_match():
+            # векторы индекса несовместимы с вопросом, пока документы не перезагружены
+            with self.lock:
+                lexical, chunks = self.lexical, self.chunks
+            vector_hits_lists = [[] for _ in queries]
+        else:
+            if query_vectors is None:
+                query_vectors = self.embed_queries(queries)
+            
+            with self.lock, metrics.timer("rag_search_seconds", stage="faiss", index=self.active_index_type):
+                vector_hits_lists = self._vector_hits(query_vectors, candidates)
+                lexical, chunks = self.lexical, self.chunks
+        
+        hits_lists, extras = [], []
+        for i, (query, vector_hits) in enumerate(zip(queries, vector_hits_lists)):
+            found = lexical_candidates[i] if lexical_candidates else None
+            lexical_hits = found[:candidates] if found is not None else lexical.search(query, candidates)
+            
+            fused = {}
+            for rank, (idx, _) in enumerate(vector_hits):
+                fused[idx] = fused.get(idx, 0.0) + 1.0 / (rrf_k + rank + 1)
+            for rank, hit in enumerate(lexical_hits):
+                fused[hit['id']] = fused.get(hit['id'], 0.0) + 1.0 / (rrf_k + rank + 1)
+            
+            best = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+            
+            # для контекста показываем косинусную близость, а для найденных только по BM25 — нормированный балл
+            similarity = {idx: score for idx, score in vector_hits}
+            for hit in lexical_hits:
+                if hit['id'] not in similarity and hit['max_score']:
+                    similarity[hit['id']] = hit['score'] / hit['max_score']
+            
+            hits_lists.append([(idx, similarity.get(idx, 0.0)) for idx, _ in best])
+            extras.append({idx: {'hybrid_score': score} for idx, score in best})
+        
+        return self._fetch_many(hits_lists, extras, chunks)
+    
+    def count(self) -> int:
+        """Число частей документов в индексе"""
+        return self.index.ntotal + self.delta.ntotal
+    
+    def memory(self) -> int:
+        """Примерный объем индекса в памяти, байт"""
+        return index_factory.estimate_memory(self.index) + index_factory.estimate_memory(self.delta)
+    
+    def close(self):
+        """Закрывает базы текущего поколения; общий кэш embeddings остается открытым"""
+        with self.lock:
+            self.chunks.close()
+            self.lexical.close()
+    
+    def sources(self) -> List[str]:
+        """Имена загруженных файлов"""
+        return self.chunks.sources()
+    
+    def count_source(self, filename: str) -> int:
+        """Число частей файла в индексе"""
+        return self.chunks.count_source(filename)
+    
     def _save_index(self):
-        """Сохраняет индекс и документы"""
-        faiss.write_index(self.index, self.index_file)
+        """Сохраняет индекс и манифест, части документов уже записаны в chunks.db"""
+        _replace_file(self.index_file, lambda path: faiss.write_index(self.index, path))
+        self.index_file_info = {'size': os.path.getsize(self.index_file), 'vectors': int(self.index.ntotal)}
+        if self.verify_checksums:
+            # чтение всего файла заметно на большом индексе, поэтому сумма считается только для проверки
+            self.index_file_info['sha256'] = _file_digest(self.index_file)
+        if self.delta.ntotal:
+            self._save_delta()
+            return
         
-        with open(self.docs_file, 'w', encoding='utf-8') as f:
-            json.dump(self.documents, f, ensure_ascii=False, indent=2)
+        # манифест пишется после индекса: если запись прервется, размер и сумма не сойдутся
+        self.delta_file_info = None
+        self._save_manifest()
+        if os.path.exists(self.delta_file):
+            os.remove(self.delta_file)
+    
+    def _save_delta(self):
+        """Сохраняет дополнительный индекс и манифест, основной индекс не переписывается"""
+        _replace_file(self.delta_file, lambda path: faiss.write_index(self.delta, path))
+        self.delta_file_info = {'size': os.path.getsize(self.delta_file), 'vectors': int(self.delta.ntotal)}
+        self._save_manifest()
+    
+    def _save_manifest(self):
+        """Сохраняет манифест файлов"""
+        def write(path):
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({
+                    'format': FORMAT_VERSION,
+                    'next_id': self.next_id,
+                    'index': {
+                        'type': self.active_index_type, 'requested': self.index_type,
+                        'params': self.index_params, 'file': self.index_file_info, 'delta': self.delta_file_info
+                    },
+                    'chunking': self.chunking,
+                    'embeddings': self.embedding_info,
+                    'files': self.manifest
+                }, f, ensure_ascii=False)
+        _replace_file(self.manifest_file, write)
+    
+    def reset(self):
+        """Удаляет все части документов и создает пустой индекс для выбранных embeddings
+        
+        Вызывается для хранилища из begin_update.
+        """
+        with self.lock:
+            self.index = self._create_index()
+            self.delta = self._empty_delta()
+            self.chunks.clear()
+            self.lexical.clear()
+            self.manifest = {}
+            self.embedding_info = self.embedder.metadata()
     
     def clear(self):
-        """Очищает индекс"""
-        self.index = faiss.IndexFlatIP(self.dimension)
-        self.documents = []
-        self._save_index()
+        """Очищает индекс, заменяя текущее поколение пустым"""
+        staged = self.begin_update()
+        staged.reset()
+        self.commit_update(staged)
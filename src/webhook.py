@@ -0,0 +1,211 @@
+import asyncio
+import hmac
+import json
+import multiprocessing
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# обновления, меняющие индекс: их обрабатывает только процесс-писатель
+WRITER_COMMANDS = ("/reload", "/rollback")
+
+def route(update: Dict, readers: int) -> Optional[int]:
+    """Номер читателя для обновления или None, если его обрабатывает писатель
+
+    Обновления одного пользователя всегда попадают в один процесс, поэтому
+    его история в памяти процесса не расходится с SQLite.
+    """
+    message = update.get('message') or update.get('edited_message') or {}
+    text = message.get('text') or ""
+    command = text.split(maxsplit=1)[0].split('@')[0] if text.startswith('/') else None
+    if not readers or message.get('document') or command in WRITER_COMMANDS:
+        return None
+
+    # пользователь есть в сообщении, нажатии кнопки и других видах обновлений
+    user = next((value['from'] for value in update.values() if isinstance(value, dict) and 'from' in value), None)
+    user_id = user['id'] if user else message.get('chat', {}).get('id', 0)
+    return user_id % readers
+
+def _run_worker(role: str, number: int, queue, peers: List, ready, metrics_port: Optional[int]):
+    """Точка входа процесса бота"""
+    if role == "reader":
+        # бот читает переменные окружения при импорте
+        os.environ["INDEX_READ_ONLY"] = "1"
+    try:
+        asyncio.run(_serve(role, number, queue, peers, ready, metrics_port))
+    except KeyboardInterrupt:
+        pass
+
+async def _serve(role: str, number: int, queue, peers: List, ready, metrics_port: Optional[int]):
+    from telegram import Update
+    from src import bot
+
+    app = bot.create_bot(metrics_port)
+    if role == "writer":
+        # читатели переходят на поколение индекса, созданное писателем
+        bot.rag.generation_listeners.append(lambda name: [peer.put({'refresh': name}) for peer in peers])
+
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    print(f"Процесс {role} {number} (pid {os.getpid()}) готов")
+    ready.set()
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, queue.get)
+            if item is None:
+                break
+            if 'refresh' in item:
+                await bot.rag.refresh_collection(item['refresh'])
+            else:
+                await app.update_queue.put(Update.de_json(item, app.bot))
+    finally:
+        await app.stop()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+        await app.shutdown()
+
+class WorkerPool:
+    """Процессы бота, между которыми распределяются обновления из webhook
+
+    Писатель — единственный процесс, который меняет индексы: /reload,
+    /rollback и загрузка файлов. readers процессов отвечают на вопросы по
+    тем же файлам индекса и частей только для чтения (с INDEX_MMAP=1 индекс
+    IVF делится через page cache) и после изменения индекса получают от
+    писателя сигнал перейти на новое поколение. Каждый процесс — свой
+    интерпретатор, поэтому поиск и сборка промпта идут на всех ядрах.
+    """
+
+    def __init__(self, readers: int = None, metrics_port: int = None):
+        self.readers = readers or os.cpu_count() or 1
+        # порты метрик: писатель metrics_port, читатели следующие по порядку
+        self.metrics_port = metrics_port
+        # spawn: процессы не наследуют потоки и открытые базы родителя
+        self.context = multiprocessing.get_context("spawn")
+        self.writer = None
+        self.writer_queue = None
+        self.processes = []
+        self.queues = []
+
+    def start(self):
+        """Запускает писателя, затем читателей, и ждет их готовности"""
+        self.queues = [self.context.Queue() for _ in range(self.readers)]
+        self.writer_queue = self.context.Queue()
+
+        # писатель стартует первым: он создает и переносит хранилища, которые открывают читатели
+        self.writer = self._spawn("writer", 0, self.writer_queue, self.queues)
+        self._wait_ready([self.writer])
+        self.processes = [
+            self._spawn("reader", number, queue, [])
+            for number, queue in enumerate(self.queues, start=1)
+        ]
+        self._wait_ready(self.processes)
+        return self
+
+    def _spawn(self, role: str, number: int, queue, peers: List):
+        ready = self.context.Event()
+        port = self.metrics_port + number if self.metrics_port else None
+        process = self.context.Process(
+            target=_run_worker, args=(role, number, queue, peers, ready, port), name=f"rag-{role}-{number}", daemon=True
+        )
+        process.ready = ready
+        process.start()
+        return process
+
+    def _wait_ready(self, processes: List):
+        for process in processes:
+            while not process.ready.wait(1.0):
+                if not process.is_alive():
+                    raise RuntimeError(f"Процесс {process.name} завершился при запуске с кодом {process.exitcode}")
+
+    def dispatch(self, update: Dict):
+        """Передает обновление процессу, который должен его обработать"""
+        number = route(update, self.readers)
+        (self.writer_queue if number is None else self.queues[number]).put(update)
+
+    def stop(self, timeout: float = 10.0):
+        """Останавливает процессы, дав им закончить начатые ответы"""
+        for queue in [self.writer_queue] + self.queues:
+            queue.put(None)
+        for process in [self.writer] + self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+class WebhookServer:
+    """HTTP-сервер, принимающий обновления Telegram и передающий их WorkerPool
+
+    Запросы без заголовка X-Telegram-Bot-Api-Secret-Token с секретом,
+    переданным в setWebhook, отклоняются. Ответ Telegram отправляется сразу
+    после постановки обновления в очередь процесса.
+    """
+
+    def __init__(self, pool: WorkerPool, host: str = "0.0.0.0", port: int = 8443, path: str = "/telegram",
+                 secret: str = None):
+        self.pool = pool
+        self.path = path
+        self.secret = secret
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self.httpd.server_address[1]
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.split('?')[0] != server.path:
+                    self._reply(404)
+                    return
+
+                token = self.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+                if server.secret and not hmac.compare_digest(token, server.secret):
+                    self._reply(403)
+                    return
+
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    update = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self._reply(400)
+                    return
+
+                server.pool.dispatch(update)
+                self._reply(200)
+
+            def _reply(self, status):
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+async def register_webhook(bot_token: str, url: str, secret: str = None, commands: List = None,
+                           api_url: str = None):
+    """Сообщает Telegram адрес webhook и устанавливает меню команд"""
+    from telegram import Bot, Update
+
+    kwargs = {}
+    if api_url:
+        kwargs = {'base_url': f"{api_url.rstrip('/')}/bot", 'base_file_url': f"{api_url.rstrip('/')}/file/bot"}
+
+    async with Bot(bot_token, **kwargs) as bot:
+        await bot.set_webhook(url, secret_token=secret, allowed_updates=Update.ALL_TYPES)
+        if commands:
+            await bot.set_my_commands(commands)
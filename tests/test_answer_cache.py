@@ -0,0 +1,85 @@
+import asyncio
+import numpy as np
+import pytest
+from src.answer_cache import AnswerCache
+from src.fake_openai import FakeOpenAIServer
+from src.rag_system import RAGSystem
+
+def _unit(seed: int) -> np.ndarray:
+    vector = np.random.default_rng(seed).standard_normal(32).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+def test_put_after_clear_is_skipped():
+    cache = AnswerCache()
+    epoch = cache.epoch
+    cache.clear()
+    cache.put(_unit(0), {'answer': "старый"}, epoch=epoch)
+    cache.put_exact(("отпуск",), {'answer': "старый"}, epoch=epoch)
+
+    assert cache.get(_unit(0)) is None
+    assert cache.get_exact(("отпуск",)) is None
+    assert cache.stats()['size'] == 0
+
+def test_exact_entries_expire_and_are_bounded():
+    cache = AnswerCache(ttl=3600, max_size=2)
+    for i in range(3):
+        cache.put_exact(i, {'answer': str(i)})
+
+    assert cache.get_exact(0) is None
+    assert cache.get_exact(2) == {'answer': "2"}
+
+    cache.ttl = -1
+    assert cache.get_exact(2) is None
+
+def test_matrix_grows_with_entries():
+    cache = AnswerCache(max_size=100)
+    for i in range(20):
+        cache.put(_unit(i), {'answer': str(i)})
+
+    assert cache.vectors.shape[0] == 32
+    assert cache.get(_unit(19)) == {'answer': "19"}
+
+@pytest.fixture
+def rag(tmp_path):
+    server = FakeOpenAIServer(chat_latency=0.2).start()
+    docs = tmp_path / "docs"
+    docs.mkdir()
+    (docs / "отпуск.txt").write_text("Отпуск оформляется заявлением за две недели до начала.", encoding="utf-8")
+    (docs / "склад.txt").write_text("Товары на складе принимаются по накладной.", encoding="utf-8")
+    system = RAGSystem(
+        "test", base_url=server.base_url, embedding_provider="hashing", embedding_dim=64,
+        docs_path=str(tmp_path / "docs"), store_path=str(tmp_path / "vectors"),
+        history_path=str(tmp_path / "history.db"), collections_path=str(tmp_path / "collections")
+    )
+    assert system.reload_documents_sync()[0]
+    yield system, server
+    server.stop()
+
+def test_keyword_answers_are_cached(rag):
+    system, server = rag
+    question = "отпуск заявлением"
+    assert system.vector_store.confident_lexical_search(question, top_k=system.retrieval_top_k)[0]
+
+    async def ask():
+        return [await system.ask_question(user_id, question) for user_id in (1, 2, 3)]
+
+    results = asyncio.run(ask())
+
+    assert server.requests == 1
+    assert [result.get('cached', False) for result in results] == [False, True, True]
+
+def test_answer_started_before_clear_is_not_cached(rag):
+    system, server = rag
+    question = "отпуск заявлением"
+
+    async def ask_during_reload():
+        answer = asyncio.ensure_future(system.ask_question(1, question))
+        await asyncio.sleep(0.1)  # генерация ответа еще идет
+        system.default_collection.answer_cache.clear()
+        await answer
+        return await system.ask_question(2, question)
+
+    second = asyncio.run(ask_during_reload())
+
+    assert not second.get('cached', False)
+    assert server.requests == 2
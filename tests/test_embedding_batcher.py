@@ -0,0 +1,35 @@
+import openai
+import pytest
+from src.embedding_batcher import EmbeddingBatcher
+from src.fake_openai import FakeOpenAIServer, fake_embedding
+
+@pytest.fixture
+def server():
+    server = FakeOpenAIServer(latency=0.02, rate_limit_probability=0.3, dimension=16, seed=1).start()
+    yield server
+    server.stop()
+
+def _batcher(server, **kwargs):
+    client = openai.OpenAI(api_key="test", base_url=server.base_url)
+    return EmbeddingBatcher(client, "text-embedding-ada-002", **kwargs)
+
+def test_rate_limited_batches_are_retried_in_order(server):
+    texts = [f"текст номер {i}" for i in range(60)]
+    batcher = _batcher(server, max_batch_items=4, max_concurrency=3, base_delay=0.01)
+
+    embeddings = batcher.embed(texts)
+
+    assert server.rate_limited > 0
+    assert batcher.retries == server.rate_limited
+    assert server.requests == 15 + server.rate_limited  # 15 пачек и по запросу на каждый повтор
+    assert server.max_in_flight <= 3
+    assert embeddings == [pytest.approx(fake_embedding(text, 16)) for text in texts]
+
+def test_retries_are_bounded(server):
+    server.rate_limit_probability = 1.0
+    batcher = _batcher(server, max_retries=2, base_delay=0.01)
+
+    with pytest.raises(openai.RateLimitError):
+        batcher.embed(["текст"])
+
+    assert batcher.retries == 2 and server.requests == 3
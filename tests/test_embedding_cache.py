@@ -0,0 +1,39 @@
+import numpy as np
+from src.embedding_cache import EmbeddingCache
+
+def _vectors(count: int):
+    return [np.full(4, i, dtype=np.float32) for i in range(count)]
+
+def test_hits_do_not_write_to_the_database(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"))
+    cache.put_many("m", ["a", "b"], _vectors(2))
+    changes = cache.conn.total_changes
+
+    vectors = cache.get_many("m", ["a", "b", "c"])
+
+    assert cache.conn.total_changes == changes
+    assert [v is None for v in vectors] == [False, False, True]
+    assert np.array_equal(vectors[1], np.full(4, 1, dtype=np.float32))
+    assert (cache.hits, cache.misses) == (2, 1)
+
+def test_stale_entries_are_touched_on_flush(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), touch_interval=0)
+    cache.put_many("m", ["a"], _vectors(1))
+    cache.conn.execute("UPDATE embeddings SET last_used = 0")
+    cache.conn.commit()
+
+    cache.get_many("m", ["a"])
+    cache.flush()
+
+    assert cache.conn.execute("SELECT last_used FROM embeddings").fetchone()[0] > 0
+
+def test_eviction_keeps_recently_read_entries(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache.db"), max_entries=2, touch_interval=0)
+    cache.put_many("m", ["a", "b"], _vectors(2))
+    cache.conn.execute("UPDATE embeddings SET last_used = 1")
+    cache.conn.commit()
+
+    cache.get_many("m", ["a"])
+    cache.put_many("m", ["c"], _vectors(1))
+
+    assert [v is None for v in cache.get_many("m", ["a", "b", "c"])] == [False, True, False]
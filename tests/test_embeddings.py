@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from src.embeddings import EmbeddingProvider, HashingEmbeddingProvider, create_provider
+
+def test_provider_without_embed_fails_at_construction():
+    class Incomplete(EmbeddingProvider):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+def test_openai_rejects_dimension_of_another_model():
+    with pytest.raises(ValueError):
+        create_provider("openai", 256)
+
+    assert create_provider("openai", 1536).dimension == 1536
+    assert create_provider("openai").dimension == 1536
+
+def test_hashing_embeddings_are_normalized_and_deterministic():
+    provider = create_provider("hashing", 64)
+    first = provider.embed(["договор аренды", ""])
+
+    assert isinstance(provider, HashingEmbeddingProvider)
+    assert first.shape == (2, 64) and first.dtype == np.float32
+    assert np.isclose(np.linalg.norm(first[0]), 1.0)
+    assert np.array_equal(first, create_provider("hashing", 64).embed(["договор аренды", ""]))
@@ -0,0 +1,46 @@
+import json
+import os
+import openai
+from src import evaluation
+from src.embeddings import OpenAIEmbeddingProvider, create_provider
+from src.evaluation import benchmark_retrieval, generate_corpus
+from src.fake_openai import FakeOpenAIServer
+from src.vector_store import FAISSVectorStore
+
+def _build_store(path, docs_path, embedder):
+    store = FAISSVectorStore(path, embedder=embedder)
+    staged = store.begin_update()
+    for name in sorted(os.listdir(docs_path)):
+        with open(os.path.join(docs_path, name), encoding='utf-8') as f:
+            staged.add_documents([{'text': line, 'source': name} for line in f if line.strip()], save=False)
+    store.commit_update(staged)
+    return store
+
+def test_embedding_requests_counts_requests_not_texts(tmp_path):
+    qa = generate_corpus(str(tmp_path / "docs"), files=2, facts_per_file=5)
+    server = FakeOpenAIServer(dimension=64).start()
+    try:
+        client = openai.OpenAI(api_key="test", base_url=server.base_url)
+        store = _build_store(str(tmp_path / "vectors"), str(tmp_path / "docs"),
+                             OpenAIEmbeddingProvider(client, dimension=64))
+        requests_before = server.embedding_requests
+
+        result = benchmark_retrieval(store, qa, top_k=3, modes=('vector',))
+
+        assert result['vector']['embedding_requests'] == server.embedding_requests - requests_before == len(qa)
+    finally:
+        server.stop()
+
+def test_cli_does_not_touch_a_store_in_use(tmp_path):
+    qa = generate_corpus(str(tmp_path / "docs"), files=2, facts_per_file=5)
+    store_path = str(tmp_path / "vectors")
+    store = _build_store(store_path, str(tmp_path / "docs"), create_provider("hashing", 64))
+    # поколение, которое бот сейчас строит
+    staged = store.begin_update()
+    qa_path = tmp_path / "qa.json"
+    qa_path.write_text(json.dumps(qa, ensure_ascii=False), encoding='utf-8')
+
+    evaluation.main(['--store', store_path, '--qa', str(qa_path), '--embeddings', 'hashing', '--embedding-dim', '64'])
+
+    assert os.path.isdir(os.path.join(store_path, "generations", staged.generation))
+    store.commit_update(staged)
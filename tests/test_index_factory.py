@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from src import index_factory
+from src.embeddings import create_provider
+from src.vector_store import FAISSVectorStore
+
+def _vectors(count: int, dimension: int, seed: int = 0):
+    vectors = np.random.default_rng(seed).normal(size=(count, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def _docs(source: str, count: int):
+    return [{'text': f"{source} часть {i} про договор {source}{i}", 'source': source} for i in range(count)]
+
+def test_default_pq_m_divides_dimension():
+    vectors = _vectors(1000, 60)
+    index = index_factory.create_index('ivf_pq', 60, {'nlist': 4, 'pq_bits': 4}, training_vectors=vectors)
+    assert 60 % index.pq.M == 0
+
+def test_pq_m_not_dividing_dimension_is_rejected_up_front(tmp_path):
+    with pytest.raises(ValueError, match="pq_m=64"):
+        index_factory.check_params('ivf_pq', 60, {'pq_m': 64})
+    with pytest.raises(ValueError, match="pq_m"):
+        FAISSVectorStore(str(tmp_path), embedder=create_provider("hashing", 60),
+                         index_type='ivf_pq', index_params={'pq_m': 64})
+
+def test_reconstruct_after_removal():
+    vectors = _vectors(500, 16)
+    ids = np.arange(500, dtype=np.int64) * 3
+    index = index_factory.create_index('ivf_flat', 16, {'nlist': 4}, training_vectors=vectors)
+    index.add_with_ids(vectors, ids)
+    index.remove_ids(ids[:10])
+
+    stored = index_factory.stored_ids(index)
+    assert sorted(stored) == list(ids[10:])
+    assert np.allclose(index_factory.reconstruct(index, stored), vectors[stored // 3])
+
+def test_stored_vectors_include_delta(tmp_path):
+    embedder = create_provider("hashing", 64)
+    store = FAISSVectorStore(str(tmp_path), embedder=embedder)
+    staged = store.begin_update()
+    staged.add_documents(_docs("a", 20), {'a': {'hash': "a", 'mtime': 1.0, 'size': 1}})
+    store.commit_update(staged)
+    store.append_documents(iter(_docs("b", 5)), {'b': {'hash': "b", 'mtime': 1.0, 'size': 1}})
+
+    ids, vectors = index_factory.load_stored_vectors(str(tmp_path))
+    assert sorted(ids) == list(range(25))
+    assert np.allclose(vectors[list(ids).index(22)], embedder.embed([_docs("b", 5)[2]['text']])[0], atol=1e-6)
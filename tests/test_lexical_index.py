@@ -0,0 +1,42 @@
+from src.lexical_index import LexicalIndex, tokenize
+
+DOCS = [
+    (0, "Договор аренды помещения"),
+    (1, "Договор поставки оборудования"),
+    (2, "Инструкция по охране труда"),
+]
+
+def _df(index: LexicalIndex):
+    return dict(index.conn.execute("SELECT term, df FROM term_df"))
+
+def _df_from_postings(index: LexicalIndex):
+    return dict(index.conn.execute("SELECT term, COUNT(*) FROM postings GROUP BY term"))
+
+def test_df_matches_postings_after_add_replace_and_remove(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical.db"))
+    index.add(DOCS)
+    index.add([(1, "Договор подряда")])
+    index.remove([2])
+
+    assert _df(index) == _df_from_postings(index)
+    assert index.count() == 2
+
+def test_clear_resets_document_frequencies(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical.db"))
+    index.add(DOCS)
+    index.clear()
+    index.add(DOCS)
+
+    assert _df(index)[tokenize("договор")[0]] == 2
+    assert _df(index) == _df_from_postings(index)
+    assert index.count() == 3
+
+def test_search_ranks_matching_document_first(tmp_path):
+    index = LexicalIndex(str(tmp_path / "lexical.db"))
+    index.add(DOCS)
+
+    hits = index.search("договор аренды", top_k=2)
+
+    assert hits[0]['id'] == 0
+    assert hits[0]['coverage'] == 1.0
+    assert hits[0]['terms'] == 2
@@ -0,0 +1,131 @@
+import os
+import subprocess
+import sys
+import faiss
+import pytest
+from src.embeddings import create_provider
+from src.vector_store import FAISSVectorStore
+
+def _docs(source: str, count: int):
+    return [{'text': f"{source} часть {i} про договор {source}{i}", 'source': source} for i in range(count)]
+
+def _info(name: str):
+    return {'hash': name, 'mtime': 1.0, 'size': 1}
+
+@pytest.fixture
+def embedder():
+    return create_provider("hashing", 64)
+
+def _store(path, embedder, **kwargs):
+    return FAISSVectorStore(str(path), embedder=embedder, **kwargs)
+
+def test_commit_swaps_generation_and_rollback_restores_it(tmp_path, embedder):
+    store = _store(tmp_path, embedder)
+    staged = store.begin_update()
+    staged.add_documents(_docs("a", 5), {'a': _info("a")})
+    assert store.count() == 0  # изменения не видны до commit_update
+    store.commit_update(staged)
+    first = store.generation
+
+    staged = store.begin_update()
+    staged.add_documents(_docs("b", 3), {'b': _info("b")})
+    store.commit_update(staged)
+    assert store.count() == 8 and store.generation != first
+
+    assert store.rollback()
+    assert store.generation == first and store.count() == 5
+    assert _store(tmp_path, embedder).count() == 5
+
+def test_abort_removes_staged_generation(tmp_path, embedder):
+    store = _store(tmp_path, embedder)
+    staged = store.begin_update()
+    staged.add_documents(_docs("a", 2), {'a': _info("a")})
+    store.abort_update(staged)
+
+    assert not os.path.exists(os.path.join(store.generations_path, staged.generation))
+    assert store.count() == 0
+
+def test_opening_store_keeps_generation_staged_by_live_process(tmp_path, embedder):
+    store = _store(tmp_path, embedder)
+    staged = store.begin_update()
+    staged.add_documents(_docs("a", 2), {'a': _info("a")})
+
+    # второй процесс-писатель открывает то же хранилище
+    _store(tmp_path, embedder)
+    store.commit_update(staged)
+
+    assert store.count() == 2
+
+def test_opening_store_removes_generation_of_dead_process(tmp_path, embedder):
+    store = _store(tmp_path, embedder)
+    staged = store.begin_update()
+    dead = subprocess.run([sys.executable, "-c", "import os; print(os.getpid())"], capture_output=True, text=True)
+    with open(os.path.join(store.generations_path, staged.generation, "STAGING"), 'w', encoding='utf-8') as f:
+        f.write(dead.stdout.strip())
+    staged.chunks.close()
+    staged.lexical.close()
+
+    _store(tmp_path, embedder)
+
+    assert not os.path.exists(os.path.join(store.generations_path, staged.generation))
+
+@pytest.fixture
+def committed(tmp_path, embedder):
+    store = _store(tmp_path, embedder)
+    staged = store.begin_update()
+    staged.add_documents(_docs("a", 20), {'a': _info("a")})
+    store.commit_update(staged)
+    return store
+
+def test_append_adds_to_delta_without_rewriting_index(committed):
+    index_mtime = os.path.getmtime(committed.index_file)
+    generation = committed.generation
+
+    assert committed.append_documents(iter(_docs("b", 5)), {'b': _info("b")}) == 5
+
+    assert os.path.getmtime(committed.index_file) == index_mtime
+    assert committed.generation == generation
+    assert committed.count() == 25 and committed.delta.ntotal == 5
+    assert committed.search("b часть 3 про договор b3", 1)[0]['source'] == "b"
+    assert committed.hybrid_search("b3", 1)[0]['source'] == "b"
+
+def test_read_only_refresh_picks_up_append(tmp_path, embedder, committed):
+    reader = _store(tmp_path, embedder, read_only=True)
+    committed.append_documents(iter(_docs("b", 5)), {'b': _info("b")})
+
+    assert reader.count() == 20
+    assert reader.refresh()
+    assert reader.count() == 25
+    assert reader.search("b часть 3 про договор b3", 1)[0]['source'] == "b"
+
+def test_failed_append_discards_written_chunks(committed):
+    def docs():
+        yield from _docs("b", 30)
+        raise RuntimeError("чтение файла прервано")
+
+    with pytest.raises(RuntimeError):
+        committed.append_documents(docs(), {'b': _info("b")}, batch_size=10)
+
+    assert committed.count() == 20 and committed.chunks.count() == 20
+    assert committed.lexical.count() == 20 and 'b' not in committed.manifest
+
+def test_reopen_drops_chunks_appended_before_crash(tmp_path, embedder, committed):
+    # части и delta.index записаны, манифест — нет
+    committed.add_documents(_docs("b", 5), delta=True, save=False)
+    faiss.write_index(committed.delta, committed.delta_file)
+    committed.close()
+
+    store = _store(tmp_path, embedder)
+
+    assert store.count() == 20 and store.chunks.count() == 20
+    assert store.lexical.count() == 20 and store.delta.ntotal == 0
+
+def test_begin_update_merges_delta_into_index(committed):
+    committed.append_documents(iter(_docs("b", 5)), {'b': _info("b")})
+
+    staged = committed.begin_update()
+    staged.remove_sources(['a'])
+    committed.commit_update(staged)
+
+    assert committed.count() == 5 and committed.delta.ntotal == 0
+    assert committed.index.ntotal == 5 and not os.path.exists(committed.delta_file)